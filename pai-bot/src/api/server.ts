@@ -662,13 +662,51 @@ export function startApiServer(port = 3000) {
         // RAG - query (agentic)
         if (path === "/api/rag/query" && method === "POST") {
           const body = await req.json();
-          const { question, max_retries = 2 } = body;
+          const {
+            question,
+            max_retries = 2,
+            stream = false,
+            session_id,
+            retrieval,
+            deadline,
+          } = body;
           if (!question) {
             return Response.json(
               { error: "question required" },
               { status: 400, headers: corsHeaders },
             );
           }
+          // 對話 session：追問沿用上一輪檢索到的文件
+          const sessionArgs = session_id ? ["--session", String(session_id)] : [];
+          // 檢索模式（loop / fanout / federated）；federated 會同時查詢記憶與歷史
+          const retrievalArgs = retrieval ? ["--retrieval", String(retrieval)] : [];
+          // 每個問題的時間上限（秒）；接近時略過評分 / 重寫，必要時只回傳檢索段落
+          const deadlineArgs = deadline ? ["--deadline", String(deadline)] : [];
+          if (stream) {
+            // NDJSON 事件（route、sources、grade、shortcut、token、done）直接轉送
+            const proc = Bun.spawn(
+              [
+                PYTHON_PATH,
+                agenticRagScript,
+                "query",
+                "-q",
+                question,
+                "--vault",
+                VAULT_PATH,
+                "-r",
+                String(max_retries),
+                ...sessionArgs,
+                ...retrievalArgs,
+                ...deadlineArgs,
+                "--stream",
+                "--json",
+              ],
+              { stdout: "pipe", stderr: "ignore" },
+            );
+            return new Response(proc.stdout, {
+              headers: { ...corsHeaders, "Content-Type": "application/x-ndjson" },
+            });
+          }
           const result = await runPython([
             agenticRagScript,
             "query",
@@ -678,6 +716,9 @@ export function startApiServer(port = 3000) {
             VAULT_PATH,
             "-r",
             String(max_retries),
+            ...sessionArgs,
+            ...retrievalArgs,
+            ...deadlineArgs,
             "--json",
           ]);
           return Response.json(result, { headers: corsHeaders });
@@ -3,27 +3,110 @@
 
 from __future__ import annotations
 
+import asyncio
 import json
 import os
+import re
+import sqlite3
 import sys
+import time
+from collections.abc import Iterator
+from datetime import UTC, datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import TYPE_CHECKING, Annotated, Any, Literal, TypedDict
+from typing import TYPE_CHECKING, Annotated, Any, Literal, NotRequired, TypedDict
 
+import numpy as np
+from answer_cache import AnswerCache
+from federated_rag import Source, afederated_search, default_sources, federated_search
 from langchain_core.documents import Document
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
-from obsidian_rag import ObsidianRAG
+from llm_cache import get_llm_cache
+from obsidian_rag import (
+    SEARCH_FETCH_MULTIPLIER,
+    SEARCH_TIMEOUT,
+    DuplicateIndex,
+    ObsidianRAG,
+    content_hash,
+    estimate_tokens,
+    extract_keywords,
+    merge_adjacent_chunks,
+    reciprocal_rank_fusion,
+    simhash,
+)
 from pydantic import BaseModel, Field
+from query_router import QueryRouter
+from reranker import (
+    RERANK_CACHE_FILE,
+    RERANK_CANDIDATES,
+    RERANK_ENABLED,
+    CrossEncoderReranker,
+    rerank_available,
+)
 
 if TYPE_CHECKING:
     from langgraph.graph.state import CompiledStateGraph
 
 # Constants
 DEFAULT_VAULT_PATH = Path.home() / "obsidian"
+# QueryRouter 的路由對應到的起始節點
+ROUTE_NODES = {"direct": "direct", "keyword": "keyword", "vector": "search", "agentic": "retrieve"}
+GREETINGS = ["你好", "嗨", "哈囉", "hello", "hi", "hey"]
 MAX_RETRIES = 2
+GRADE_CONCURRENCY = 5  # 同時進行的 grading 呼叫上限
+MIN_RELEVANT_DOCS = 1  # 相關文件少於此數才重寫查詢
+FANOUT_QUERIES = 3  # fanout 檢索一次產生的改寫查詢數
+RETRIEVAL_MODES = ("loop", "fanout", "federated")
+# 距離門檻：cosine distance <= relevant 直接視為相關、>= irrelevant 直接視為不相關，
+# 只有中間區段才呼叫 LLM 評分；calibrate 命令會依標註樣本覆寫
+GRADE_RELEVANT_DISTANCE = 0.25
+GRADE_IRRELEVANT_DISTANCE = 0.65
+GRADE_THRESHOLDS_FILE = "grade_thresholds.json"
+CALIBRATION_PRECISION = 0.95
+CALIBRATION_MIN_SAMPLES = 20
+QUERY_CONCURRENCY = 8  # query_many 同時執行的問題上限
+EMBED_BATCH_WINDOW = 0.01  # 秒；同一時間窗內的查詢 embedding 合併成一次 API 呼叫
+SESSION_DB_FILE = "agentic_sessions.sqlite"  # 對話 session 的 checkpoint（存在向量庫旁）
+SESSION_HISTORY_MESSAGES = 6  # 生成時帶入的前幾則對話
+# 追問判斷：指涉前文的詞，以及不算新實體的常見詞/功能字
+FOLLOWUP_PATTERN = re.compile(
+    r"它|他們|她們|這個|那個|這些|那些|這篇|那篇|第[一二三四五六七八九十\d]+|上面|剛剛|剛才|前面|"
+    r"\b(?:it|its|they|them|this|that|these|those|first|second|third|above|previous|one)\b",
+    re.IGNORECASE,
+)
+FOLLOWUP_STOPWORDS = set(
+    (
+        "what about the and or of to in on for is are was how why when where which who does do "
+        "did can could more tell me again also else one first second third it its they them this "
+        "that these those above previous with without between compared compare than from by "
+        "any some other there here like vs an"
+    ).split()
+)
+FOLLOWUP_FUNCTION_CHARS = set(
+    "的了呢嗎吧啊呀是在有和與及或這那哪個些它他她們什麼怎麼如何為第一二三四五六七八九十還也再又說"
+)
+# 每個問題的時間上限（秒）；未設定則不限。接近期限時略過評分、重寫，甚至不生成
+QUERY_DEADLINE = float(os.environ.get("RAG_QUERY_DEADLINE") or 0) or None
+# 各步驟預留的時間（秒）：剩餘時間不夠時改走捷徑，並記錄在結果的 shortcuts
+DEADLINE_GENERATE_SECONDS = 4.0
+DEADLINE_GRADE_SECONDS = 1.5
+DEADLINE_REWRITE_SECONDS = 3.0  # 重寫 + 再檢索 + 再評分一輪
+DEADLINE_PASSAGES_NOTE = "（時間不足，未生成回答；以下是最相關的段落）\n\n"
+CONTEXT_TOKEN_BUDGET = 3000  # 生成時檢索內容的 token 上限
+# 生成模型路由：單一事實 / 找檔名的問題且檢索內容小時改用 lite 模型生成；
+# 經過評分且相關文件多（需要綜合多份筆記）時仍用 main
+LITE_GENERATE_ROUTES = ("vector", "keyword")
+LITE_GENERATE_MAX_CONTEXT_TOKENS = CONTEXT_TOKEN_BUDGET // 2
+LITE_GENERATE_MAX_RELEVANT_DOCS = 3
+SENTENCE_SIMHASH_MIN_TOKENS = 8  # 句子夠長才做 SimHash 近似比對，短句只比對正規化後是否相同
 
 
 class AgentState(TypedDict):
@@ -36,6 +119,22 @@ class AgentState(TypedDict):
     generation: str | None
     retry_count: int
     grade_decision: str | None
+    context_stats: dict[str, int] | None
+    followup: str | None
+    source_stats: dict[str, Any] | None
+    deadline: float | None  # epoch 秒（session 狀態會存進 checkpoint，不能用 monotonic）
+    shortcuts: list[str]
+    generation_model: str | None  # lite / main
+
+
+class GradeThresholds(TypedDict):
+    """免 LLM 評分的距離門檻"""
+
+    relevant: float
+    irrelevant: float
+    samples: NotRequired[int]
+    skip_rate: NotRequired[float]
+    calibrated_at: NotRequired[str]
 
 
 class RelevanceGrade(BaseModel):
@@ -50,6 +149,12 @@ class RewrittenQuery(BaseModel):
     query: str = Field(description="重寫後的搜尋查詢")
 
 
+class FanoutQueries(BaseModel):
+    """多個角度的改寫查詢"""
+
+    queries: list[str] = Field(description="彼此不同的搜尋查詢")
+
+
 def _check_api_key() -> None:
     """檢查 API key"""
     if not os.environ.get("GOOGLE_API_KEY"):
@@ -62,6 +167,7 @@ def get_lite_llm() -> ChatGoogleGenerativeAI:
     return ChatGoogleGenerativeAI(
         model="gemini-2.5-flash-lite",
         temperature=0,
+        cache=get_llm_cache("agentic_rag"),
     )
 
 
@@ -71,260 +177,1486 @@ def get_main_llm() -> ChatGoogleGenerativeAI:
     return ChatGoogleGenerativeAI(
         model="gemini-2.5-flash",
         temperature=0,
+        cache=get_llm_cache("agentic_rag"),
     )
 
 
-def create_rag_graph(
-    vault_path: str | Path, max_retries: int = MAX_RETRIES
-) -> CompiledStateGraph[AgentState]:
-    """建立 Agentic RAG 圖
-
-    使用混合模型策略：
-    - lite_llm (gemini-2.5-flash-lite): grading 等簡單任務
-    - main_llm (gemini-2.5-flash): rewrite、generate 等複雜任務
-    """
-
-    rag = ObsidianRAG(vault_path)
-    lite_llm = get_lite_llm()
-    main_llm = get_main_llm()
-
-    # Grader prompt (uses lite_llm)
-    grade_prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """你是一個評估文件相關性的評分員。
+# Grader prompt (uses lite_llm)
+GRADE_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """你是一個評估文件相關性的評分員。
 判斷檢索到的文件是否與使用者問題相關。
 如果文件包含與問題相關的關鍵字或語意，就評為相關。
 只回答 'yes' 或 'no'。""",
-            ),
-            (
-                "human",
-                "文件內容:\n{document}\n\n問題: {question}",
-            ),
-        ]
-    )
-    grader_chain = grade_prompt | lite_llm.with_structured_output(RelevanceGrade)
-
-    # Rewriter prompt (uses main_llm)
-    rewrite_prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """你是一個查詢重寫專家。
+        ),
+        (
+            "human",
+            "文件內容:\n{document}\n\n問題: {question}",
+        ),
+    ]
+)
+
+# Rewriter prompt (uses main_llm)
+REWRITE_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """你是一個查詢重寫專家。
 將使用者的問題改寫成更適合語意搜尋的查詢。
 保持原意，但使用更精確的關鍵字。
 直接輸出重寫後的查詢，不要加任何前綴。""",
-            ),
-            (
-                "human",
-                "原始問題: {question}\n\n請重寫這個查詢以改善檢索效果:",
-            ),
-        ]
-    )
-    rewriter_chain = rewrite_prompt | main_llm.with_structured_output(RewrittenQuery)
-
-    # Generator prompt (uses main_llm)
-    generate_prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """你是一個知識庫助手，根據檢索到的文件回答問題。
+        ),
+        (
+            "human",
+            "原始問題: {question}\n\n請重寫這個查詢以改善檢索效果:",
+        ),
+    ]
+)
+
+# Fan-out prompt (uses main_llm)
+FANOUT_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """你是一個查詢重寫專家。
+將使用者的問題改寫成 {count} 個適合語意搜尋的查詢。
+每個查詢保持原意，但從不同角度切入：同義詞、更具體的關鍵字、更廣的主題。
+查詢之間不要重複。""",
+        ),
+        (
+            "human",
+            "原始問題: {question}",
+        ),
+    ]
+)
+
+# Generator prompt (uses main_llm)
+GENERATE_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """你是一個知識庫助手，根據檢索到的文件回答問題。
 只使用提供的文件內容來回答，不要編造資訊。
 如果文件中沒有相關資訊，請誠實說明。
 回答要簡潔、有重點。
 在回答最後列出參考的檔案路徑。""",
-            ),
-            (
-                "human",
-                "問題: {question}\n\n檢索到的文件:\n{context}",
-            ),
+        ),
+        (
+            "human",
+            "{history}問題: {question}\n\n檢索到的文件:\n{context}",
+        ),
+    ]
+)
+
+# Direct prompt (uses lite_llm)：不需要檢索的閒聊與指令
+DIRECT_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """你是一個知識庫助手。這個訊息不需要查詢知識庫。
+簡短、自然地回應。
+如果是你無法執行的指令（例如設定提醒），說明你只能查詢與整理知識庫內容。""",
+        ),
+        ("human", "{question}"),
+    ]
+)
+
+
+def new_entities(question: str, known_text: str) -> list[str]:
+    """問題中不在已知內容（先前的文件與問題）裡的關鍵字，略過常見詞與功能字"""
+    known = known_text.lower()
+    return [
+        term
+        for term in extract_keywords(question)
+        if term.lower() not in FOLLOWUP_STOPWORDS
+        and not FOLLOWUP_FUNCTION_CHARS.intersection(term)
+        and term.lower() not in known
+    ]
+
+
+def _to_documents(results: list[dict[str, Any]]) -> list[Document]:
+    return [
+        Document(
+            page_content=r["chunk"],
+            metadata={
+                "file_path": r["file_path"],
+                "chunk_index": r.get("chunk_index"),
+                "distance": r["distance"],
+                # 關鍵字搜尋的 distance 不是 cosine distance，不能套用距離門檻
+                "degraded": r.get("degraded", False),
+                "source": r.get("source", "vault"),
+            },
+        )
+        for r in results
+    ]
+
+
+def _split_sentences(text: str) -> list[str]:
+    return [s for s in re.split(r"(?<=[。！？.!?])\s*|\n+", text) if s.strip()]
+
+
+def build_context(
+    documents: list[Document], budget: int = CONTEXT_TOKEN_BUDGET
+) -> tuple[str, dict[str, int]]:
+    """將檢索文件壓縮成生成用的 context
+
+    1. 合併同檔案相鄰的 chunks（保留排名順序）
+    2. 移除已出現過的重複或近似重複句子
+    3. 依排名放入段落直到 token 上限；放不下的段落截到句子邊界
+    每段保留 [n] 來源標記，回傳 (context, 統計)。
+    """
+    results = [
+        {
+            "file_path": doc.metadata.get("file_path", "unknown"),
+            "chunk_index": doc.metadata.get("chunk_index"),
+            "chunk": doc.page_content,
+            "distance": doc.metadata.get("distance"),
+        }
+        for doc in documents
+    ]
+    passages = merge_adjacent_chunks(results, len(results))
+
+    seen = DuplicateIndex()
+    parts: list[str] = []
+    used = dropped = 0
+    for passage in passages:
+        sentences: list[str] = []
+        for sentence in _split_sentences(passage["chunk"]):
+            digest, fingerprint = content_hash(sentence), simhash(sentence)
+            long_enough = estimate_tokens(sentence) >= SENTENCE_SIMHASH_MIN_TOKENS
+            if digest in seen.by_hash or (long_enough and seen.find(digest, fingerprint)):
+                dropped += 1
+                continue
+            seen.add(f"{len(parts)}:{len(sentences)}", digest, fingerprint)
+            sentences.append(sentence)
+        if not sentences:
+            continue
+
+        header = f"[{len(parts) + 1}] 來源: {passage['file_path']}\n"
+        remaining = budget - used - estimate_tokens(header)
+        kept: list[str] = []
+        for sentence in sentences:
+            cost = estimate_tokens(sentence)
+            if cost > remaining:
+                break
+            kept.append(sentence)
+            remaining -= cost
+        if not kept:
+            break
+        parts.append(header + "\n".join(kept))
+        used = budget - remaining
+        if len(kept) < len(sentences):
+            break
+
+    return "\n\n---\n\n".join(parts), {
+        "passages": len(parts),
+        "dropped_sentences": dropped,
+        "raw_tokens": sum(estimate_tokens(doc.page_content) for doc in documents),
+        "context_tokens": used,
+    }
+
+
+def calibrate_thresholds(
+    samples: list[tuple[float, bool]], precision: float = CALIBRATION_PRECISION
+) -> GradeThresholds:
+    """由 (distance, 是否相關) 標註樣本計算距離門檻
+
+    relevant: 距離不超過此值的樣本中，相關比例 >= precision 的最大距離
+    irrelevant: 距離不小於此值的樣本中，不相關比例 >= precision 的最小距離
+    """
+    if len(samples) < CALIBRATION_MIN_SAMPLES:
+        raise ValueError(f"標註樣本不足: {len(samples)} < {CALIBRATION_MIN_SAMPLES}")
+    ordered = sorted(samples)
+
+    relevant = 0.0
+    hits = 0
+    for i, (distance, is_relevant) in enumerate(ordered, 1):
+        hits += is_relevant
+        if hits / i >= precision:
+            relevant = distance
+
+    irrelevant = 2.0  # cosine distance 上限，等於停用
+    misses = 0
+    for i, (distance, is_relevant) in enumerate(reversed(ordered), 1):
+        misses += not is_relevant
+        if misses / i >= precision:
+            irrelevant = distance
+
+    if relevant >= irrelevant:
+        raise ValueError(f"相關與不相關樣本的距離重疊 ({relevant:.4f} >= {irrelevant:.4f})")
+
+    skipped = sum(d <= relevant or d >= irrelevant for d, _ in samples)
+    return {
+        "relevant": round(relevant, 4),
+        "irrelevant": round(irrelevant, 4),
+        "samples": len(samples),
+        "skip_rate": round(skipped / len(samples), 4),
+        "calibrated_at": datetime.now(tz=UTC).isoformat(),
+    }
+
+
+class EmbeddingBatcher:
+    """非同步查詢共用的 embedding 批次器
+
+    同一時間窗內（以及上一批進行中時）送來的查詢合併成一次 embed_queries 呼叫，
+    結果照樣寫入 ObsidianRAG 的查詢向量快取。
+    """
+
+    def __init__(
+        self,
+        rag: ObsidianRAG,
+        window: float = EMBED_BATCH_WINDOW,
+        timeout: float | None = SEARCH_TIMEOUT,
+    ):
+        self.rag = rag
+        self.window = window
+        self.timeout = timeout
+        self.batches = 0
+        self.queries = 0
+        self._pending: list[tuple[str, asyncio.Future[np.ndarray | None]]] = []
+        self._worker: asyncio.Task[None] | None = None
+
+    async def embed(self, query: str) -> np.ndarray | None:
+        """取得查詢向量；逾時或 API 失敗時回傳 None"""
+        future: asyncio.Future[np.ndarray | None] = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.window)
+            batch, self._pending = self._pending, []
+            try:
+                vectors = await asyncio.to_thread(
+                    self.rag.embed_queries, [q for q, _ in batch], self.timeout
+                )
+            except Exception as e:
+                print(f"  [embed] 批次 embedding 失敗: {e}", file=sys.stderr)
+                vectors = None
+            self.batches += 1
+            self.queries += len(batch)
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(None if vectors is None else vectors[i])
+
+
+def _format_history(messages: list[BaseMessage]) -> str:
+    """session 的前幾則對話（沒有時為空字串）"""
+    lines = [
+        f"{'使用者' if isinstance(m, HumanMessage) else '助手'}: {m.content}"
+        for m in messages[-SESSION_HISTORY_MESSAGES:]
+    ]
+    return "對話紀錄:\n" + "\n".join(lines) + "\n\n" if lines else ""
+
+
+NOT_FOUND_ANSWER = "抱歉，在知識庫中找不到相關資訊。"
+
+
+def _not_found() -> dict[str, Any]:
+    """找不到文件時的回應
+
+    每次都建立新的 AIMessage：add_messages 會為訊息指定 id，共用同一個物件時
+    同一 session 的第二次回應會取代第一次。
+    """
+    return {"generation": NOT_FOUND_ANSWER, "messages": [AIMessage(content=NOT_FOUND_ANSWER)]}
+
+
+class AgenticRAG:
+    """可重複使用的 Agentic RAG
+
+    圖只編譯一次；ObsidianRAG 與 LLM clients 在第一次用到時才建立，
+    所以單純打招呼的問題不需要開啟向量庫或建立 Gemini client。
+
+    起始路徑由本地 QueryRouter 決定（direct / keyword / vector / agentic），
+    便宜的問題不必走完整的 retrieve → grade 迴圈。
+
+    使用混合模型策略：
+    - lite_llm (gemini-2.5-flash-lite): grading 等簡單任務
+    - main_llm (gemini-2.5-flash): rewrite、generate 等複雜任務
+    - model_routing: 單一事實的簡單問題且檢索內容小時，generate 也改用 lite_llm
+
+    rerank: retrieve 多取候選，以本地 cross-encoder 重新排序（需要 sentence-transformers）
+
+    檢索模式（retrieval）：
+    - loop: retrieve → grade → rewrite → retrieve，最多重試 max_retries 次
+    - fanout: 一次 LLM 呼叫產生多個改寫查詢，與原問題一起批次檢索後以 RRF 合併；
+      已涵蓋改寫的效果，不再重試
+    - federated: 同 loop，但每次檢索同時查詢 vault、短期記憶與對話歷史（federated_rag）
+    """
+
+    def __init__(
+        self,
+        vault_path: str | Path = DEFAULT_VAULT_PATH,
+        max_retries: int = MAX_RETRIES,
+        rag: ObsidianRAG | None = None,
+        lite_llm: BaseChatModel | None = None,
+        main_llm: BaseChatModel | None = None,
+        use_cache: bool = True,
+        retrieval: str = "loop",
+        grade_thresholds: GradeThresholds | None = None,
+        context_budget: int = CONTEXT_TOKEN_BUDGET,
+        router: QueryRouter | None = None,
+        sources: list[Source] | None = None,
+        deadline: float | None = QUERY_DEADLINE,
+        model_routing: bool = True,
+        rerank: bool = RERANK_ENABLED,
+        reranker: CrossEncoderReranker | None = None,
+    ):
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"未知的檢索模式: {retrieval}")
+        self.vault_path = Path(vault_path)
+        self.retrieval = retrieval
+        self.max_retries = 0 if retrieval == "fanout" else max_retries
+        self.use_cache = use_cache
+        self.context_budget = context_budget
+        self.deadline = deadline  # 每個問題的時間上限（秒），None 為不限
+        self.model_routing = model_routing  # False 時一律用 main_llm 生成
+        self.rerank = rerank or reranker is not None
+        self._reranker = reranker
+        self._rag = rag
+        self._answer_cache: AnswerCache | None = None
+        self._lite_llm = lite_llm
+        self._main_llm = main_llm
+        self._grader_chain: Runnable[dict[str, Any], Any] | None = None
+        self._rewriter_chain: Runnable[dict[str, Any], Any] | None = None
+        self._fanout_chain: Runnable[dict[str, Any], Any] | None = None
+        self._grade_thresholds = grade_thresholds
+        self._router = router
+        self._sources = sources
+        self._embedding_batcher: EmbeddingBatcher | None = None
+        self._graph: CompiledStateGraph[AgentState] | None = None
+        self._session_graph: CompiledStateGraph[AgentState] | None = None
+
+    # === Lazy components ===
+
+    @property
+    def rag(self) -> ObsidianRAG:
+        if self._rag is None:
+            self._rag = ObsidianRAG(self.vault_path)
+        return self._rag
+
+    @property
+    def answer_cache(self) -> AnswerCache:
+        if self._answer_cache is None:
+            self._answer_cache = AnswerCache(self.rag)
+        return self._answer_cache
+
+    @property
+    def embedding_batcher(self) -> EmbeddingBatcher:
+        if self._embedding_batcher is None:
+            self._embedding_batcher = EmbeddingBatcher(self.rag)
+        return self._embedding_batcher
+
+    @property
+    def grade_thresholds(self) -> GradeThresholds:
+        """校準過的距離門檻（存在向量庫旁），沒有則用預設值"""
+        if self._grade_thresholds is None:
+            path = self.rag._state_path(GRADE_THRESHOLDS_FILE)
+            if path.exists():
+                self._grade_thresholds = json.loads(path.read_text(encoding="utf-8"))
+            else:
+                self._grade_thresholds = {
+                    "relevant": GRADE_RELEVANT_DISTANCE,
+                    "irrelevant": GRADE_IRRELEVANT_DISTANCE,
+                }
+        return self._grade_thresholds
+
+    @property
+    def sources(self) -> list[Source]:
+        """federated 檢索的來源（預設為 vault + bot API 的 memory / history）"""
+        if self._sources is None:
+            self._sources = default_sources(self.rag)
+        return self._sources
+
+    @property
+    def router(self) -> QueryRouter:
+        if self._router is None:
+            self._router = QueryRouter.load()
+        return self._router
+
+    @property
+    def reranker(self) -> CrossEncoderReranker | None:
+        """cross-encoder 重排序；未啟用或未安裝 sentence-transformers 時為 None"""
+        if self._reranker is None and self.rerank:
+            if not rerank_available():
+                print("  [rerank] 未安裝 sentence-transformers，略過重排序", file=sys.stderr)
+                self.rerank = False
+                return None
+            self._reranker = CrossEncoderReranker(
+                cache_path=self.rag._state_path(RERANK_CACHE_FILE)
+            )
+        return self._reranker
+
+    @property
+    def lite_llm(self) -> BaseChatModel:
+        if self._lite_llm is None:
+            self._lite_llm = get_lite_llm()
+        return self._lite_llm
+
+    @property
+    def main_llm(self) -> BaseChatModel:
+        if self._main_llm is None:
+            self._main_llm = get_main_llm()
+        return self._main_llm
+
+    @property
+    def grader_chain(self) -> Runnable[dict[str, Any], Any]:
+        if self._grader_chain is None:
+            self._grader_chain = GRADE_PROMPT | self.lite_llm.with_structured_output(RelevanceGrade)
+        return self._grader_chain
+
+    @property
+    def rewriter_chain(self) -> Runnable[dict[str, Any], Any]:
+        if self._rewriter_chain is None:
+            self._rewriter_chain = REWRITE_PROMPT | self.main_llm.with_structured_output(
+                RewrittenQuery
+            )
+        return self._rewriter_chain
+
+    @property
+    def fanout_chain(self) -> Runnable[dict[str, Any], Any]:
+        if self._fanout_chain is None:
+            self._fanout_chain = FANOUT_PROMPT | self.main_llm.with_structured_output(FanoutQueries)
+        return self._fanout_chain
+
+    @property
+    def graph(self) -> CompiledStateGraph[AgentState]:
+        if self._graph is None:
+            self._graph = self._build_graph()
+        return self._graph
+
+    @property
+    def session_graph(self) -> CompiledStateGraph[AgentState]:
+        """帶 SQLite checkpointer 的圖；以 session id 作為 thread_id 保存對話狀態"""
+        if self._session_graph is None:
+            conn = sqlite3.connect(self.rag._state_path(SESSION_DB_FILE), check_same_thread=False)
+            self._session_graph = self._build_graph(SqliteSaver(conn))
+        return self._session_graph
+
+    # === Deadline ===
+
+    def _out_of_time(self, state: AgentState, reserve: float) -> bool:
+        """剩餘時間是否不足 reserve 秒"""
+        deadline = state.get("deadline")
+        return deadline is not None and deadline - time.time() < reserve
+
+    def _shortcut(self, state: AgentState, name: str) -> list[str]:
+        print(f"  [deadline] 接近期限，{name}", file=sys.stderr)
+        return [*(state.get("shortcuts") or []), name]
+
+    # === Node functions ===
+
+    def route_question(
+        self, state: AgentState
+    ) -> Literal["retrieve", "search", "keyword", "direct", "followup"]:
+        """以本地 QueryRouter 選擇路徑；session 中已有文件且需要檢索時交給 followup 判斷能否沿用
+
+        - direct: 不檢索直接回應
+        - keyword: 本地關鍵字搜尋後直接生成
+        - search: 向量檢索一次後直接生成（不評分、不重寫）
+        - retrieve: 完整的 agentic 迴圈
+        """
+        route = ROUTE_NODES[self.router.route(state["question"])]
+        # 「謝謝」之類的閒聊即使在 session 中也直接回應，不走 followup 的檢索
+        if route != "direct" and state.get("documents"):
+            return "followup"
+        return route  # type: ignore[return-value]
+
+    def followup(self, state: AgentState) -> dict[str, Any]:
+        """session 追問：沿用上一輪的文件，只為新出現的實體補檢索
+
+        - reuse: 問題沒有新的關鍵字，且指涉前文或上一輪的文件仍是新問題的檢索結果，
+          直接用上一輪的文件生成
+        - incremental: 指涉前文或部分關鍵字已知，只以新關鍵字檢索並併入
+        - fresh: 換了話題，重新檢索
+        """
+        question = state["question"]
+        previous = state["documents"]
+        asked = [str(m.content) for m in state["messages"][:-1] if isinstance(m, HumanMessage)]
+        known_text = " ".join([doc.page_content for doc in previous] + asked)
+
+        new_terms = new_entities(question, known_text)
+        all_terms = new_entities(question, "")
+        # 上一輪已評分為相關的文件，不再經過 LLM 評分
+        kept = [
+            Document(page_content=doc.page_content, metadata={**doc.metadata, "relevant": True})
+            for doc in previous
         ]
-    )
 
-    # Node functions
-    def route_question(state: AgentState) -> Literal["retrieve", "direct"]:
-        """判斷是否需要檢索"""
-        question = state["question"].lower()
+        refers_back = FOLLOWUP_PATTERN.search(question) is not None
+        # 關鍵字只是剛好出現在舊文件裡不代表同一話題，沒有指涉前文時要確認舊文件仍然相關
+        if not new_terms and (refers_back or self._still_relevant(question, kept)):
+            print(f"  [followup] 沿用 {len(kept)} 個文件", file=sys.stderr)
+            return {"followup": "reuse", "documents": kept, "grade_decision": "generate"}
+
+        if new_terms and (refers_back or len(new_terms) < len(all_terms)):
+            query = " ".join(new_terms)
+            print(f"  [followup] 補檢索新關鍵字: {query}", file=sys.stderr)
+            seen = {(d.metadata.get("file_path"), d.metadata.get("chunk_index")) for d in kept}
+            added = [
+                doc
+                for doc in _to_documents(self.rag.search(query, top_k=5))
+                if (doc.metadata["file_path"], doc.metadata["chunk_index"]) not in seen
+            ]
+            return {"followup": "incremental", "documents": kept + added}
+
+        print("  [followup] 新話題，重新檢索", file=sys.stderr)
+        return {"followup": "fresh", "documents": []}
+
+    def _still_relevant(self, question: str, documents: list[Document]) -> bool:
+        """上一輪的文件是否仍在新問題的檢索結果中，且 cosine distance 未達不相關門檻"""
+        kept = {(d.metadata.get("file_path"), d.metadata.get("chunk_index")) for d in documents}
+        return any(
+            (r["file_path"], r.get("chunk_index")) in kept
+            and not r.get("degraded")
+            and r["distance"] < self.grade_thresholds["irrelevant"]
+            for r in self.rag.search(question, top_k=5)
+        )
+
+    async def afollowup(self, state: AgentState) -> dict[str, Any]:
+        """followup 的非同步版本（只有補檢索會用到 I/O）"""
+        return await asyncio.to_thread(self.followup, state)
+
+    def _rerank(self, state: AgentState, results: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """以原問題重排序多取的候選（grade 也以原問題評分），取前 5 個"""
+        reranker = self.reranker
+        if reranker is None:
+            return results[:5]
+        return reranker.rerank(state["question"], results, top_k=5)
+
+    def retrieve(self, state: AgentState) -> dict[str, Any]:
+        """從向量庫檢索文件（啟用重排序時多取候選再以 cross-encoder 排序）"""
+        query = state.get("rewritten_query") or state["question"]
+        print(f"  [retrieve] 查詢: {query}", file=sys.stderr)
 
-        greetings = ["你好", "嗨", "哈囉", "hello", "hi", "hey"]
-        if any(g in question for g in greetings) and len(question) < 20:
-            return "direct"
+        fetch_k = RERANK_CANDIDATES if self.reranker else 5
+        documents = _to_documents(self._rerank(state, self.rag.search(query, top_k=fetch_k)))
 
-        return "retrieve"
+        print(f"  [retrieve] 找到 {len(documents)} 個文件", file=sys.stderr)
+        return {"documents": documents}
 
-    def retrieve(state: AgentState) -> dict[str, Any]:
-        """從向量庫檢索文件"""
+    async def aretrieve(self, state: AgentState) -> dict[str, Any]:
+        """retrieve 的非同步版本：查詢 embedding 與其他並行查詢合併成一批"""
         query = state.get("rewritten_query") or state["question"]
         print(f"  [retrieve] 查詢: {query}", file=sys.stderr)
 
-        results = rag.search(query, top_k=5)
+        fetch_k = RERANK_CANDIDATES if self.reranker else 5
+        query_vec = await self.embedding_batcher.embed(query)
+        if query_vec is None:
+            results = await asyncio.to_thread(self.rag.keyword_search, query, fetch_k)
+            for r in results:
+                r["degraded"] = True
+        else:
+            results = await asyncio.to_thread(self.rag.search_vector, query_vec, fetch_k)
+        documents = _to_documents(await asyncio.to_thread(self._rerank, state, results))
 
-        documents = [
-            Document(
-                page_content=r["chunk"],
-                metadata={"file_path": r["file_path"], "distance": r["distance"]},
-            )
-            for r in results
-        ]
+        print(f"  [retrieve] 找到 {len(documents)} 個文件", file=sys.stderr)
+        return {"documents": documents}
 
+    def _federated_result(
+        self, results: list[dict[str, Any]], reports: dict[str, Any]
+    ) -> dict[str, Any]:
+        summary = ", ".join(f"{name} {r['status']} {r['count']}" for name, r in reports.items())
+        print(f"  [retrieve] 來源: {summary}", file=sys.stderr)
+        documents = _to_documents(results)
         print(f"  [retrieve] 找到 {len(documents)} 個文件", file=sys.stderr)
+        return {"documents": documents, "source_stats": reports}
+
+    def federated_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """同時查詢所有來源（各自逾時），正規化分數後合併"""
+        query = state.get("rewritten_query") or state["question"]
+        print(f"  [retrieve] 查詢: {query}", file=sys.stderr)
+        return self._federated_result(*federated_search(self.sources, query, top_k=5))
+
+    async def afederated_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """federated_retrieve 的非同步版本"""
+        query = state.get("rewritten_query") or state["question"]
+        print(f"  [retrieve] 查詢: {query}", file=sys.stderr)
+        return self._federated_result(*await afederated_search(self.sources, query, top_k=5))
+
+    def keyword_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """本地關鍵字搜尋（不需要 embedding）"""
+        question = state["question"]
+        print(f"  [keyword] 查詢: {question}", file=sys.stderr)
+
+        results = self.rag.keyword_search(question, 5)
+        for r in results:
+            r["degraded"] = True  # distance 是未命中關鍵字的比例，不是 cosine distance
+        documents = _to_documents(results)
+
+        print(f"  [keyword] 找到 {len(documents)} 個文件", file=sys.stderr)
         return {"documents": documents}
 
-    def grade_documents(state: AgentState) -> dict[str, str]:
-        """評估文件相關性"""
-        documents = state["documents"]
+    async def akeyword_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """keyword_retrieve 的非同步版本"""
+        return await asyncio.to_thread(self.keyword_retrieve, state)
+
+    def _fanout_queries(self, question: str, result: Any) -> list[str]:
+        if isinstance(result, Exception):
+            print(f"  [retrieve] 改寫查詢失敗，只用原問題: {result}", file=sys.stderr)
+            rewrites: list[str] = []
+        else:
+            # Handle both dict and Pydantic model responses
+            rewrites = result.queries if isinstance(result, FanoutQueries) else result["queries"]
+
+        queries = list(dict.fromkeys([question, *(q.strip() for q in rewrites if q.strip())]))
+        queries = queries[: FANOUT_QUERIES + 1]
+        print(f"  [retrieve] 查詢 ({len(queries)}): {' | '.join(queries)}", file=sys.stderr)
+        return queries
+
+    def _skip_fanout(self, state: AgentState) -> dict[str, Any]:
+        """剩餘時間不夠改寫查詢時，只用原問題檢索"""
+        if not self._out_of_time(
+            state, DEADLINE_REWRITE_SECONDS + DEADLINE_GRADE_SECONDS + DEADLINE_GENERATE_SECONDS
+        ):
+            return {}
+        return {"shortcuts": self._shortcut(state, "skip_fanout")}
+
+    def fanout_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """一次產生多個改寫查詢，與原問題一起批次檢索並以 RRF 合併"""
         question = state["question"]
+        skipped = self._skip_fanout(state)
+        try:
+            result = (
+                FanoutQueries(queries=[])
+                if skipped
+                else self.fanout_chain.invoke({"question": question, "count": FANOUT_QUERIES})
+            )
+        except Exception as e:
+            result = e
+        queries = self._fanout_queries(question, result)
+
+        documents = _to_documents(self.rag.search_multi(queries, top_k=5))
+
+        print(f"  [retrieve] 找到 {len(documents)} 個文件", file=sys.stderr)
+        return {"documents": documents, **skipped}
+
+    async def afanout_retrieve(self, state: AgentState) -> dict[str, Any]:
+        """fanout_retrieve 的非同步版本"""
+        question = state["question"]
+        skipped = self._skip_fanout(state)
+        try:
+            result = (
+                FanoutQueries(queries=[])
+                if skipped
+                else await self.fanout_chain.ainvoke(
+                    {"question": question, "count": FANOUT_QUERIES}
+                )
+            )
+        except Exception as e:
+            result = e
+        queries = self._fanout_queries(question, result)
+
+        query_vecs = await asyncio.gather(*(self.embedding_batcher.embed(q) for q in queries))
+        if any(v is None for v in query_vecs):
+            results = await asyncio.to_thread(self.rag.keyword_search, question, 5)
+            for r in results:
+                r["degraded"] = True
+        else:
+            rankings = await asyncio.to_thread(
+                self.rag.search_vectors, list(query_vecs), 5 * SEARCH_FETCH_MULTIPLIER
+            )
+            results = reciprocal_rank_fusion(rankings, 5)
+        documents = _to_documents(results)
+
+        print(f"  [retrieve] 找到 {len(documents)} 個文件", file=sys.stderr)
+        return {"documents": documents, **skipped}
+
+    def _distance_verdict(self, doc: Document) -> bool | None:
+        """依距離門檻判斷相關性；落在中間區段回傳 None"""
+        if doc.metadata.get("relevant"):
+            return True
+        distance = doc.metadata.get("distance")
+        if distance is None or doc.metadata.get("degraded"):
+            return None
+        if distance <= self.grade_thresholds["relevant"]:
+            return True
+        if distance >= self.grade_thresholds["irrelevant"]:
+            return False
+        return None
+
+    def _grade_prepare(
+        self, state: AgentState
+    ) -> tuple[list[bool | None], list[Document], list[str]]:
+        """距離門檻先判斷，回傳 (各文件判定, 需要 LLM 評分的文件, 已走的捷徑)
+
+        接近期限時不呼叫 LLM 評分，中間區段的文件都保留給生成階段。
+        """
+        documents = state["documents"]
+        shortcuts = state.get("shortcuts") or []
+        if not documents:
+            return [], [], shortcuts
+        verdicts = [self._distance_verdict(doc) for doc in documents]
+        ambiguous = [doc for doc, v in zip(documents, verdicts, strict=True) if v is None]
+        if ambiguous and verdicts.count(True) < MIN_RELEVANT_DOCS:
+            if self._out_of_time(state, DEADLINE_GRADE_SECONDS + DEADLINE_GENERATE_SECONDS):
+                return verdicts, [], self._shortcut(state, "skip_grade")
+            return verdicts, ambiguous, shortcuts
+        print(
+            f"  [grade] 距離門檻判定，略過 LLM 評分 ({len(ambiguous)} 個未評分)",
+            file=sys.stderr,
+        )
+        return verdicts, [], shortcuts
+
+    def _grade_decide(
+        self,
+        state: AgentState,
+        verdicts: list[bool | None],
+        results: list[Any],
+        shortcuts: list[str],
+    ) -> dict[str, Any]:
+        """合併 LLM 評分結果並決定下一步（剩餘時間不夠再跑一輪時不重寫）"""
+        documents = state["documents"]
         retry_count = state.get("retry_count", 0)
+        can_retry = retry_count < self.max_retries
+        if can_retry and self._out_of_time(
+            state, DEADLINE_REWRITE_SECONDS + DEADLINE_GENERATE_SECONDS
+        ):
+            can_retry = False
+            skip_rewrite = [*shortcuts, "skip_rewrite"]
+        else:
+            skip_rewrite = shortcuts
 
         if not documents:
-            if retry_count < max_retries:
+            if can_retry:
                 print("  [grade] 無文件，重寫查詢", file=sys.stderr)
-                return {"grade_decision": "rewrite"}
+                return {"grade_decision": "rewrite", "shortcuts": shortcuts}
             print("  [grade] 無文件，直接生成", file=sys.stderr)
-            return {"grade_decision": "generate"}
+            return {"grade_decision": "generate", "shortcuts": skip_rewrite}
+
+        graded = iter(results)
+        verdicts = [
+            v if v is not None else self._grade_verdict(next(graded, None)) for v in verdicts
+        ]
+
+        # 未評分（None）的文件保留，交給生成階段判斷
+        relevant = [doc for doc, v in zip(documents, verdicts, strict=True) if v is not False]
 
-        doc = documents[0]
-        result = grader_chain.invoke({"document": doc.page_content, "question": question})
+        print(f"  [grade] 相關文件 {len(relevant)}/{len(documents)}", file=sys.stderr)
 
+        if len(relevant) >= MIN_RELEVANT_DOCS:
+            print("  [grade] 進入生成", file=sys.stderr)
+            return {"grade_decision": "generate", "documents": relevant, "shortcuts": shortcuts}
+        elif can_retry:
+            print(
+                f"  [grade] 相關文件不足，重寫查詢 (retry {retry_count + 1}/{self.max_retries})",
+                file=sys.stderr,
+            )
+            return {"grade_decision": "rewrite", "shortcuts": shortcuts}
+        elif skip_rewrite is not shortcuts:
+            print("  [deadline] 接近期限，skip_rewrite：使用現有文件生成", file=sys.stderr)
+            return {"grade_decision": "generate", "shortcuts": skip_rewrite}
+        else:
+            print("  [grade] 達到重試上限，使用現有文件生成", file=sys.stderr)
+            return {"grade_decision": "generate", "shortcuts": shortcuts}
+
+    def grade_documents(self, state: AgentState) -> dict[str, Any]:
+        """評估文件相關性，過濾不相關文件
+
+        先用距離門檻判斷：已有足夠確定相關的文件就直接生成（保留中間區段的文件），
+        全部確定不相關就直接重寫；只有其餘情況才平行呼叫 LLM 評分中間區段的文件。
+        """
+        verdicts, ambiguous, shortcuts = self._grade_prepare(state)
+        results = (
+            self.grader_chain.batch(
+                [{"document": d.page_content, "question": state["question"]} for d in ambiguous],
+                config={"max_concurrency": GRADE_CONCURRENCY},
+                return_exceptions=True,
+            )
+            if ambiguous
+            else []
+        )
+        return self._grade_decide(state, verdicts, results, shortcuts)
+
+    async def agrade_documents(self, state: AgentState) -> dict[str, Any]:
+        """grade_documents 的非同步版本"""
+        verdicts, ambiguous, shortcuts = self._grade_prepare(state)
+        results = (
+            await self.grader_chain.abatch(
+                [{"document": d.page_content, "question": state["question"]} for d in ambiguous],
+                config={"max_concurrency": GRADE_CONCURRENCY},
+                return_exceptions=True,
+            )
+            if ambiguous
+            else []
+        )
+        return self._grade_decide(state, verdicts, results, shortcuts)
+
+    def _grade_verdict(self, result: Any) -> bool | None:
+        if result is None:
+            return None
+        if isinstance(result, Exception):
+            # 評分失敗時保留文件，交給生成階段判斷
+            print(f"  [grade] 評分失敗: {result}", file=sys.stderr)
+            return None
         # Handle both dict and Pydantic model responses
         if isinstance(result, RelevanceGrade):
             score = result.binary_score
         else:
-            score = result["binary_score"]  # type: ignore[index]
-
-        if score == "yes":
-            print("  [grade] 文件相關，進入生成", file=sys.stderr)
-            return {"grade_decision": "generate"}
-        elif retry_count < max_retries:
-            print(f"  [grade] 文件不相關，重寫查詢 (retry {retry_count + 1}/{max_retries})", file=sys.stderr)
-            return {"grade_decision": "rewrite"}
-        else:
-            print("  [grade] 達到重試上限，使用現有文件生成", file=sys.stderr)
-            return {"grade_decision": "generate"}
+            score = result["binary_score"]
+        return bool(score == "yes")
 
-    def rewrite_question(state: AgentState) -> dict[str, Any]:
+    def rewrite_question(self, state: AgentState) -> dict[str, Any]:
         """重寫查詢"""
-        question = state["question"]
-        retry_count = state.get("retry_count", 0)
+        return self._rewrite_result(
+            state, self.rewriter_chain.invoke({"question": state["question"]})
+        )
 
-        result = rewriter_chain.invoke({"question": question})
+    async def arewrite_question(self, state: AgentState) -> dict[str, Any]:
+        """rewrite_question 的非同步版本"""
+        result = await self.rewriter_chain.ainvoke({"question": state["question"]})
+        return self._rewrite_result(state, result)
+
+    def _rewrite_result(self, state: AgentState, result: Any) -> dict[str, Any]:
+        retry_count = state.get("retry_count", 0)
         # Handle both dict and Pydantic model responses
         if isinstance(result, RewrittenQuery):
             new_query = result.query
         else:
-            new_query = result["query"]  # type: ignore[index]
+            new_query = result["query"]
 
         print(f"  [rewrite] 新查詢: {new_query}", file=sys.stderr)
         return {"rewritten_query": new_query, "retry_count": retry_count + 1}
 
-    def generate_answer(state: AgentState) -> dict[str, Any]:
-        """生成答案"""
-        question = state["question"]
-        documents = state["documents"]
-
-        if not documents:
-            return {
-                "generation": "抱歉，在知識庫中找不到相關資訊。",
-                "messages": [AIMessage(content="抱歉，在知識庫中找不到相關資訊。")],
-            }
+    def _generation_prompt(self, state: AgentState) -> tuple[str, dict[str, int]]:
+        context, context_stats = build_context(state["documents"], self.context_budget)
+        prompt = GENERATE_PROMPT.format(
+            history=_format_history(state["messages"][:-1]),
+            question=state["question"],
+            context=context,
+        )
+        context_stats["prompt_tokens"] = estimate_tokens(prompt)
+        return prompt, context_stats
+
+    def _generation_model(
+        self, state: AgentState, context_stats: dict[str, int]
+    ) -> tuple[str, BaseChatModel]:
+        """依問題類型、檢索內容大小與評分為相關的文件數選擇生成模型，回傳 (lite / main, 模型)
+
+        重寫過查詢或 session 追問（prompt 帶對話歷史）的問題一律用 main_llm。
+        search / keyword 路徑不評分，只看問題類型與檢索內容大小。
+        """
+        if not self.model_routing or state.get("retry_count", 0) or len(state["messages"]) > 1:
+            return "main", self.main_llm
+        route, confidence = self.router.predict(state["question"])
+        relevant = len(state["documents"]) if state.get("grade_decision") else 0
+        if (
+            route in LITE_GENERATE_ROUTES
+            and confidence >= self.router.min_confidence
+            and context_stats["context_tokens"] <= LITE_GENERATE_MAX_CONTEXT_TOKENS
+            and relevant <= LITE_GENERATE_MAX_RELEVANT_DOCS
+        ):
+            return "lite", self.lite_llm
+        return "main", self.main_llm
+
+    def _generation_result(
+        self, answer: Any, context_stats: dict[str, int], model: str
+    ) -> dict[str, Any]:
+        print(
+            f"  [generate] 生成完成（{model}，prompt 約 {context_stats['prompt_tokens']} tokens，"
+            f"檢索內容 {context_stats['raw_tokens']} → {context_stats['context_tokens']}）",
+            file=sys.stderr,
+        )
+        return {
+            "generation": answer,
+            "messages": [AIMessage(content=str(answer))],
+            "context_stats": context_stats,
+            "generation_model": model,
+        }
 
-        context_parts = []
-        for i, doc in enumerate(documents, 1):
-            file_path = doc.metadata.get("file_path", "unknown")
-            context_parts.append(f"[{i}] 來源: {file_path}\n{doc.page_content}")
+    def _passages_result(self, state: AgentState) -> dict[str, Any] | None:
+        """剩餘時間不夠生成時，直接回傳檢索到的段落"""
+        if not self._out_of_time(state, DEADLINE_GENERATE_SECONDS):
+            return None
+        context, context_stats = build_context(state["documents"], self.context_budget)
+        answer = DEADLINE_PASSAGES_NOTE + context
+        return {
+            "generation": answer,
+            "messages": [AIMessage(content=answer)],
+            "context_stats": context_stats,
+            "shortcuts": self._shortcut(state, "skip_generate"),
+        }
 
-        context = "\n\n---\n\n".join(context_parts)
+    def generate_answer(self, state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+        """生成答案（串流模式下 LLM 輸出會以 token 事件送出）"""
+        if not state["documents"]:
+            return _not_found()
+        if passages := self._passages_result(state):
+            return passages
+        prompt, context_stats = self._generation_prompt(state)
+        model, llm = self._generation_model(state, context_stats)
+        response = llm.invoke(prompt, config)
+        return self._generation_result(response.content, context_stats, model)
+
+    async def agenerate_answer(self, state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+        """generate_answer 的非同步版本"""
+        if not state["documents"]:
+            return _not_found()
+        if passages := self._passages_result(state):
+            return passages
+        prompt, context_stats = self._generation_prompt(state)
+        model, llm = self._generation_model(state, context_stats)
+        response = await llm.ainvoke(prompt, config)
+        return self._generation_result(response.content, context_stats, model)
+
+    def _greeting(self, state: AgentState) -> dict[str, Any] | None:
+        """單純打招呼用固定回覆，不呼叫 LLM"""
+        question = state["question"].lower()
+        if not (any(g in question for g in GREETINGS) and len(question) < 20):
+            return None
+        return {
+            "generation": "你好！有什麼我可以幫你在知識庫中查找的嗎？",
+            "messages": [AIMessage(content="你好！有什麼我可以幫你在知識庫中查找的嗎？")],
+        }
 
-        response = main_llm.invoke(generate_prompt.format(question=question, context=context))
-        answer = response.content
+    def direct_response(self, state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+        """直接回應（不需要檢索）：打招呼用固定回覆，其餘交給 lite_llm"""
+        greeting = self._greeting(state)
+        if greeting is not None:
+            return greeting
+        response = self.lite_llm.invoke(DIRECT_PROMPT.format(question=state["question"]), config)
+        return {"generation": response.content, "messages": [AIMessage(content=response.content)]}
+
+    async def adirect_response(self, state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+        """direct_response 的非同步版本"""
+        greeting = self._greeting(state)
+        if greeting is not None:
+            return greeting
+        prompt = DIRECT_PROMPT.format(question=state["question"])
+        response = await self.lite_llm.ainvoke(prompt, config)
+        return {"generation": response.content, "messages": [AIMessage(content=response.content)]}
+
+    def _build_graph(
+        self, checkpointer: BaseCheckpointSaver[Any] | None = None
+    ) -> CompiledStateGraph[AgentState]:
+        workflow: StateGraph[AgentState] = StateGraph(AgentState)
+
+        # 每個節點同時提供同步與非同步版本：invoke 走同步、ainvoke 走非同步
+        if self.retrieval == "fanout":
+            retrieve = RunnableLambda(self.fanout_retrieve, afunc=self.afanout_retrieve)
+        elif self.retrieval == "federated":
+            retrieve = RunnableLambda(self.federated_retrieve, afunc=self.afederated_retrieve)
+        else:
+            retrieve = RunnableLambda(self.retrieve, afunc=self.aretrieve)
+        workflow.add_node("retrieve", retrieve)
+        workflow.add_node("search", RunnableLambda(self.retrieve, afunc=self.aretrieve))
+        workflow.add_node(
+            "keyword", RunnableLambda(self.keyword_retrieve, afunc=self.akeyword_retrieve)
+        )
+        workflow.add_node(
+            "grade", RunnableLambda(self.grade_documents, afunc=self.agrade_documents)
+        )
+        workflow.add_node(
+            "rewrite", RunnableLambda(self.rewrite_question, afunc=self.arewrite_question)
+        )
+        workflow.add_node(
+            "generate", RunnableLambda(self.generate_answer, afunc=self.agenerate_answer)
+        )
+        workflow.add_node(
+            "direct", RunnableLambda(self.direct_response, afunc=self.adirect_response)
+        )
+        workflow.add_node("followup", RunnableLambda(self.followup, afunc=self.afollowup))
+
+        workflow.add_conditional_edges(
+            START,
+            self.route_question,
+            {
+                "retrieve": "retrieve",
+                "search": "search",
+                "keyword": "keyword",
+                "direct": "direct",
+                "followup": "followup",
+            },
+        )
+        workflow.add_conditional_edges(
+            "followup",
+            lambda state: state["followup"],
+            {"reuse": "generate", "incremental": "grade", "fresh": "retrieve"},
+        )
+        workflow.add_edge("retrieve", "grade")
+        workflow.add_edge("search", "generate")
+        # 關鍵字沒有命中時改走完整的 agentic 迴圈
+        workflow.add_conditional_edges(
+            "keyword",
+            lambda state: "generate" if state["documents"] else "retrieve",
+            {"generate": "generate", "retrieve": "retrieve"},
+        )
+        workflow.add_conditional_edges(
+            "grade",
+            lambda state: state["grade_decision"],
+            {"generate": "generate", "rewrite": "rewrite"},
+        )
+        workflow.add_edge("rewrite", "retrieve")
+        workflow.add_edge("generate", END)
+        workflow.add_edge("direct", END)
+
+        return workflow.compile(checkpointer=checkpointer)  # type: ignore[return-value]
+
+    # === Public API ===
+
+    def initial_state(self, question: str) -> AgentState:
+        return {
+            "messages": [HumanMessage(content=question)],
+            "question": question,
+            "rewritten_query": None,
+            "documents": [],
+            "generation": None,
+            "retry_count": 0,
+            "grade_decision": None,
+            "context_stats": None,
+            "followup": None,
+            "source_stats": None,
+            "deadline": time.time() + self.deadline if self.deadline else None,
+            "shortcuts": [],
+            "generation_model": None,
+        }
 
-        print("  [generate] 生成完成", file=sys.stderr)
-        return {"generation": answer, "messages": [AIMessage(content=str(answer))]}
+    def session_input(self, question: str) -> dict[str, Any]:
+        """session 每一輪的輸入：documents 與 messages 沿用 checkpoint，其餘欄位重設"""
+        state: dict[str, Any] = dict(self.initial_state(question))
+        del state["documents"]
+        return state
+
+    def _session_state(self, session_id: str, question: str) -> tuple[dict[str, Any], Any]:
+        """回傳 (本輪開始時的完整狀態, graph config)"""
+        config = {"configurable": {"thread_id": session_id}}
+        previous = self.session_graph.get_state(config).values  # type: ignore[arg-type]
+        state = {**self.initial_state(question), **previous, **self.session_input(question)}
+        state["messages"] = [*previous.get("messages", []), *state["messages"][-1:]]
+        return state, config
+
+    def _session_result(
+        self, session_id: str, question: str, result: dict[str, Any]
+    ) -> dict[str, Any]:
+        formatted = self._finish(question, result, None)
+        formatted["session"] = {
+            "id": session_id,
+            "followup": result.get("followup"),
+            "turns": sum(isinstance(m, HumanMessage) for m in result.get("messages", [])),
+        }
+        return formatted
 
-    def direct_response(state: AgentState) -> dict[str, Any]:
-        """直接回應（不需要檢索）"""
+    def format_result(self, question: str, result: dict[str, Any]) -> dict[str, Any]:
         return {
-            "generation": "你好！有什麼我可以幫你在知識庫中查找的嗎？",
-            "messages": [AIMessage(content="你好！有什麼我可以幫你在知識庫中查找的嗎？")],
+            "question": question,
+            "answer": result.get("generation", ""),
+            "documents": [
+                {
+                    "file_path": d.metadata.get("file_path"),
+                    "distance": d.metadata.get("distance"),
+                    "source": d.metadata.get("source", "vault"),
+                }
+                for d in result.get("documents", [])
+            ],
+            "retry_count": result.get("retry_count", 0),
+            "context": result.get("context_stats"),
+            "sources": result.get("source_stats"),
+            "shortcuts": result.get("shortcuts") or [],
+            "model": result.get("generation_model"),
         }
 
-    # Build graph
-    workflow: StateGraph[AgentState] = StateGraph(AgentState)
+    def _lookup_cache(
+        self, question: str, route: str
+    ) -> tuple[np.ndarray | None, dict[str, Any] | None]:
+        """查語意答案快取，回傳 (問題向量, 命中結果)
+
+        問題向量會留在 ObsidianRAG 的查詢快取，未命中時 retrieve 不需要重新 embedding。
+        """
+        if not self.use_cache or route not in ("retrieve", "search"):
+            return None, None
+        query_vec = self.rag.embed_query(question, SEARCH_TIMEOUT)
+        if query_vec is None:
+            return None, None
+        return query_vec, self._cache_hit(question, self.answer_cache.lookup(query_vec))
+
+    async def _alookup_cache(
+        self, question: str, route: str
+    ) -> tuple[np.ndarray | None, dict[str, Any] | None]:
+        """_lookup_cache 的非同步版本（問題向量走共用的 embedding 批次）"""
+        if not self.use_cache or route not in ("retrieve", "search"):
+            return None, None
+        query_vec = await self.embedding_batcher.embed(question)
+        if query_vec is None:
+            return None, None
+        hit = await asyncio.to_thread(self.answer_cache.lookup, query_vec)
+        return query_vec, self._cache_hit(question, hit)
+
+    def _cache_hit(self, question: str, hit: dict[str, Any] | None) -> dict[str, Any] | None:
+        if hit is None:
+            return None
+        print(f"  [cache] 命中: {hit['question']}", file=sys.stderr)
+        # 與圖的執行結果同樣的欄位（model / shortcuts / sources 等），呼叫端不需要分開處理
+        formatted = self.format_result(question, {"generation": hit["answer"]})
+        formatted["documents"] = hit["documents"]
+        formatted["cache"] = {
+            "hit": True,
+            "similarity": hit["similarity"],
+            "hit_rate": hit["hit_rate"],
+        }
+        return formatted
+
+    def _finish(
+        self, question: str, result: dict[str, Any], query_vec: np.ndarray | None
+    ) -> dict[str, Any]:
+        """整理圖的執行結果，並寫入答案快取"""
+        formatted = self.format_result(question, result)
+        # 走過捷徑的答案不完整，不寫入快取
+        if query_vec is not None and formatted["documents"] and not formatted["shortcuts"]:
+            self.answer_cache.store(
+                query_vec, question, str(formatted["answer"]), formatted["documents"]
+            )
+        formatted["cache"] = {
+            "hit": False,
+            "hit_rate": self.answer_cache.hit_rate() if query_vec is not None else None,
+        }
+        return formatted
+
+    def query(self, question: str, session_id: str | None = None) -> dict[str, Any]:
+        """執行 Agentic RAG 查詢（需要檢索的問題先查語意答案快取）
+
+        session_id: 對話 session；狀態存在 SQLite checkpoint，追問可沿用上一輪的文件。
+        追問的意思依賴前文，session 模式不使用答案快取。
+        """
+        if session_id is not None:
+            result = self.session_graph.invoke(
+                self.session_input(question),  # type: ignore[arg-type]
+                {"configurable": {"thread_id": session_id}},
+            )
+            return self._session_result(session_id, question, result)
+
+        state = self.initial_state(question)
+        query_vec, hit = self._lookup_cache(question, self.route_question(state))
+        if hit is not None:
+            return hit
+        return self._finish(question, self.graph.invoke(state), query_vec)
+
+    async def aquery(self, question: str) -> dict[str, Any]:
+        """非同步執行 Agentic RAG 查詢（ainvoke；LLM 與檢索都不阻塞 event loop）"""
+        state = self.initial_state(question)
+        query_vec, hit = await self._alookup_cache(question, self.route_question(state))
+        if hit is not None:
+            return hit
+        result = await self.graph.ainvoke(state)
+        return await asyncio.to_thread(self._finish, question, result, query_vec)
+
+    async def aquery_many(
+        self, questions: list[str], concurrency: int = QUERY_CONCURRENCY
+    ) -> list[dict[str, Any]]:
+        """並行執行多個問題（最多 concurrency 個同時進行），結果依輸入順序回傳
+
+        各問題的查詢 embedding 透過 embedding_batcher 合併成批次呼叫；
+        單一問題失敗時該筆結果為 {"question", "error"}。
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(question: str) -> dict[str, Any]:
+            async with semaphore:
+                try:
+                    return await self.aquery(question)
+                except Exception as e:
+                    print(f"  [query] 查詢失敗 ({question}): {e}", file=sys.stderr)
+                    return {"question": question, "error": str(e)}
+
+        return await asyncio.gather(*(run(q) for q in questions))
+
+    def stream(self, question: str, session_id: str | None = None) -> Iterator[dict[str, Any]]:
+        """串流執行 Agentic RAG 查詢，依序產生事件
+
+        - route: 起始節點（retrieve / search / keyword / direct；session 追問為 followup）
+        - sources: 檢索到的文件（重寫查詢後會再出現）
+        - grade: 評分結果；進入生成時附上交給生成階段的文件
+        - rewrite: 重寫後的查詢
+        - shortcut: 接近期限而略過的步驟（skip_fanout / skip_grade / skip_rewrite / skip_generate）
+        - token: 答案片段（generate / direct 節點的 LLM 輸出，逐段送出）
+        - done: 完整結果（與 query() 相同）
+        """
+        if session_id is not None:
+            state, config = self._session_state(session_id, question)
+            graph, graph_input = self.session_graph, self.session_input(question)
+        else:
+            state, config = dict(self.initial_state(question)), None
+            graph, graph_input = self.graph, state
+        route = self.route_question(state)  # type: ignore[arg-type]
+        yield {"event": "route", "route": route}
+
+        query_vec, hit = (None, None) if session_id else self._lookup_cache(question, route)
+        if hit is not None:
+            yield {"event": "sources", "documents": hit["documents"], "cached": True}
+            yield {"event": "token", "text": hit["answer"]}
+            yield {"event": "done", "result": hit}
+            return
+
+        final: dict[str, Any] = dict(state)
+        streamed = False
+        for mode, chunk in graph.stream(
+            graph_input,  # type: ignore[arg-type]
+            config,  # type: ignore[arg-type]
+            stream_mode=["updates", "messages"],
+        ):
+            if mode == "messages":
+                message, metadata = chunk
+                # 只轉送 LLM 的串流片段；節點寫回 state 的完整訊息不重複送出
+                if (
+                    isinstance(message, AIMessageChunk)
+                    and metadata.get("langgraph_node") in ("generate", "direct")
+                    and message.text
+                ):
+                    streamed = True
+                    yield {"event": "token", "text": message.text}
+                continue
+
+            for node, update in chunk.items():
+                taken = len(final.get("shortcuts") or [])
+                final.update({k: v for k, v in (update or {}).items() if k != "messages"})
+                for name in (final.get("shortcuts") or [])[taken:]:
+                    yield {"event": "shortcut", "name": name}
+                if node in ("retrieve", "search", "keyword"):
+                    yield {
+                        "event": "sources",
+                        "query": final.get("rewritten_query") or question,
+                        "documents": self.format_result(question, update)["documents"],
+                    }
+                elif node == "grade":
+                    event: dict[str, Any] = {"event": "grade", "decision": update["grade_decision"]}
+                    if update["grade_decision"] == "generate":
+                        event["documents"] = self.format_result(question, final)["documents"]
+                    yield event
+                elif node == "rewrite":
+                    yield {"event": "rewrite", "query": update["rewritten_query"]}
+                elif node == "followup":
+                    yield {
+                        "event": "followup",
+                        "decision": update["followup"],
+                        "documents": self.format_result(question, final)["documents"],
+                    }
+
+        # 固定回覆（打招呼、找不到文件）沒有經過 LLM，整段送出
+        if not streamed and final.get("generation"):
+            yield {"event": "token", "text": str(final["generation"])}
+        if session_id is not None:
+            result = graph.get_state(config).values  # type: ignore[arg-type]
+            yield {"event": "done", "result": self._session_result(session_id, question, result)}
+        else:
+            yield {"event": "done", "result": self._finish(question, final, query_vec)}
+
+    def calibrate(
+        self, labels_path: str | Path, precision: float = CALIBRATION_PRECISION
+    ) -> GradeThresholds:
+        """依標註樣本校準距離門檻並儲存
+
+        標註檔為 JSONL，每行 {"question": "...", "relevant": ["相關檔案路徑", ...]}；
+        每個問題以 retrieve 相同的 top_k 檢索，結果依檔案是否在 relevant 中標記。
+        """
+        labels = [
+            json.loads(line)
+            for line in Path(labels_path).expanduser().read_text(encoding="utf-8").splitlines()
+            if line.strip()
+        ]
+        query_vecs = self.rag.embed_queries([label["question"] for label in labels])
+        if query_vecs is None:
+            raise RuntimeError("查詢 embedding 失敗，無法校準")
 
-    workflow.add_node("retrieve", retrieve)
-    workflow.add_node("grade", grade_documents)
-    workflow.add_node("rewrite", rewrite_question)
-    workflow.add_node("generate", generate_answer)
-    workflow.add_node("direct", direct_response)
+        samples: list[tuple[float, bool]] = []
+        for label, results in zip(labels, self.rag.search_vectors(query_vecs, 5), strict=True):
+            relevant_files = set(label["relevant"])
+            samples.extend((r["distance"], r["file_path"] in relevant_files) for r in results)
 
-    workflow.add_conditional_edges(
-        START,
-        route_question,
-        {"retrieve": "retrieve", "direct": "direct"},
-    )
-    workflow.add_edge("retrieve", "grade")
-    workflow.add_conditional_edges(
-        "grade",
-        lambda state: state["grade_decision"],
-        {"generate": "generate", "rewrite": "rewrite"},
-    )
-    workflow.add_edge("rewrite", "retrieve")
-    workflow.add_edge("generate", END)
-    workflow.add_edge("direct", END)
+        thresholds = calibrate_thresholds(samples, precision)
+        self.rag._state_path(GRADE_THRESHOLDS_FILE).write_text(
+            json.dumps(thresholds), encoding="utf-8"
+        )
+        self._grade_thresholds = thresholds
+        return thresholds
 
-    return workflow.compile()  # type: ignore[return-value]
+
+def create_rag_graph(
+    vault_path: str | Path, max_retries: int = MAX_RETRIES
+) -> CompiledStateGraph[AgentState]:
+    """建立 Agentic RAG 圖（元件延遲建立）"""
+    return AgenticRAG(vault_path, max_retries).graph
+
+
+@lru_cache(maxsize=8)
+def get_agent(
+    vault_path: str | Path = DEFAULT_VAULT_PATH,
+    max_retries: int = MAX_RETRIES,
+    use_cache: bool = True,
+    retrieval: str = "loop",
+    context_budget: int = CONTEXT_TOKEN_BUDGET,
+    deadline: float | None = QUERY_DEADLINE,
+    model_routing: bool = True,
+) -> AgenticRAG:
+    """取得共用的 AgenticRAG（同一個程序內重複使用）"""
+    return AgenticRAG(
+        vault_path,
+        max_retries,
+        use_cache=use_cache,
+        retrieval=retrieval,
+        context_budget=context_budget,
+        deadline=deadline,
+        model_routing=model_routing,
+    )
 
 
 def query(
     question: str,
     vault_path: str | Path = DEFAULT_VAULT_PATH,
     max_retries: int = MAX_RETRIES,
+    use_cache: bool = True,
+    retrieval: str = "loop",
+    context_budget: int = CONTEXT_TOKEN_BUDGET,
+    session_id: str | None = None,
+    deadline: float | None = QUERY_DEADLINE,
+    model_routing: bool = True,
 ) -> dict[str, Any]:
     """執行 Agentic RAG 查詢"""
-    graph = create_rag_graph(vault_path, max_retries)
-
-    initial_state: AgentState = {
-        "messages": [HumanMessage(content=question)],
-        "question": question,
-        "rewritten_query": None,
-        "documents": [],
-        "generation": None,
-        "retry_count": 0,
-        "grade_decision": None,
-    }
+    agent = get_agent(
+        str(vault_path), max_retries, use_cache, retrieval, context_budget, deadline, model_routing
+    )
+    return agent.query(question, session_id)
 
-    result = graph.invoke(initial_state)
 
-    return {
-        "question": question,
-        "answer": result.get("generation", ""),
-        "documents": [
-            {"file_path": d.metadata.get("file_path"), "distance": d.metadata.get("distance")}
-            for d in result.get("documents", [])
-        ],
-        "retry_count": result.get("retry_count", 0),
-    }
+def query_many(
+    questions: list[str],
+    vault_path: str | Path = DEFAULT_VAULT_PATH,
+    max_retries: int = MAX_RETRIES,
+    concurrency: int = QUERY_CONCURRENCY,
+) -> list[dict[str, Any]]:
+    """並行執行多個 Agentic RAG 查詢"""
+    agent = get_agent(str(vault_path), max_retries)
+    return asyncio.run(agent.aquery_many(questions, concurrency))
+
+
+def benchmark(
+    question: str,
+    vault_path: str | Path = DEFAULT_VAULT_PATH,
+    iterations: int = 20,
+) -> dict[str, float]:
+    """比較每次重建（舊行為）與共用 AgenticRAG 的每次查詢額外開銷（毫秒）
+
+    舊的 query() 每次都建立 ObsidianRAG、兩個 Gemini client 並重新編譯圖；
+    per_query 以同樣方式強制建立所有元件來重現。
+    建議用 direct 路徑的問題（例如「你好」），才能只量到額外開銷而不是 API 延遲。
+    """
+
+    def per_query() -> None:
+        agent = AgenticRAG(vault_path)
+        _ = agent.rag, agent.lite_llm, agent.main_llm
+        agent.query(question)
+
+    shared = AgenticRAG(vault_path)
+    shared.query(question)  # warm-up
+
+    timings: dict[str, float] = {}
+    for name, run in (("per_query", per_query), ("shared", lambda: shared.query(question))):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        timings[name] = round((time.perf_counter() - started) / iterations * 1000, 2)
+    return timings
 
 
 def main() -> None:
     import argparse
 
     parser = argparse.ArgumentParser(description="Obsidian Agentic RAG")
-    parser.add_argument("command", choices=["query"], help="執行的命令")
+    parser.add_argument(
+        "command",
+        choices=["query", "batch", "bench", "calibrate", "cache-stats", "cache-clear"],
+        help="執行的命令",
+    )
     parser.add_argument("--vault", default=str(DEFAULT_VAULT_PATH), help="Vault 路徑")
-    parser.add_argument("--question", "-q", required=True, help="查詢問題")
+    parser.add_argument("--question", "-q", help="查詢問題")
     parser.add_argument("--max-retries", "-r", type=int, default=MAX_RETRIES, help="最大重試次數")
+    parser.add_argument("--iterations", "-n", type=int, default=20, help="bench 重複次數")
+    parser.add_argument(
+        "--stream", action="store_true", help="串流輸出（搭配 --json 輸出 NDJSON 事件）"
+    )
+    parser.add_argument(
+        "--retrieval",
+        choices=RETRIEVAL_MODES,
+        default="loop",
+        help="檢索模式：loop（逐次重寫重試）、fanout（一次多查詢 + RRF）、"
+        "federated（同時查詢 vault、記憶與歷史）",
+    )
+    parser.add_argument(
+        "--context-budget",
+        type=int,
+        default=CONTEXT_TOKEN_BUDGET,
+        help="生成時檢索內容的 token 上限",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=QUERY_DEADLINE,
+        help="每個問題的時間上限（秒）；接近時略過評分或重寫，必要時只回傳檢索段落",
+    )
+    parser.add_argument(
+        "--no-model-routing", action="store_true", help="一律以 main 模型生成（不依問題選模型）"
+    )
+    parser.add_argument("--questions-file", help="batch 使用的問題檔（每行一個問題）")
+    parser.add_argument(
+        "--concurrency", type=int, default=QUERY_CONCURRENCY, help="batch 同時執行的問題上限"
+    )
+    parser.add_argument("--labels", help="calibrate 使用的標註檔（JSONL）")
+    parser.add_argument(
+        "--precision",
+        type=float,
+        default=CALIBRATION_PRECISION,
+        help="calibrate 時門檻內判定需達到的準確率",
+    )
+    parser.add_argument("--session", "-s", help="對話 session id（追問沿用上一輪的文件）")
+    parser.add_argument("--no-cache", action="store_true", help="不使用語意答案快取")
     parser.add_argument("--json", action="store_true", help="輸出 JSON 格式")
 
     args = parser.parse_args()
 
+    if args.command in ("query", "bench") and not args.question:
+        parser.error("query / bench 需要 --question")
+    if args.command == "batch" and not args.questions_file:
+        parser.error("batch 需要 --questions-file")
+    if args.command == "calibrate" and not args.labels:
+        parser.error("calibrate 需要 --labels")
+
     if args.command == "query":
         if not args.json:
             print(f"Agentic RAG 查詢: {args.question}", file=sys.stderr)
             print("-" * 50, file=sys.stderr)
 
-        result = query(args.question, args.vault, args.max_retries)
+        if args.stream:
+            agent = get_agent(
+                args.vault,
+                args.max_retries,
+                not args.no_cache,
+                args.retrieval,
+                args.context_budget,
+                args.deadline,
+                not args.no_model_routing,
+            )
+            for event in agent.stream(args.question, args.session):
+                if args.json:
+                    print(json.dumps(event, ensure_ascii=False), flush=True)
+                elif event["event"] == "token":
+                    print(event["text"], end="", flush=True)
+            if not args.json:
+                print()
+            return
+
+        result = query(
+            args.question,
+            args.vault,
+            args.max_retries,
+            not args.no_cache,
+            args.retrieval,
+            args.context_budget,
+            args.session,
+            args.deadline,
+            not args.no_model_routing,
+        )
 
         if args.json:
             print(json.dumps(result, ensure_ascii=False))
@@ -336,6 +1668,62 @@ def main() -> None:
                     print(f"  - {doc['file_path']} (distance: {doc['distance']:.4f})")
             if result["retry_count"] > 0:
                 print(f"\n查詢重寫次數: {result['retry_count']}")
+            if result["context"] and "prompt_tokens" in result["context"]:
+                print(f"\nPrompt tokens（估計）: {result['context']['prompt_tokens']}")
+            if result["shortcuts"]:
+                print(f"\n接近期限略過的步驟: {', '.join(result['shortcuts'])}")
+            if result["cache"]["hit"]:
+                print(f"\n（快取命中，相似度 {result['cache']['similarity']:.4f}）")
+
+    elif args.command == "bench":
+        timings = benchmark(args.question, args.vault, args.iterations)
+        if args.json:
+            print(json.dumps(timings))
+        else:
+            print(f"每次查詢額外開銷（{args.iterations} 次平均）:")
+            print(f"  每次重建: {timings['per_query']:.2f} ms")
+            print(f"  共用實例: {timings['shared']:.2f} ms")
+
+    elif args.command == "batch":
+        questions = [
+            line.strip()
+            for line in Path(args.questions_file)
+            .expanduser()
+            .read_text(encoding="utf-8")
+            .splitlines()
+            if line.strip()
+        ]
+        results = query_many(questions, args.vault, args.max_retries, args.concurrency)
+        if args.json:
+            print(json.dumps(results, ensure_ascii=False))
+        else:
+            for result in results:
+                print(f"\n問題: {result['question']}")
+                print(f"回答: {result.get('answer') or result.get('error')}")
+
+    elif args.command == "calibrate":
+        thresholds = AgenticRAG(args.vault).calibrate(args.labels, args.precision)
+        if args.json:
+            print(json.dumps(thresholds))
+        else:
+            print(f"樣本數: {thresholds['samples']}")
+            print(f"直接視為相關: distance <= {thresholds['relevant']}")
+            print(f"直接視為不相關: distance >= {thresholds['irrelevant']}")
+            print(f"略過 LLM 評分比例: {thresholds['skip_rate']:.1%}")
+
+    elif args.command in ("cache-stats", "cache-clear"):
+        cache = AnswerCache(ObsidianRAG(args.vault, readonly=True))
+        if args.command == "cache-clear":
+            removed = cache.clear()
+            print(json.dumps({"removed": removed}) if args.json else f"已清除 {removed} 筆快取")
+        else:
+            s = cache.stats()
+            if args.json:
+                print(json.dumps(s))
+            else:
+                print(f"快取項目: {s['entries']}")
+                print(f"命中率: {s['hits']}/{s['lookups']} ({s['hit_rate']:.1%})")
+                print(f"相似度門檻: {s['similarity']}")
 
 
 if __name__ == "__main__":
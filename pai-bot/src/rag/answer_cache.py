@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Agentic RAG 語意答案快取 - 相似問題直接回傳先前的答案
+
+每筆快取記錄問題向量、答案、引用檔案與當時的索引版本（manifest mtime）。
+查詢時以 cosine 相似度找最接近的問題；任何引用檔案被重新索引（mtime 改變
+或已刪除）時，該筆快取失效並刪除。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+from datetime import UTC, datetime
+from typing import Any
+
+import numpy as np
+from obsidian_rag import ObsidianRAG, content_hash
+
+ANSWER_CACHE_COLLECTION = "agentic_answer_cache"
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("RAG_ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+
+class AnswerCache:
+    """以問題向量查找的持久化答案快取（與索引同一個 ChromaDB）"""
+
+    def __init__(
+        self,
+        rag: ObsidianRAG,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.rag = rag
+        self.similarity = similarity
+        self.max_entries = max_entries
+        # 向量由呼叫端提供，collection 不需要 embedding function
+        self.collection = rag.client.get_or_create_collection(
+            name=ANSWER_CACHE_COLLECTION,
+            metadata={"hnsw:space": "cosine"},
+        )
+        self.stats_path = rag._state_path("answer_cache_stats.json")
+        # aquery_many 會在多個 thread 同時查詢、更新統計
+        self._lock = threading.Lock()
+
+    def _load_stats(self) -> dict[str, int]:
+        if not self.stats_path.exists():
+            return {"lookups": 0, "hits": 0}
+        data: dict[str, int] = json.loads(self.stats_path.read_text(encoding="utf-8"))
+        return data
+
+    def _record(self, hit: bool) -> dict[str, int]:
+        with self._lock:
+            stats = self._load_stats()
+            stats["lookups"] += 1
+            stats["hits"] += int(hit)
+            # 先寫暫存檔再替換，其他程序不會讀到寫到一半的檔案
+            tmp_path = self.stats_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(stats), encoding="utf-8")
+            tmp_path.replace(self.stats_path)
+            return stats
+
+    def _is_current(self, files: dict[str, str]) -> bool:
+        """引用檔案的 manifest mtime 是否仍與快取時相同"""
+        return all(self.rag._get_stored_mtime(path) == mtime for path, mtime in files.items())
+
+    def lookup(self, query_vec: np.ndarray) -> dict[str, Any] | None:
+        """找相似度達門檻且仍有效的快取答案；未命中回傳 None"""
+        hit: dict[str, Any] | None = None
+        if self.collection.count():
+            results = self.collection.query(
+                query_embeddings=[query_vec],  # type: ignore[arg-type]
+                n_results=1,
+                include=["documents", "metadatas", "distances"],
+            )
+            if results["ids"][0]:
+                entry_id = results["ids"][0][0]
+                similarity = 1 - float(results["distances"][0][0])  # type: ignore[index]
+                meta = results["metadatas"][0][0]  # type: ignore[index]
+                if similarity >= self.similarity:
+                    if self._is_current(json.loads(str(meta["files"]))):
+                        hit = {
+                            "question": meta["question"],
+                            "answer": results["documents"][0][0],  # type: ignore[index]
+                            "documents": json.loads(str(meta["documents"])),
+                            "similarity": round(similarity, 4),
+                        }
+                    else:
+                        print("  [cache] 引用檔案已重新索引，快取失效", file=sys.stderr)
+                        self.collection.delete(ids=[entry_id])
+
+        stats = self._record(hit is not None)
+        if hit is not None:
+            hit["hit_rate"] = round(stats["hits"] / stats["lookups"], 4)
+        return hit
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            stats = self._load_stats()
+        return round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+
+    def store(
+        self,
+        query_vec: np.ndarray,
+        question: str,
+        answer: str,
+        documents: list[dict[str, Any]],
+    ) -> None:
+        """寫入快取；記錄引用檔案目前的 manifest mtime"""
+        files: dict[str, str] = {}
+        for doc in documents:
+            mtime = self.rag._get_stored_mtime(doc["file_path"])
+            if mtime is None:
+                return  # 引用檔案不在索引中，無法判斷何時失效
+            files[doc["file_path"]] = mtime
+
+        self.collection.upsert(
+            ids=[content_hash(question)],
+            embeddings=[query_vec],  # type: ignore[list-item]
+            documents=[answer],
+            metadatas=[
+                {
+                    "question": question,
+                    "files": json.dumps(files),
+                    "documents": json.dumps(documents, ensure_ascii=False),
+                    "created_at": datetime.now(tz=UTC).isoformat(),
+                }
+            ],
+        )
+        self._evict()
+
+    def _evict(self) -> None:
+        """超過上限時刪除最舊的項目"""
+        overflow = self.collection.count() - self.max_entries
+        if overflow <= 0:
+            return
+        stored = self.collection.get(include=["metadatas"])  # type: ignore[list-item]
+        entries = sorted(
+            zip(stored["ids"], stored.get("metadatas") or [], strict=False),
+            key=lambda e: str(e[1]["created_at"]),
+        )
+        self.collection.delete(ids=[entry_id for entry_id, _ in entries[:overflow]])
+
+    def clear(self) -> int:
+        """清空快取與命中統計，回傳刪除的項目數"""
+        stored = self.collection.get(include=[])
+        if stored["ids"]:
+            self.collection.delete(ids=stored["ids"])
+        self.stats_path.unlink(missing_ok=True)
+        return len(stored["ids"])
+
+    def stats(self) -> dict[str, Any]:
+        stats = self._load_stats()
+        return {
+            "entries": self.collection.count(),
+            "lookups": stats["lookups"],
+            "hits": stats["hits"],
+            "hit_rate": self.hit_rate(),
+            "similarity": self.similarity,
+        }
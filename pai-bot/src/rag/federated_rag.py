@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""聯合檢索 - 同時查詢 vault、短期記憶與對話歷史，正規化分數後合併
+
+來源：
+- vault: ObsidianRAG 語意搜尋（embedding 逾時時為關鍵字搜尋）
+- memory: bot 的 POST /api/memory/search（短期記憶，關鍵字比對）
+- history: bot 的 GET /api/history/search（sessions / learnings / decisions，子字串比對）
+
+每個來源有自己的逾時；所有來源並行查詢，一個問題的檢索時間取決於最慢的來源
+（最多到它的逾時），逾時或失敗的來源略過。各來源的分數先正規化到 [0, 1]
+再乘上來源權重排序，交給 grade 節點評分。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.parse
+import urllib.request
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TypedDict
+
+from obsidian_rag import SEARCH_TIMEOUT, ObsidianRAG, extract_keywords
+
+# Constants
+# 由 bot spawn 時沿用 bot 的 API_PORT
+PAI_API_URL = (
+    os.environ.get("PAI_API_URL") or f"http://127.0.0.1:{os.environ.get('API_PORT', '3000')}"
+)
+PAI_API_KEY = os.environ.get("PAI_API_KEY", "")
+SOURCE_TIMEOUT = 2.0  # 秒；HTTP 來源的預設逾時
+# vault 的 embedding 逾時後還要做關鍵字搜尋，來源逾時多留一點時間（未設定 RAG_SEARCH_TIMEOUT 時
+# embedding 以 SOURCE_TIMEOUT 為上限，聯合檢索不能無限等待）
+VAULT_KEYWORD_GRACE = 1.0
+VAULT_SOURCE_TIMEOUT = (SEARCH_TIMEOUT or SOURCE_TIMEOUT) + VAULT_KEYWORD_GRACE
+HISTORY_MAX_KEYWORDS = 3  # history 只做子字串比對，用前幾個關鍵字分別查詢
+SOURCE_WEIGHTS = {"vault": 1.0, "memory": 0.8, "history": 0.6}
+
+
+class SourceReport(TypedDict):
+    """單一來源的查詢結果摘要"""
+
+    status: str  # ok / timeout / error
+    count: int
+    ms: float
+
+
+class Source(ABC):
+    """檢索來源：search 回傳帶 score（[0, 1]，越大越相關）的結果"""
+
+    name = "source"
+
+    def __init__(self, timeout: float = SOURCE_TIMEOUT, weight: float | None = None):
+        self.timeout = timeout
+        self.weight = SOURCE_WEIGHTS.get(self.name, 1.0) if weight is None else weight
+
+    @abstractmethod
+    def search(self, query: str, top_k: int) -> list[dict[str, Any]]: ...
+
+
+class VaultSource(Source):
+    name = "vault"
+
+    def __init__(self, rag: ObsidianRAG, timeout: float = VAULT_SOURCE_TIMEOUT):
+        super().__init__(timeout)
+        self.rag = rag
+
+    def search(self, query: str, top_k: int) -> list[dict[str, Any]]:
+        # embedding 逾時由 search 自己降級成關鍵字搜尋
+        embed_timeout = max(0.0, self.timeout - VAULT_KEYWORD_GRACE)
+        results = self.rag.search(query, top_k=top_k, timeout=embed_timeout)
+        for r in results:
+            # cosine distance 介於 0~2；關鍵字搜尋的 distance 是未命中比例（0~1）
+            r["score"] = max(0.0, 1.0 - float(r["distance"]))
+        return results
+
+
+class ApiSource(Source):
+    """bot HTTP API 來源"""
+
+    def __init__(
+        self,
+        base_url: str = PAI_API_URL,
+        api_key: str = PAI_API_KEY,
+        timeout: float = SOURCE_TIMEOUT,
+    ):
+        super().__init__(timeout)
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+
+    def _request(self, path: str, body: dict[str, Any] | None = None) -> Any:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(
+            f"{self.base_url}{path}",
+            data=json.dumps(body).encode() if body is not None else None,
+            headers=headers,
+            method="POST" if body is not None else "GET",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+class MemorySource(ApiSource):
+    name = "memory"
+
+    def search(self, query: str, top_k: int) -> list[dict[str, Any]]:
+        data = self._request("/api/memory/search", {"query": query, "limit": top_k})
+        memories = data.get("memories", [])
+        # API 不回傳分數，依排名換算
+        return [
+            {
+                "file_path": f"memory/{m['id']}",
+                "chunk_index": 0,
+                "chunk": m["content"],
+                "distance": None,
+                "score": 1.0 / (rank + 1),
+            }
+            for rank, m in enumerate(memories)
+        ]
+
+
+class HistorySource(ApiSource):
+    name = "history"
+
+    def search(self, query: str, top_k: int) -> list[dict[str, Any]]:
+        keywords = extract_keywords(query)[:HISTORY_MAX_KEYWORDS]
+        if not keywords:
+            return []
+
+        def fetch(keyword: str) -> list[dict[str, Any]]:
+            params = urllib.parse.urlencode({"query": keyword, "limit": top_k})
+            items: list[dict[str, Any]] = self._request(f"/api/history/search?{params}")["items"]
+            return items
+
+        # 每個關鍵字一個請求，同時送出
+        with ThreadPoolExecutor(max_workers=len(keywords)) as executor:
+            responses = list(executor.map(fetch, keywords))
+
+        matched: dict[str, tuple[dict[str, Any], int]] = {}
+        for items in responses:
+            for item in items:
+                path = f"history/{item['type']}/{item['filename']}"
+                _, hits = matched.get(path, (item, 0))
+                matched[path] = (item, hits + 1)
+
+        ranked = sorted(matched.items(), key=lambda e: (-e[1][1], e[0]))[:top_k]
+        return [
+            {
+                "file_path": path,
+                "chunk_index": 0,
+                "chunk": item.get("summary") or f"{item['date']} {item['filename']}",
+                "distance": None,
+                "score": hits / len(keywords),
+            }
+            for path, (item, hits) in ranked
+        ]
+
+
+def default_sources(
+    rag: ObsidianRAG, base_url: str = PAI_API_URL, api_key: str = PAI_API_KEY
+) -> list[Source]:
+    return [
+        VaultSource(rag),
+        MemorySource(base_url, api_key),
+        HistorySource(base_url, api_key),
+    ]
+
+
+def fuse_sources(
+    rankings: dict[str, list[dict[str, Any]]], weights: dict[str, float], top_k: int
+) -> list[dict[str, Any]]:
+    """依 權重 × 正規化分數 合併各來源結果，同一個 (file_path, chunk_index) 只留一筆
+
+    非 vault 來源的 distance 以 1 - 分數 代替，並標記 degraded：
+    它們不是 cosine distance，不能套用免 LLM 評分的距離門檻。
+    """
+    fused: dict[tuple[str, Any], dict[str, Any]] = {}
+    for name, results in rankings.items():
+        for r in results:
+            key = (r["file_path"], r.get("chunk_index"))
+            score = round(weights.get(name, 1.0) * min(1.0, float(r["score"])), 4)
+            if key in fused and fused[key]["fused_score"] >= score:
+                continue
+            entry = {**r, "source": name, "fused_score": score}
+            if name != "vault":
+                entry["distance"] = round(1.0 - score, 4)
+                entry["degraded"] = True
+            fused[key] = entry
+    return sorted(fused.values(), key=lambda r: -r["fused_score"])[:top_k]
+
+
+def _run_source(source: Source, query: str, top_k: int) -> tuple[list[dict[str, Any]], float]:
+    started = time.perf_counter()
+    results = source.search(query, top_k)
+    return results, (time.perf_counter() - started) * 1000
+
+
+def _report(
+    source: Source, outcome: tuple[list[dict[str, Any]], float] | BaseException, waited_ms: float
+) -> tuple[list[dict[str, Any]], SourceReport]:
+    if isinstance(outcome, TimeoutError):
+        print(f"  [federated] {source.name} 逾時（{source.timeout}s）", file=sys.stderr)
+        return [], {"status": "timeout", "count": 0, "ms": round(waited_ms, 1)}
+    if isinstance(outcome, BaseException):
+        print(f"  [federated] {source.name} 查詢失敗: {outcome}", file=sys.stderr)
+        return [], {"status": "error", "count": 0, "ms": round(waited_ms, 1)}
+    results, ms = outcome
+    return results, {"status": "ok", "count": len(results), "ms": round(ms, 1)}
+
+
+def federated_search(
+    sources: list[Source], query: str, top_k: int = 5
+) -> tuple[list[dict[str, Any]], dict[str, SourceReport]]:
+    """並行查詢所有來源（各自逾時），回傳 (合併結果, 各來源摘要)"""
+    rankings: dict[str, list[dict[str, Any]]] = {}
+    reports: dict[str, SourceReport] = {}
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    futures = [executor.submit(_run_source, source, query, top_k) for source in sources]
+    for source, future in zip(sources, futures, strict=True):
+        # 所有來源同時開始，各自的截止時間從 started 起算
+        remaining = max(0.0, source.timeout - (time.perf_counter() - started))
+        try:
+            outcome: tuple[list[dict[str, Any]], float] | BaseException = future.result(remaining)
+        except Exception as e:
+            outcome = e
+        waited_ms = (time.perf_counter() - started) * 1000
+        rankings[source.name], reports[source.name] = _report(source, outcome, waited_ms)
+    # 逾時的來源不等它結束
+    executor.shutdown(wait=False, cancel_futures=True)
+    return fuse_sources(rankings, {s.name: s.weight for s in sources}, top_k), reports
+
+
+async def afederated_search(
+    sources: list[Source], query: str, top_k: int = 5
+) -> tuple[list[dict[str, Any]], dict[str, SourceReport]]:
+    """federated_search 的非同步版本"""
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(
+            asyncio.wait_for(asyncio.to_thread(_run_source, s, query, top_k), s.timeout)
+            for s in sources
+        ),
+        return_exceptions=True,
+    )
+    waited_ms = (time.perf_counter() - started) * 1000
+    rankings: dict[str, list[dict[str, Any]]] = {}
+    reports: dict[str, SourceReport] = {}
+    for source, outcome in zip(sources, outcomes, strict=True):
+        rankings[source.name], reports[source.name] = _report(source, outcome, waited_ms)
+    return fuse_sources(rankings, {s.name: s.weight for s in sources}, top_k), reports
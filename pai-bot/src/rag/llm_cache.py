@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""持久化 LLM 回應快取 - temperature=0 的 Gemini 呼叫，相同輸入直接回傳先前的結果
+
+agentic_rag 與 intel-feed agent 共用同一個 SQLite 檔（各自的 namespace 分開統計）：
+- key: (模型設定, 完整 prompt) 的 sha256；模型設定由 LangChain 產生，包含模型名稱、
+  temperature 與 with_structured_output 的 schema（tool / response_format 參數）
+- TTL: 超過存活時間的紀錄視為未命中並刪除
+- 容量: 超過上限時依最後使用時間淘汰（LRU）
+- 命中率: 每個 namespace 的 hits / misses 持久化，`llm_cache.py stats` 查看
+
+用法：ChatGoogleGenerativeAI(..., cache=get_llm_cache("agentic_rag"))
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import warnings
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+# Constants
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = Path(
+    os.environ.get("LLM_CACHE_PATH") or Path.home() / ".cache" / "pai" / "llm_cache.sqlite"
+).expanduser()
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL") or 7 * 24 * 3600)  # 秒
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES") or 20000)
+LLM_CACHE_EVICT_RATIO = 0.9  # 超過上限時淘汰到上限的這個比例，避免每次寫入都淘汰
+LLM_CACHE_BUSY_TIMEOUT = 5.0  # 秒；多個程序同時寫入時的等待上限
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at);
+CREATE TABLE IF NOT EXISTS llm_cache_stats (
+    namespace TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\x1f{prompt}".encode()).hexdigest()
+
+
+class SQLiteLLMCache(BaseCache):
+    """SQLite 的 LangChain 快取，帶 TTL、容量上限與命中率統計"""
+
+    def __init__(
+        self,
+        path: Path = LLM_CACHE_PATH,
+        namespace: str = "default",
+        ttl: float = LLM_CACHE_TTL,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0  # 本程序的統計；跨程序的累計在 llm_cache_stats
+        self.misses = 0
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=LLM_CACHE_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def _count(self, hit: bool) -> None:
+        column = "hits" if hit else "misses"
+        self._conn.execute(
+            f"INSERT INTO llm_cache_stats (namespace, {column}) VALUES (?, 1) "
+            f"ON CONFLICT (namespace) DO UPDATE SET {column} = {column} + 1",
+            (self.namespace,),
+        )
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        key = _cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._count(row is not None)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", LangChainBetaWarning)
+            generations: RETURN_VAL_TYPE = loads(row[0], allowed_objects="core")
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, namespace, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (_cache_key(prompt, llm_string), self.namespace, dumps(return_val), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """刪除過期紀錄；仍超過容量時依最後使用時間淘汰"""
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        (entries,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if entries <= self.max_entries:
+            return
+        excess = entries - int(self.max_entries * LLM_CACHE_EVICT_RATIO)
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN "
+            "(SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+            (excess,),
+        )
+        print(f"  [llm-cache] 淘汰 {excess} 筆", file=sys.stderr)
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.execute("DELETE FROM llm_cache_stats")
+
+    def stats(self) -> dict[str, Any]:
+        """各 namespace 的累計命中率與快取大小"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT namespace, hits, misses FROM llm_cache_stats ORDER BY namespace"
+            ).fetchall()
+            entries = dict(
+                self._conn.execute(
+                    "SELECT namespace, COUNT(*) FROM llm_cache GROUP BY namespace"
+                ).fetchall()
+            )
+        namespaces = {
+            name: {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+                "entries": entries.get(name, 0),
+            }
+            for name, hits, misses in rows
+        }
+        return {
+            "path": str(self.path),
+            "entries": sum(entries.values()),
+            "bytes": self.path.stat().st_size if self.path.exists() else 0,
+            "namespaces": namespaces,
+        }
+
+
+@lru_cache(maxsize=8)
+def get_llm_cache(namespace: str) -> SQLiteLLMCache | None:
+    """取得共用的快取（LLM_CACHE=0 或無法開啟時回傳 None，不使用快取）"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        return SQLiteLLMCache(namespace=namespace)
+    except sqlite3.Error as e:
+        print(f"  [llm-cache] 無法開啟 {LLM_CACHE_PATH}，不使用快取: {e}", file=sys.stderr)
+        return None
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="LLM 回應快取")
+    parser.add_argument("command", choices=["stats", "clear"], help="執行的命令")
+    parser.add_argument("--path", default=str(LLM_CACHE_PATH), help="快取檔路徑")
+    parser.add_argument("--json", action="store_true", help="輸出 JSON 格式")
+
+    args = parser.parse_args()
+    cache = SQLiteLLMCache(Path(args.path).expanduser())
+
+    if args.command == "clear":
+        cache.clear()
+        print("已清除 LLM 回應快取")
+        return
+
+    stats = cache.stats()
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False))
+        return
+    print(f"快取檔: {stats['path']}（{stats['entries']} 筆，{stats['bytes'] / 1024:.0f} KB）")
+    for name, s in stats["namespaces"].items():
+        rate = f"{s['hit_rate']:.1%}" if s["hit_rate"] is not None else "-"
+        total = s["hits"] + s["misses"]
+        print(f"  {name:<14} 命中率 {rate:>6}（{s['hits']} / {total}），{s['entries']} 筆")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,35 +4,85 @@
 from __future__ import annotations
 
 import hashlib
+import json
 import os
 import re
+import sys
+import threading
+import time
+import zipfile
+from collections.abc import Callable
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, cast
 
 import chromadb
+import numpy as np
 from chromadb.api.types import Embeddable, EmbeddingFunction
+from token_estimate import estimate_tokens
 
 # 設定
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 DB_PATH = Path.home() / ".chromadb" / "obsidian"
+DEFAULT_COLLECTION = "obsidian_vault"
+COLLECTION_METADATA = {"hnsw:space": "cosine"}  # 距離評分、MMR、相關筆記都假設 cosine
+RELATED_TOP_K = 10
+RELATED_BLOCK_SIZE = 512
+FETCH_BATCH_SIZE = 500
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_PRICE_PER_1M_TOKENS = 0.02  # USD
+DEFAULT_EMBED_TOKENS_PER_SEC = 3000.0
+SEARCH_FETCH_MULTIPLIER = 4
+MMR_LAMBDA = 0.5
+RRF_K = 60  # reciprocal rank fusion 的平滑常數
+QUERY_CACHE_SIZE = 256
+KEYWORD_MAX_TERMS = 8
+# 查詢 embedding 的等待上限（秒），逾時改用關鍵字搜尋；未設定則不限
+SEARCH_TIMEOUT = float(os.environ.get("RAG_SEARCH_TIMEOUT") or 0) or None
+SIMHASH_MAX_DISTANCE = 3  # 64-bit SimHash 漢明距離 <= 3 視為近似重複（固定門檻）
+# 依文字長度放寬的門檻：同樣改一行，短文字的漢明距離較大；上限必須小於 SIMHASH_BANDS
+SIMHASH_SCALED_MAX_DISTANCE = 7
+SIMHASH_MIN_TOKENS = 32  # 少於這個 token 數只做精確比對
+SIMHASH_VERSION = 2  # 指紋演算法版本；舊版本的 chunk 只做精確去重（--rebuild 後重新計算）
+SIMHASH_BANDS = 8
+# 段落去重：這個長度以上、且在其他筆記出現過的段落（例如模板區塊）獨立成 chunk
+PARAGRAPH_DEDUP_MIN_CHARS = 40
+SKIP_BLOCKS_FILE = ".rag-skip-blocks.md"  # vault 內的模板區塊設定（以空行分隔）
 
 
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
-    """將文字切成 chunks"""
-    # 移除 frontmatter
+def split_paragraphs(text: str, skip_blocks: set[str] | None = None) -> list[str]:
+    """移除 frontmatter 後按空行切成段落
+
+    skip_blocks: 要略過的段落 content_hash（例如 daily note 模板的固定段落）
+    """
     text = re.sub(r"^---\n.*?\n---\n", "", text, flags=re.DOTALL)
+    paragraphs = [p.strip() for p in re.split(r"\n\n+", text)]
+    return [p for p in paragraphs if p and not (skip_blocks and content_hash(p) in skip_blocks)]
+
 
-    # 按段落切分
-    paragraphs = re.split(r"\n\n+", text)
+def chunk_text(
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    overlap: int = CHUNK_OVERLAP,
+    skip_blocks: set[str] | None = None,
+    isolate: Callable[[str], bool] | None = None,
+) -> list[str]:
+    """將文字切成 chunks
 
+    skip_blocks: 要略過的段落 content_hash（例如 daily note 模板的固定段落）
+    isolate: 回傳 True 的段落獨立成一個 chunk，不與前後段落合併
+             （在其他筆記出現過的模板段落獨立後，整個 chunk 才能去重）
+    """
     chunks = []
     current_chunk = ""
 
-    for para in paragraphs:
-        para = para.strip()
-        if not para:
+    for para in split_paragraphs(text, skip_blocks):
+        if isolate is not None and isolate(para):
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            chunks.append(para)
+            current_chunk = ""
             continue
 
         if len(current_chunk) + len(para) < chunk_size:
@@ -66,9 +116,170 @@ def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVE
     return [c for c in final_chunks if len(c) > 20]
 
 
-def generate_chunk_id(file_path: str, chunk_index: int) -> str:
-    """產生 chunk 的唯一 ID"""
-    return hashlib.md5(f"{file_path}:{chunk_index}".encode()).hexdigest()
+def normalize_chunk(text: str) -> str:
+    """正規化文字：小寫、移除標點與多餘空白"""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_hash(text: str) -> str:
+    """正規化後的內容 hash，用於精確去重"""
+    return hashlib.md5(normalize_chunk(text).encode()).hexdigest()
+
+
+SIMHASH_TOKEN_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|[^\W\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+"
+)
+_FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+_FNV_PRIME = np.uint64(0x100000001B3)
+
+
+def _mix64(h: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer：讓每個 bit 都均勻受輸入影響"""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def simhash(text: str, shingle: int = 3) -> int:
+    """64-bit SimHash，用於近似去重（例如只差日期的模板段落）"""
+    return fingerprint(text, shingle)[0]
+
+
+def simhash_max_distance(tokens: int) -> int:
+    """依 token 數決定近似重複的漢明距離門檻
+
+    同樣改動幾個 token（例如日期），文字越短距離越大，門檻隨長度放寬；
+    太短的文字近似比對不可靠，只接受相同指紋。
+    """
+    if tokens < SIMHASH_MIN_TOKENS:
+        return 0
+    return min(SIMHASH_SCALED_MAX_DISTANCE, 3 + round(48 / tokens**0.5))
+
+
+def fingerprint(text: str, shingle: int = 3) -> tuple[int, int]:
+    """回傳 (64-bit SimHash, 依長度放寬的漢明距離門檻)
+
+    以 token 序列的 shingle 計算：英數以詞為 token，CJK 以字為 token。
+    token 與 shingle 的 hash 都以 NumPy 向量運算（FNV-1a + splitmix64），
+    再把 64 個 bit plane 相加，避免逐 shingle、逐 bit 的 Python 迴圈。
+    """
+    tokens = SIMHASH_TOKEN_PATTERN.findall(normalize_chunk(text)) or [""]
+    words = np.array(tokens)
+    codes = words.astype(words.dtype.newbyteorder("<")).view("<u4").reshape(len(tokens), -1)
+    hashes = np.full(len(tokens), _FNV_OFFSET)
+    for column in codes.T.astype(np.uint64):
+        hashes = (hashes ^ column) * _FNV_PRIME
+
+    count = max(len(tokens) - shingle + 1, 1)
+    grams = hashes[:count].copy()
+    for offset in range(1, min(shingle, len(tokens))):
+        grams = _mix64(grams) * _FNV_PRIME + hashes[offset : offset + count]
+    grams = _mix64(grams)
+
+    planes = np.unpackbits(grams.astype("<u8").view(np.uint8), bitorder="little")
+    ones = planes.reshape(count, 64).sum(axis=0)
+    value = int(np.packbits(ones * 2 > count, bitorder="little").view("<u8")[0])
+    return value, simhash_max_distance(len(tokens))
+
+
+def _paragraph_fingerprints(chunk: str) -> str:
+    """多段落 chunk 內夠長段落的 "hash:simhash"（以換行分隔），單段落 chunk 回傳空字串"""
+    paragraphs = [p.strip() for p in re.split(r"\n\n+", chunk)]
+    if len(paragraphs) < 2:
+        return ""
+    return "\n".join(
+        f"{content_hash(p)}:{simhash(p):016x}"
+        for p in paragraphs
+        if len(p) >= PARAGRAPH_DEDUP_MIN_CHARS
+    )
+
+
+def _stored_fingerprint(meta: Any) -> int | None:
+    """chunk metadata 中的 SimHash；沒有或版本不同時回傳 None"""
+    if not meta.get("simhash") or meta.get("simhash_version") != SIMHASH_VERSION:
+        return None
+    return int(str(meta["simhash"]), 16)
+
+
+def load_skip_blocks(path: Path) -> set[str]:
+    """讀取模板區塊設定檔，回傳各段落的 content_hash"""
+    if not path.exists():
+        return set()
+    blocks = re.split(r"\n\n+", path.read_text(encoding="utf-8"))
+    return {content_hash(b) for b in blocks if b.strip()}
+
+
+def _split_refs(refs: Any) -> list[str]:
+    return [r for r in str(refs or "").split("\n") if r]
+
+
+def _parse_ref(ref: str) -> tuple[str, int]:
+    """解析 "path#chunk_index" 格式的引用"""
+    path, _, index = ref.rpartition("#")
+    return path, int(index)
+
+
+class DuplicateIndex:
+    """chunk 去重索引：正規化 hash 精確比對 + SimHash 分段 bucket 近似比對"""
+
+    def __init__(self, max_distance: int = SIMHASH_MAX_DISTANCE, bands: int = SIMHASH_BANDS):
+        self.max_distance = max_distance
+        self.bands = bands
+        self.band_bits = 64 // bands
+        self.by_hash: dict[str, str] = {}
+        self.entries: dict[str, tuple[str, int | None]] = {}  # chunk_id -> (hash, simhash)
+        self.buckets: dict[tuple[int, int], set[str]] = {}
+
+    def _band_keys(self, fingerprint: int) -> list[tuple[int, int]]:
+        mask = (1 << self.band_bits) - 1
+        return [(b, (fingerprint >> (b * self.band_bits)) & mask) for b in range(self.bands)]
+
+    def add(self, chunk_id: str, digest: str, fingerprint: int | None) -> None:
+        """fingerprint 為 None 時只參與精確比對（例如舊版指紋的 chunk）"""
+        self.entries[chunk_id] = (digest, fingerprint)
+        self.by_hash.setdefault(digest, chunk_id)
+        if fingerprint is None:
+            return
+        for key in self._band_keys(fingerprint):
+            self.buckets.setdefault(key, set()).add(chunk_id)
+
+    def remove(self, chunk_id: str) -> None:
+        entry = self.entries.pop(chunk_id, None)
+        if entry is None:
+            return
+        digest, fingerprint = entry
+        if self.by_hash.get(digest) == chunk_id:
+            del self.by_hash[digest]
+        if fingerprint is None:
+            return
+        for key in self._band_keys(fingerprint):
+            self.buckets.get(key, set()).discard(chunk_id)
+
+    def find(self, digest: str, fingerprint: int, max_distance: int | None = None) -> str | None:
+        """找出重複或近似重複的 chunk id
+
+        max_distance: 這次比對的漢明距離門檻（預設 self.max_distance，不可超過 bands - 1）
+        """
+        if digest in self.by_hash:
+            return self.by_hash[digest]
+        limit = self.max_distance if max_distance is None else min(max_distance, self.bands - 1)
+        # 漢明距離 <= limit 時，至少有一段 band 完全相同（bands > limit）
+        for key in self._band_keys(fingerprint):
+            for chunk_id in self.buckets.get(key, ()):
+                stored = self.entries[chunk_id][1]
+                if stored is not None and bin(stored ^ fingerprint).count("1") <= limit:
+                    return chunk_id
+        return None
+
+
+def generate_chunk_id(file_path: str, chunk_index: int, digest: str = "") -> str:
+    """產生 chunk 的唯一 ID
+
+    digest 為內容 hash：去重後 chunk 可能轉移給其他檔案，加入內容避免重新索引時覆蓋
+    """
+    key = f"{file_path}:{chunk_index}:{digest}" if digest else f"{file_path}:{chunk_index}"
+    return hashlib.md5(key.encode()).hexdigest()
 
 
 def get_openai_embedding_function() -> EmbeddingFunction[Embeddable]:
@@ -85,34 +296,198 @@ def get_openai_embedding_function() -> EmbeddingFunction[Embeddable]:
         EmbeddingFunction[Embeddable],
         OpenAIEmbeddingFunction(
             api_key=api_key,
-            model_name="text-embedding-3-small",
+            model_name=EMBEDDING_MODEL,
         ),
     )
 
 
+def _format_results(results: Any, query_index: int = 0) -> list[dict[str, Any]]:
+    """將 collection.query 結果（第 query_index 個查詢）轉為 dict 列表"""
+    output: list[dict[str, Any]] = []
+    metadatas = results["metadatas"][query_index]
+    documents = results["documents"][query_index]
+    distances = results["distances"][query_index]
+
+    for i in range(len(results["ids"][query_index])):
+        result = {
+            "file_path": metadatas[i]["file_path"],
+            "chunk_index": metadatas[i].get("chunk_index"),
+            "chunk": documents[i],
+            "distance": distances[i],
+        }
+        refs = _split_refs(metadatas[i].get("refs"))
+        if refs:
+            result["shared_with"] = sorted({_parse_ref(r)[0] for r in refs})
+        output.append(result)
+
+    return output
+
+
+def extract_keywords(query: str, max_terms: int = KEYWORD_MAX_TERMS) -> list[str]:
+    """擷取關鍵字：英數詞直接使用，CJK 連續字串切成 bigram"""
+    terms: list[str] = []
+    for token in re.findall(r"[\w\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+", query):
+        cjk_runs = re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+", token)
+        if not cjk_runs:
+            if len(token) > 1:
+                terms.append(token)
+            continue
+        for run in cjk_runs:
+            terms += [run] if len(run) <= 2 else [run[i : i + 2] for i in range(len(run) - 1)]
+        terms += [
+            t for t in re.split(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+", token) if len(t) > 1
+        ]
+
+    unique = list(dict.fromkeys(terms))
+    return sorted(unique, key=len, reverse=True)[:max_terms]
+
+
+def mmr_order(query_vec: np.ndarray, vectors: np.ndarray, mmr_lambda: float = 0.5) -> list[int]:
+    """Maximal marginal relevance 排序，回傳候選的新順序"""
+    norm = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+    relevance = norm @ (query_vec / (np.linalg.norm(query_vec) + 1e-12))
+    pairwise = norm @ norm.T
+
+    selected: list[int] = []
+    remaining = list(range(len(vectors)))
+    while remaining:
+        if selected:
+            redundancy = pairwise[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[dict[str, Any]]], top_k: int, k: int = RRF_K
+) -> list[dict[str, Any]]:
+    """以 RRF 合併多組排序：score = Σ 1 / (k + rank)
+
+    同一個 chunk 保留最小的 distance，並加上 rrf_score。
+    """
+    scores: dict[tuple[str, Any], float] = {}
+    best: dict[tuple[str, Any], dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, r in enumerate(ranking, 1):
+            key = (r["file_path"], r["chunk_index"])
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+            if key not in best or r["distance"] < best[key]["distance"]:
+                best[key] = r
+
+    order = sorted(scores, key=lambda key: scores[key], reverse=True)[:top_k]
+    return [{**best[key], "rrf_score": round(scores[key], 6)} for key in order]
+
+
+def merge_adjacent_chunks(results: list[dict[str, Any]], top_k: int) -> list[dict[str, Any]]:
+    """依排名合併同檔案連續 chunk_index 的結果，最多回傳 top_k 段"""
+    passages: list[dict[str, Any]] = []
+    for r in results:
+        index = r.get("chunk_index")
+        target = None
+        if index is not None:
+            for p in passages:
+                if p["file_path"] == r["file_path"] and (
+                    index == p["chunk_indexes"][0] - 1 or index == p["chunk_indexes"][-1] + 1
+                ):
+                    target = p
+                    break
+
+        if target is not None:
+            if index < target["chunk_indexes"][0]:
+                target["chunk_indexes"].insert(0, index)
+                target["parts"].insert(0, r["chunk"])
+                target["chunk_index"] = index
+            else:
+                target["chunk_indexes"].append(index)
+                target["parts"].append(r["chunk"])
+            target["distance"] = min(target["distance"], r["distance"])
+        elif len(passages) < top_k:
+            passages.append({**r, "chunk_indexes": [index], "parts": [r["chunk"]]})
+
+    for p in passages:
+        p["chunk"] = "\n\n".join(p.pop("parts"))
+    return passages
+
+
 class ObsidianRAG:
     """Obsidian RAG 索引管理器"""
 
-    def __init__(self, vault_path: str | Path, db_path: str | Path | None = None, readonly: bool = False):
+    def __init__(
+        self,
+        vault_path: str | Path,
+        db_path: str | Path | None = None,
+        readonly: bool = False,
+        skip_blocks_path: str | Path | None = None,
+        collection: str = DEFAULT_COLLECTION,
+        embedding_function: EmbeddingFunction[Embeddable] | None = None,
+    ):
         self.vault_path = Path(vault_path).expanduser()
         self.db_path = Path(db_path).expanduser() if db_path else DB_PATH
         self.db_path.mkdir(parents=True, exist_ok=True)
+        self.collection_name = collection
 
         self.client = chromadb.PersistentClient(path=str(self.db_path))
 
         if readonly:
             # Stats only - no embedding needed
+            # 新的向量庫在第一次 sync 前也可能先跑 plan / fsck，必須用同樣的距離建立，
+            # 否則 collection 會以 L2 建立並沿用下去；也不能寫入預設 embedding function，
+            # 否則之後 sync 帶入的 embedding function 會與設定衝突
             self.embedding_fn = None
-            self.collection = self.client.get_or_create_collection(name="obsidian_vault")
+            self.collection = self.client.get_or_create_collection(
+                name=collection, metadata=COLLECTION_METADATA, embedding_function=None
+            )
         else:
-            self.embedding_fn = get_openai_embedding_function()
+            # 可注入其他 embedding function（例如離線 harness 的替身）
+            self.embedding_fn = embedding_function or get_openai_embedding_function()
             self.collection = self.client.get_or_create_collection(
-                name="obsidian_vault",
-                metadata={"hnsw:space": "cosine"},
+                name=collection,
+                metadata=COLLECTION_METADATA,
                 embedding_function=self.embedding_fn,
             )
 
-        self.meta_collection = self.client.get_or_create_collection(name="obsidian_meta")
+        # 預設 collection 沿用既有的 obsidian_meta 名稱
+        meta_name = "obsidian_meta" if collection == DEFAULT_COLLECTION else f"{collection}_meta"
+        if embedding_function is None and not readonly:
+            self.meta_collection = self.client.get_or_create_collection(name=meta_name)
+        else:
+            self.meta_collection = self.client.get_or_create_collection(
+                name=meta_name, embedding_function=embedding_function
+            )
+
+        # 相關筆記表（本地快取，不需要 embedding API）
+        self.related_path = self._state_path("related_notes.json")
+        self.related_vectors_path = self._state_path("related_vectors.npz")
+        self._related_table: dict[str, Any] | None = None
+
+        # 同步吞吐量紀錄（plan 用來估算時間）
+        self.sync_stats_path = self._state_path("sync_stats.json")
+        self._embedded_tokens = 0
+
+        # 查詢向量快取（embedding 逾時時可直接使用）
+        self.query_cache_path = self._state_path("query_cache.npz")
+        self._query_cache: dict[str, np.ndarray] | None = None
+
+        # 去重：重複的 chunk 只存一份，其他檔案記錄在 refs（"path#chunk_index"）
+        skip_path = (
+            Path(skip_blocks_path) if skip_blocks_path else self.vault_path / SKIP_BLOCKS_FILE
+        )
+        self.skip_blocks = load_skip_blocks(skip_path.expanduser())
+        self._dedup_index: DuplicateIndex | None = None
+        # 多段落 chunk 內的段落（id 為 "chunk_id/n"），用來發現跨筆記重複的模板段落
+        self._paragraph_index = DuplicateIndex()
+        self._deduplicated = 0
+        self._reowned: set[str] = set()  # 接手去重 chunk 的檔案，相關筆記需要重算
+
+    def _state_path(self, name: str) -> Path:
+        """本地狀態檔路徑（非預設 collection 加上前綴，讓多個 shard 共用 db_path）"""
+        if self.collection_name == DEFAULT_COLLECTION:
+            return self.db_path / name
+        return self.db_path / f"{self.collection_name}.{name}"
 
     def _get_file_mtime(self, file_path: Path) -> str:
         return datetime.fromtimestamp(file_path.stat().st_mtime, tz=timezone.utc).isoformat()
@@ -124,22 +499,115 @@ class ObsidianRAG:
             return str(mtime) if mtime is not None else None
         return None
 
-    def _update_stored_mtime(self, rel_path: str, mtime: str) -> None:
+    def _update_stored_mtime(
+        self,
+        rel_path: str,
+        mtime: str,
+        shared: list[str] | None = None,
+        chunk_count: int | None = None,
+    ) -> None:
+        meta: dict[str, Any] = {
+            "mtime": mtime,
+            "indexed_at": datetime.now(tz=timezone.utc).isoformat(),
+            "shared": "\n".join(shared or []),
+        }
+        if chunk_count is not None:
+            meta["chunk_count"] = chunk_count  # fsck 用來確認 chunks 沒有缺漏
         self.meta_collection.upsert(
             ids=[rel_path],
-            metadatas=[{"mtime": mtime, "indexed_at": datetime.now(tz=timezone.utc).isoformat()}],
+            metadatas=[meta],
             documents=[rel_path],
         )
 
+    def _build_dedup_index(self) -> DuplicateIndex:
+        index = DuplicateIndex()
+        self._paragraph_index = DuplicateIndex()
+        stored = self.collection.get(include=["metadatas"])  # type: ignore[list-item]
+        for chunk_id, meta in zip(stored["ids"], stored.get("metadatas") or [], strict=False):
+            if meta and meta.get("content_hash"):
+                index.add(chunk_id, str(meta["content_hash"]), _stored_fingerprint(meta))
+                self._add_paragraphs(chunk_id, meta)
+        return index
+
+    @property
+    def dedup_index(self) -> DuplicateIndex:
+        if self._dedup_index is None:
+            self._dedup_index = self._build_dedup_index()
+        return self._dedup_index
+
+    def _add_paragraphs(self, chunk_id: str, meta: Any) -> None:
+        """把 chunk metadata 記錄的段落指紋（"hash:simhash"）加入段落索引"""
+        version_ok = meta.get("simhash_version") == SIMHASH_VERSION
+        for n, entry in enumerate(_split_refs(meta.get("paragraphs"))):
+            digest, _, value = entry.partition(":")
+            fp = int(value, 16) if version_ok and value else None
+            self._paragraph_index.add(f"{chunk_id}/{n}", digest, fp)
+
+    def _forget_chunk(self, chunk_id: str, meta: Any) -> None:
+        self.dedup_index.remove(chunk_id)
+        for n in range(len(_split_refs(meta.get("paragraphs")))):
+            self._paragraph_index.remove(f"{chunk_id}/{n}")
+
+    def _is_shared_paragraph(self, paragraph: str) -> bool:
+        """段落是否已出現在其他 chunk（獨立的 chunk 或多段落 chunk 中的段落）"""
+        if len(paragraph) < PARAGRAPH_DEDUP_MIN_CHARS:
+            return False
+        digest = content_hash(paragraph)
+        fp, limit = fingerprint(paragraph)
+        return (
+            self.dedup_index.find(digest, fp, limit) is not None
+            or self._paragraph_index.find(digest, fp, limit) is not None
+        )
+
+    def _set_refs(self, chunk_id: str, meta: dict[str, Any], refs: list[str]) -> None:
+        self.collection.update(ids=[chunk_id], metadatas=[{**meta, "refs": "\n".join(refs)}])
+
+    def _get_shared(self, rel_path: str) -> list[str]:
+        result = self.meta_collection.get(ids=[rel_path], include=["metadatas"])  # type: ignore[list-item]
+        if result["metadatas"] and result["metadatas"][0]:
+            return _split_refs(result["metadatas"][0].get("shared"))
+        return []
+
+    def _remove_shared(self, rel_path: str, chunk_id: str) -> None:
+        result = self.meta_collection.get(ids=[rel_path], include=["metadatas"])  # type: ignore[list-item]
+        if not (result["metadatas"] and result["metadatas"][0]):
+            return
+        meta = dict(result["metadatas"][0])
+        meta["shared"] = "\n".join(i for i in _split_refs(meta.get("shared")) if i != chunk_id)
+        self.meta_collection.update(ids=[rel_path], metadatas=[meta])
+
     def _delete_file_chunks(self, rel_path: str) -> int:
-        results = self.collection.get(where={"file_path": rel_path})
-        if results["ids"]:
-            self.collection.delete(ids=results["ids"])
-            return len(results["ids"])
-        return 0
+        """刪除檔案的 chunks；仍被其他檔案引用的 chunk 轉移給下一個引用者"""
+        results = self.collection.get(where={"file_path": rel_path}, include=["metadatas"])  # type: ignore[list-item]
+        delete_ids: list[str] = []
+        delete_metas: list[Any] = []
+        for chunk_id, meta in zip(results["ids"], results.get("metadatas") or [], strict=False):
+            refs = [r for r in _split_refs(meta.get("refs")) if _parse_ref(r)[0] != rel_path]
+            if not refs:
+                delete_ids.append(chunk_id)
+                delete_metas.append(meta)
+                continue
+            owner, index = _parse_ref(refs[0])
+            self._set_refs(chunk_id, {**meta, "file_path": owner, "chunk_index": index}, refs[1:])
+            self._remove_shared(owner, chunk_id)
+            self._reowned.add(owner)
+
+        # 這個檔案引用的其他 chunks
+        shared_ids = self._get_shared(rel_path)
+        if shared_ids:
+            shared = self.collection.get(ids=shared_ids, include=["metadatas"])  # type: ignore[list-item]
+            for chunk_id, meta in zip(shared["ids"], shared.get("metadatas") or [], strict=False):
+                refs = [r for r in _split_refs(meta.get("refs")) if _parse_ref(r)[0] != rel_path]
+                self._set_refs(chunk_id, dict(meta), refs)
+
+        if delete_ids:
+            self.collection.delete(ids=delete_ids)
+            for chunk_id, meta in zip(delete_ids, delete_metas, strict=True):
+                self._forget_chunk(chunk_id, meta)
+        return len(results["ids"])
 
     def index_file(self, file_path: Path) -> int:
-        """索引單一檔案，回傳 chunk 數量"""
+        """索引單一檔案，回傳 chunk 數量（含去重後以引用方式記錄的 chunks）"""
         rel_path = str(file_path.relative_to(self.vault_path))
         current_mtime = self._get_file_mtime(file_path)
         stored_mtime = self._get_stored_mtime(rel_path)
@@ -155,42 +623,207 @@ class ObsidianRAG:
             print(f"  無法讀取 {rel_path}: {e}")
             return 0
 
-        chunks = chunk_text(content)
+        chunks = chunk_text(
+            content, skip_blocks=self.skip_blocks, isolate=self._is_shared_paragraph
+        )
         if not chunks:
             return 0
 
-        ids = [generate_chunk_id(rel_path, i) for i in range(len(chunks))]
-        metadatas = [
-            {"file_path": rel_path, "chunk_index": i, "mtime": current_mtime}
-            for i in range(len(chunks))
-        ]
+        ids: list[str] = []
+        documents: list[str] = []
+        metadatas: list[dict[str, Any]] = []
+        refs: dict[str, list[str]] = {}  # 既有 chunk id -> 新增的引用
+        for i, chunk in enumerate(chunks):
+            digest = content_hash(chunk)
+            fp, limit = fingerprint(chunk)
+            duplicate = self.dedup_index.find(digest, fp, limit)
+            if duplicate is not None:
+                refs.setdefault(duplicate, []).append(f"{rel_path}#{i}")
+                continue
 
-        self.collection.upsert(ids=ids, documents=chunks, metadatas=metadatas)  # type: ignore[arg-type]
-        self._update_stored_mtime(rel_path, current_mtime)
+            chunk_id = generate_chunk_id(rel_path, i, digest)
+            meta: dict[str, Any] = {
+                "file_path": rel_path,
+                "chunk_index": i,
+                "mtime": current_mtime,
+                "content_hash": digest,
+                "simhash": f"{fp:016x}",
+                "simhash_version": SIMHASH_VERSION,
+                "paragraphs": _paragraph_fingerprints(chunk),
+                "refs": "",
+            }
+            self.dedup_index.add(chunk_id, digest, fp)
+            self._add_paragraphs(chunk_id, meta)
+            ids.append(chunk_id)
+            documents.append(chunk)
+            metadatas.append(meta)
 
-        return len(ids)
+        # 同一檔案內的重複 chunk 也記成引用，寫入前先併入待寫入的 metadata
+        pending = dict(zip(ids, metadatas, strict=True))
+        for chunk_id in [c for c in refs if c in pending]:
+            pending[chunk_id]["refs"] = "\n".join(refs.pop(chunk_id))
 
-    def sync(self) -> dict[str, int]:
-        """同步整個 vault"""
-        stats = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+        if ids:
+            self.collection.upsert(ids=ids, documents=documents, metadatas=metadatas)  # type: ignore[arg-type]
+        if refs:
+            existing = self.collection.get(ids=list(refs), include=["metadatas"])  # type: ignore[list-item]
+            for chunk_id, meta in zip(
+                existing["ids"], existing.get("metadatas") or [], strict=False
+            ):
+                self._set_refs(chunk_id, dict(meta), _split_refs(meta.get("refs")) + refs[chunk_id])
 
-        all_meta = self.meta_collection.get()
-        indexed_files = set(all_meta["ids"]) if all_meta["ids"] else set()
+        self._update_stored_mtime(
+            rel_path, current_mtime, shared=sorted(refs), chunk_count=len(chunks)
+        )
+        self._embedded_tokens += sum(estimate_tokens(c) for c in documents)
+        self._deduplicated += len(chunks) - len(ids)
 
-        current_files = set()
+        return len(chunks)
+
+    def _scan_vault(self) -> dict[str, Path]:
+        """列出 vault 中需要索引的 markdown 檔案"""
+        files: dict[str, Path] = {}
         for md_file in self.vault_path.rglob("*.md"):
             if any(part.startswith(".") for part in md_file.parts):
                 continue
+            files[str(md_file.relative_to(self.vault_path))] = md_file
+        return files
 
-            rel_path = str(md_file.relative_to(self.vault_path))
-            current_files.add(rel_path)
+    def _load_manifest(self) -> dict[str, str]:
+        """一次取回所有已索引檔案的 mtime"""
+        return {
+            rel_path: str(meta.get("mtime"))
+            for rel_path, meta in self._load_manifest_entries().items()
+        }
+
+    def _load_manifest_entries(self) -> dict[str, dict[str, Any]]:
+        """一次取回所有已索引檔案的 manifest metadata"""
+        all_meta = self.meta_collection.get(include=["metadatas"])  # type: ignore[list-item]
+        metadatas = all_meta.get("metadatas") or []
+        return {
+            rel_path: dict(meta or {})
+            for rel_path, meta in zip(all_meta["ids"], metadatas, strict=False)
+        }
+
+    def _record_throughput(self, tokens: int, seconds: float) -> None:
+        """以移動平均記錄 embedding 吞吐量（tokens/sec）"""
+        if tokens <= 0 or seconds <= 0:
+            return
+        measured = tokens / seconds
+        previous = self._load_throughput()
+        if previous is not None:
+            measured = 0.7 * previous + 0.3 * measured
+        self.sync_stats_path.write_text(
+            json.dumps(
+                {
+                    "tokens_per_sec": round(measured, 1),
+                    "measured_at": datetime.now(tz=timezone.utc).isoformat(),
+                }
+            ),
+            encoding="utf-8",
+        )
+
+    def _load_throughput(self) -> float | None:
+        if not self.sync_stats_path.exists():
+            return None
+        data = json.loads(self.sync_stats_path.read_text(encoding="utf-8"))
+        return float(data["tokens_per_sec"])
+
+    def plan(self) -> dict[str, Any]:
+        """預估同步工作量：只做檔案/manifest 比對與切塊，不呼叫 embedding API
+
+        去重只以 content_hash 精確比對，不計算 SimHash（大量匯入時指紋是主要成本）；
+        近似重複在 sync 時才會發現，tokens 是上限估計（report["dedup"] == "exact"）。
+        """
+        manifest = self._load_manifest()
+        current = self._scan_vault()
+        stored = self.collection.get(include=["metadatas"])  # type: ignore[list-item]
+        deleted = manifest.keys() - current.keys()
+
+        # 既有（扣除將被取代的）chunks 與其中段落的 hash
+        chunks = {"add": 0, "update": 0, "delete": 0, "deduplicated": 0}
+        known: set[str] = set()
+        changed = {p for p, f in current.items() if manifest.get(p) != self._get_file_mtime(f)}
+        replaced = deleted | changed
+        for meta in stored.get("metadatas") or []:
+            if str(meta.get("file_path")) in replaced:
+                chunks["delete"] += 1
+            elif meta.get("content_hash"):
+                known.add(str(meta["content_hash"]))
+                known.update(e.partition(":")[0] for e in _split_refs(meta.get("paragraphs")))
+
+        def isolate(paragraph: str) -> bool:
+            return len(paragraph) >= PARAGRAPH_DEDUP_MIN_CHARS and content_hash(paragraph) in known
 
-            stored_mtime = self._get_stored_mtime(rel_path)
-            is_new = stored_mtime is None
+        tokens = 0
+        files = {"add": 0, "update": 0, "delete": 0, "unchanged": 0}
+        for rel_path, md_file in current.items():
+            if rel_path not in changed:
+                files["unchanged"] += 1
+                continue
+            try:
+                new_chunks = chunk_text(
+                    md_file.read_text(encoding="utf-8"),
+                    skip_blocks=self.skip_blocks,
+                    isolate=isolate,
+                )
+            except Exception:
+                new_chunks = []
+            if not new_chunks:
+                files["unchanged"] += 1
+                continue
+            files["update" if rel_path in manifest else "add"] += 1
+
+            # 與 sync 相同的順序：前面檔案的 chunks / 段落可讓後面的檔案去重
+            for chunk in new_chunks:
+                digest = content_hash(chunk)
+                if digest in known:
+                    chunks["deduplicated"] += 1
+                    continue
+                known.add(digest)
+                known.update(content_hash(p) for p in re.split(r"\n\n+", chunk))
+                chunks["update" if rel_path in manifest else "add"] += 1
+                tokens += estimate_tokens(chunk)
+
+        files["delete"] = len(deleted)
+
+        measured = self._load_throughput()
+        throughput = measured or DEFAULT_EMBED_TOKENS_PER_SEC
+        return {
+            "files": files,
+            "chunks": chunks,
+            "tokens": tokens,
+            "cost_usd": round(tokens / 1_000_000 * EMBEDDING_PRICE_PER_1M_TOKENS, 6),
+            "tokens_per_sec": throughput,
+            "throughput_measured": measured is not None,
+            "est_seconds": round(tokens / throughput, 1),
+            "embedding": EMBEDDING_MODEL,
+            "dedup": "exact",
+        }
 
+    def sync(self) -> dict[str, int]:
+        """同步整個 vault"""
+        stats = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0, "deduplicated": 0}
+        changed_files: set[str] = set()
+
+        manifest = self._load_manifest()
+        indexed_files = set(manifest)
+
+        current_files = set()
+        embed_seconds = 0.0
+        self._embedded_tokens = 0
+        self._deduplicated = 0
+        self._reowned = set()
+        for rel_path, md_file in self._scan_vault().items():
+            current_files.add(rel_path)
+            is_new = rel_path not in manifest
+
+            started = time.monotonic()
             chunks_indexed = self.index_file(md_file)
 
             if chunks_indexed > 0:
+                embed_seconds += time.monotonic() - started
+                changed_files.add(rel_path)
                 if is_new:
                     stats["added"] += 1
                     print(f"  + {rel_path} ({chunks_indexed} chunks)")
@@ -200,6 +833,9 @@ class ObsidianRAG:
             else:
                 stats["unchanged"] += 1
 
+        self._record_throughput(self._embedded_tokens, embed_seconds)
+        stats["deduplicated"] = self._deduplicated
+
         deleted_files = indexed_files - current_files
         for rel_path in deleted_files:
             deleted_chunks = self._delete_file_chunks(rel_path)
@@ -207,31 +843,490 @@ class ObsidianRAG:
             stats["deleted"] += 1
             print(f"  - {rel_path} ({deleted_chunks} chunks)")
 
+        # 擁有者被刪除或更新時，去重 chunk 轉移給其他引用的檔案，這些筆記也要重算
+        changed_files |= self._reowned - deleted_files
+        if changed_files or deleted_files or not self.related_path.exists():
+            self.update_related(changed_files, deleted_files)
+
         return stats
 
-    def search(self, query: str, top_k: int = 5) -> list[dict[str, Any]]:
-        """語意搜尋"""
+    # === 相關筆記索引 ===
+
+    def _load_note_vectors(self, files: list[str] | None = None) -> dict[str, np.ndarray]:
+        """從已存的 chunk embeddings 計算筆記層級向量（chunk 平均後正規化）
+
+        去重後只存一份的 chunk 同時算進擁有者與所有引用它的筆記，
+        內容全部重複的筆記也有向量。
+        """
+        grouped: dict[str, dict[str, np.ndarray]] = {}  # path -> chunk id -> embedding
+        wanted = set(files) if files is not None else None
+
+        def collect(where: dict[str, Any] | None = None, ids: list[str] | None = None) -> None:
+            result = self.collection.get(
+                ids=ids,
+                where=where,  # type: ignore[arg-type]
+                include=["embeddings", "metadatas"],  # type: ignore[list-item]
+            )
+            embeddings = result.get("embeddings")
+            metadatas = result.get("metadatas") or []
+            if embeddings is None:
+                return
+            for chunk_id, meta, emb in zip(result["ids"], metadatas, embeddings, strict=False):
+                paths = {str(meta["file_path"])}
+                paths.update(_parse_ref(r)[0] for r in _split_refs(meta.get("refs")))
+                for path in paths if wanted is None else paths & wanted:
+                    grouped.setdefault(path, {})[chunk_id] = np.asarray(emb)
+
+        if files is None:
+            collect()
+        else:
+            for start in range(0, len(files), FETCH_BATCH_SIZE):
+                batch = files[start : start + FETCH_BATCH_SIZE]
+                if not batch:
+                    continue
+                collect(where={"file_path": {"$in": batch}})
+                # 這些檔案引用（但不擁有）的 chunks
+                manifest = self.meta_collection.get(ids=batch, include=["metadatas"])  # type: ignore[list-item]
+                shared = sorted(
+                    {
+                        chunk_id
+                        for meta in manifest.get("metadatas") or []
+                        for chunk_id in _split_refs((meta or {}).get("shared"))
+                    }
+                )
+                for offset in range(0, len(shared), FETCH_BATCH_SIZE):
+                    collect(ids=shared[offset : offset + FETCH_BATCH_SIZE])
+
+        vectors: dict[str, np.ndarray] = {}
+        for path, by_chunk in grouped.items():
+            mat = np.vstack(list(by_chunk.values())).astype(np.float32)
+            mat /= np.linalg.norm(mat, axis=1, keepdims=True) + 1e-12
+            vec = mat.mean(axis=0)
+            vectors[path] = vec / (np.linalg.norm(vec) + 1e-12)
+        return vectors
+
+    @staticmethod
+    def _top_neighbors(
+        ids: list[str], matrix: np.ndarray, rows: list[int], top_k: int
+    ) -> dict[str, list[list[Any]]]:
+        """分塊矩陣乘法計算指定列的 top-k 鄰居"""
+        neighbors: dict[str, list[list[Any]]] = {}
+        k = min(top_k, len(ids) - 1)
+        if k <= 0:
+            return {ids[r]: [] for r in rows}
+
+        for start in range(0, len(rows), RELATED_BLOCK_SIZE):
+            block_rows = rows[start : start + RELATED_BLOCK_SIZE]
+            sims = matrix[block_rows] @ matrix.T
+            sims[np.arange(len(block_rows)), block_rows] = -np.inf
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            for i, row in enumerate(block_rows):
+                order = top[i][np.argsort(-sims[i, top[i]])]
+                neighbors[ids[row]] = [[ids[j], round(float(sims[i, j]), 4)] for j in order]
+        return neighbors
+
+    def _load_related(self) -> dict[str, Any] | None:
+        if self._related_table is None and self.related_path.exists():
+            try:
+                self._related_table = json.loads(self.related_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                return None  # 表損毀就整個重建
+        return self._related_table
+
+    def _save_related(self, ids: list[str], matrix: np.ndarray, table: dict[str, Any]) -> None:
+        # 與查詢快取相同：先寫暫存檔再替換，查詢 related 的程序不會讀到寫一半的檔案
+        vectors_tmp = self.related_vectors_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(vectors_tmp, ids=np.array(ids, dtype=object), matrix=matrix)
+        vectors_tmp.replace(self.related_vectors_path)
+        table_tmp = self.related_path.with_suffix(f".{os.getpid()}.tmp")
+        table_tmp.write_text(json.dumps(table, ensure_ascii=False), encoding="utf-8")
+        table_tmp.replace(self.related_path)
+        self._related_table = table
+
+    def rebuild_related(self, top_k: int = RELATED_TOP_K) -> int:
+        """完整重建相關筆記表，回傳筆記數"""
+        vectors = self._load_note_vectors()
+        ids = sorted(vectors)
+        matrix = np.vstack([vectors[i] for i in ids]) if ids else np.zeros((0, 0), dtype=np.float32)
+        table = {
+            "top_k": top_k,
+            "updated_at": datetime.now(tz=timezone.utc).isoformat(),
+            "neighbors": self._top_neighbors(ids, matrix, list(range(len(ids))), top_k),
+        }
+        self._save_related(ids, matrix, table)
+        return len(ids)
+
+    def update_related(
+        self, changed: set[str], deleted: set[str], top_k: int = RELATED_TOP_K
+    ) -> int:
+        """增量更新相關筆記表，回傳重新計算的列數
+
+        只有變更的筆記，以及鄰居清單中含有變更/刪除筆記的列需要完整重算；
+        其他列的 top-k 在未變更筆記間仍然成立，只需合併變更筆記的新分數。
+        """
+        table = self._load_related()
+        if table is None or table.get("top_k") != top_k or not self.related_vectors_path.exists():
+            return self.rebuild_related(top_k)
+
+        try:
+            with np.load(self.related_vectors_path, allow_pickle=True) as stored:
+                old_ids = [str(i) for i in stored["ids"]]
+                old_matrix = stored["matrix"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return self.rebuild_related(top_k)
+        # 兩個檔案分別替換，中途中斷時向量與表可能對不上
+        if set(old_ids) != set(table["neighbors"]):
+            return self.rebuild_related(top_k)
+        stale = changed | deleted
+
+        keep = [i for i, path in enumerate(old_ids) if path not in stale]
+        ids = [old_ids[i] for i in keep]
+        blocks = [old_matrix[keep]] if keep else []
+
+        fresh = self._load_note_vectors(sorted(changed))
+        new_ids = sorted(fresh)
+        ids += new_ids
+        blocks += [np.vstack([fresh[i] for i in new_ids])] if new_ids else []
+        matrix = np.vstack(blocks) if blocks else np.zeros((0, 0), dtype=np.float32)
+
+        neighbors: dict[str, list[list[Any]]] = table["neighbors"]
+        position = {path: i for i, path in enumerate(ids)}
+        dirty = set(new_ids)
+        for path in ids:
+            if path in dirty:
+                continue
+            if any(other in stale for other, _ in neighbors.get(path, [])):
+                dirty.add(path)
+
+        # 未受影響的列：合併變更筆記的新相似度
+        if new_ids:
+            new_rows = [position[i] for i in new_ids]
+            cross = matrix @ matrix[new_rows].T
+            for path in ids:
+                if path in dirty:
+                    continue
+                row = position[path]
+                merged = neighbors.get(path, []) + [
+                    [new_ids[j], round(float(cross[row, j]), 4)] for j in range(len(new_ids))
+                ]
+                merged.sort(key=lambda item: item[1], reverse=True)
+                neighbors[path] = merged[:top_k]
+
+        for path in deleted:
+            neighbors.pop(path, None)
+        neighbors.update(self._top_neighbors(ids, matrix, [position[p] for p in dirty], top_k))
+
+        table["neighbors"] = neighbors
+        table["updated_at"] = datetime.now(tz=timezone.utc).isoformat()
+        self._save_related(ids, matrix, table)
+        return len(dirty)
+
+    def related(self, rel_path: str, top_k: int = RELATED_TOP_K) -> list[dict[str, Any]]:
+        """查詢預先計算的相關筆記"""
+        table = self._load_related()
+        if table is None:
+            return []
+        return [
+            {"file_path": path, "similarity": score}
+            for path, score in table["neighbors"].get(rel_path, [])[:top_k]
+        ]
+
+    def fsck(self, repair: bool = False) -> dict[str, Any]:
+        """比對 manifest、chunk 與檔案系統，找出不一致並（可選）修復
+
+        - orphan_chunks: 檔案不在 manifest 或已不存在的 chunks（中斷的同步）；
+          仍被其他檔案引用的會轉移擁有者，其餘刪除
+        - duplicate_chunks: 同一檔案同一 chunk_index 的多餘 chunks
+        - stale_refs: 指向已不存在檔案的去重引用
+        - stale_meta: 檔案已刪除但仍在 manifest
+        - requeue: manifest 有紀錄但 chunks 缺漏的檔案（與 manifest 記錄的 chunk_count 比對；
+          舊 manifest 沒有 chunk_count 時只檢查 chunk_index 是否連續），
+          刪除 manifest 讓下次 sync 重新索引
+        """
+        manifest = self._load_manifest_entries()
+        current = self._scan_vault()
+        stored = self.collection.get(include=["metadatas"])  # type: ignore[list-item]
+
+        def alive(rel_path: str) -> bool:
+            return rel_path in manifest and rel_path in current
+
+        orphans: list[tuple[str, dict[str, Any], list[str]]] = []
+        duplicate_ids: list[str] = []
+        stale_refs: list[tuple[str, dict[str, Any], list[str]]] = []
+        by_file: dict[str, dict[int, list[tuple[str, str]]]] = {}  # path -> index -> (mtime, id)
+        referenced: dict[str, set[int]] = {}
+        for chunk_id, meta in zip(stored["ids"], stored.get("metadatas") or [], strict=False):
+            meta = dict(meta or {})
+            refs = _split_refs(meta.get("refs"))
+            live_refs = [r for r in refs if alive(_parse_ref(r)[0])]
+            for ref in live_refs:
+                path, index = _parse_ref(ref)
+                referenced.setdefault(path, set()).add(index)
+
+            rel_path = str(meta.get("file_path", ""))
+            if not alive(rel_path):
+                orphans.append((chunk_id, meta, live_refs))
+                continue
+            if len(live_refs) != len(refs):
+                stale_refs.append((chunk_id, meta, live_refs))
+            index = int(meta.get("chunk_index", -1))
+            entry = (str(meta.get("mtime", "")), chunk_id)
+            by_file.setdefault(rel_path, {}).setdefault(index, []).append(entry)
+
+        for indexes in by_file.values():
+            for entries in indexes.values():
+                # 保留最新的一份
+                duplicate_ids.extend(chunk_id for _, chunk_id in sorted(entries)[:-1])
+
+        requeue: list[str] = []
+        for rel_path, entry in manifest.items():
+            if rel_path not in current:
+                continue
+            covered = set(by_file.get(rel_path, {})) | referenced.get(rel_path, set())
+            expected = entry.get("chunk_count")
+            if expected is None:
+                expected = len(covered) or 1
+            if covered != set(range(int(expected))):
+                requeue.append(rel_path)
+
+        stale_meta = sorted(manifest.keys() - current.keys())
+        requeue.sort()
+
+        report: dict[str, Any] = {
+            "total_chunks": len(stored["ids"]),
+            "total_files": len(manifest),
+            "orphan_chunks": len(orphans),
+            "duplicate_chunks": len(duplicate_ids),
+            "stale_refs": len(stale_refs),
+            "stale_meta": len(stale_meta),
+            "requeue": requeue,
+            "repaired": False,
+        }
+
+        if repair:
+            self._reowned = set()
+            delete_ids = sorted(set(duplicate_ids) | {c for c, _, refs in orphans if not refs})
+            for start in range(0, len(delete_ids), FETCH_BATCH_SIZE):
+                self.collection.delete(ids=delete_ids[start : start + FETCH_BATCH_SIZE])
+            for chunk_id, meta, refs in stale_refs:
+                self._set_refs(chunk_id, meta, refs)
+            for chunk_id, meta, refs in orphans:
+                if refs:
+                    owner, index = _parse_ref(refs[0])
+                    self._set_refs(
+                        chunk_id, {**meta, "file_path": owner, "chunk_index": index}, refs[1:]
+                    )
+                    self._remove_shared(owner, chunk_id)
+                    self._reowned.add(owner)
+            for rel_path in requeue:
+                self._delete_file_chunks(rel_path)
+            meta_delete = stale_meta + requeue
+            for start in range(0, len(meta_delete), FETCH_BATCH_SIZE):
+                self.meta_collection.delete(ids=meta_delete[start : start + FETCH_BATCH_SIZE])
+            reowned = self._reowned - set(stale_meta) - set(requeue)
+            if stale_meta or reowned:
+                self.update_related(reowned, set(stale_meta))
+            self._dedup_index = None
+            report["repaired"] = True
+
+        return report
+
+    def _load_query_cache(self) -> dict[str, np.ndarray]:
+        if self._query_cache is None:
+            self._query_cache = {}
+            if self.query_cache_path.exists():
+                try:
+                    with np.load(self.query_cache_path, allow_pickle=True) as stored:
+                        for key, vec in zip(stored["keys"], stored["vectors"], strict=False):
+                            self._query_cache[str(key)] = vec
+                except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                    self._query_cache = {}  # 快取損毀就重新 embedding
+        return self._query_cache
+
+    def _save_query_cache(self) -> None:
+        cache = self._load_query_cache()
+        if not cache:
+            return
+        keys = list(cache)[-QUERY_CACHE_SIZE:]
+        # 每次 /api/rag 都是獨立程序：先寫暫存檔再替換，其他程序不會讀到寫一半的檔案
+        # （np.savez 會自動補 .npz，暫存檔名要以 .npz 結尾；加上 pid 避免同時寫入互相覆蓋）
+        tmp_path = self.query_cache_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(keys, dtype=object),
+            vectors=np.vstack([cache[k] for k in keys]),
+        )
+        tmp_path.replace(self.query_cache_path)
+
+    def embed_queries(
+        self, queries: list[str], timeout: float | None = None
+    ) -> list[np.ndarray] | None:
+        """批次取得查詢向量；快取未命中的查詢合併成一次 API 呼叫
+
+        embedding 在 daemon thread 執行，逾時後不會阻擋程序結束；
+        逾時或 API 失敗時回傳 None。
+        """
+        keys = [q.strip() for q in queries]
+        cache = self._load_query_cache()
+        missing = [k for k in dict.fromkeys(keys) if k not in cache]
+
+        if missing:
+            assert self.embedding_fn is not None
+            embedding_fn = self.embedding_fn
+            result: dict[str, Any] = {}
+
+            def run() -> None:
+                try:
+                    result["vectors"] = [
+                        np.asarray(v, dtype=np.float32) for v in embedding_fn(missing)
+                    ]
+                except Exception as e:
+                    result["error"] = e
+
+            worker = threading.Thread(target=run, daemon=True)
+            worker.start()
+            worker.join(timeout)
+
+            if "vectors" not in result:
+                reason = result.get("error") or f"逾時 {timeout}s"
+                print(f"  [search] 查詢 embedding 失敗 ({reason})，改用關鍵字搜尋", file=sys.stderr)
+                return None
+            cache.update(zip(missing, result["vectors"], strict=True))
+
+        for key in dict.fromkeys(keys):
+            cache[key] = cache.pop(key)  # LRU: 移到最後
+        if missing:
+            self._save_query_cache()
+        return [cache[k] for k in keys]
+
+    def embed_query(self, query: str, timeout: float | None = None) -> np.ndarray | None:
+        """取得查詢向量；逾時或 API 失敗時回傳 None"""
+        vectors = self.embed_queries([query], timeout)
+        return None if vectors is None else vectors[0]
+
+    def keyword_search(self, query: str, top_k: int = 5) -> list[dict[str, Any]]:
+        """本地關鍵字搜尋（不需 embedding），distance 為未命中關鍵字的比例"""
+        terms = extract_keywords(query)
+        if not terms:
+            return []
+
+        where_document: dict[str, Any] = (
+            {"$contains": terms[0]}
+            if len(terms) == 1
+            else {"$or": [{"$contains": t} for t in terms]}
+        )
+        found = self.collection.get(
+            where_document=where_document,  # type: ignore[arg-type]
+            include=["documents", "metadatas"],
+        )
+
+        scored: list[tuple[float, int, dict[str, Any]]] = []
+        documents = found.get("documents") or []
+        metadatas = found.get("metadatas") or []
+        for doc, meta in zip(documents, metadatas, strict=False):
+            lowered = doc.lower()
+            hits = sum(1 for t in terms if t.lower() in lowered)
+            frequency = sum(lowered.count(t.lower()) for t in terms)
+            result = {
+                "file_path": meta["file_path"],
+                "chunk_index": meta.get("chunk_index"),
+                "chunk": doc,
+                "distance": round(1 - hits / len(terms), 4),
+            }
+            scored.append((result["distance"], -frequency, result))
+
+        scored.sort(key=lambda item: (item[0], item[1]))
+        return [r for _, _, r in scored[:top_k]]
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 5,
+        mmr: bool = False,
+        mmr_lambda: float = MMR_LAMBDA,
+        merge_adjacent: bool = False,
+        fetch_k: int | None = None,
+        timeout: float | None = SEARCH_TIMEOUT,
+    ) -> list[dict[str, Any]]:
+        """語意搜尋
+
+        mmr / merge_adjacent 會先多取 fetch_k 個候選，在本地重新排序：
+        - mmr: maximal marginal relevance，降低彼此重疊的結果
+        - merge_adjacent: 同檔案連續 chunk_index 合併成一段
+
+        timeout: 查詢 embedding 的等待上限；逾時改用關鍵字搜尋，結果標記 degraded
+        """
+        query_vec = self.embed_query(query, timeout)
+        if query_vec is None:
+            candidates = self.keyword_search(query, fetch_k or top_k * SEARCH_FETCH_MULTIPLIER)
+            for r in candidates:
+                r["degraded"] = True
+            if merge_adjacent:
+                return merge_adjacent_chunks(candidates, top_k)
+            return candidates[:top_k]
+
+        return self.search_vector(query_vec, top_k, mmr, mmr_lambda, merge_adjacent, fetch_k)
+
+    def search_vector(
+        self,
+        query_vec: np.ndarray,
+        top_k: int = 5,
+        mmr: bool = False,
+        mmr_lambda: float = MMR_LAMBDA,
+        merge_adjacent: bool = False,
+        fetch_k: int | None = None,
+    ) -> list[dict[str, Any]]:
+        """以已計算好的查詢向量搜尋（本地操作，不呼叫 embedding API）"""
+        over_fetch = mmr or merge_adjacent
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if mmr else [])
+        results = self.collection.query(
+            query_embeddings=[query_vec],  # type: ignore[arg-type]
+            n_results=(fetch_k or top_k * SEARCH_FETCH_MULTIPLIER) if over_fetch else top_k,
+            include=include,  # type: ignore[arg-type]
+        )
+        candidates = _format_results(results)
+        embeddings = results.get("embeddings")
+
+        if mmr and candidates and embeddings is not None:
+            vectors = np.asarray(embeddings[0], dtype=np.float32)
+            order = mmr_order(query_vec, vectors, mmr_lambda)
+            candidates = [candidates[i] for i in order]
+
+        if merge_adjacent:
+            return merge_adjacent_chunks(candidates, top_k)
+        return candidates[:top_k]
+
+    def search_vectors(
+        self, query_vecs: list[np.ndarray], top_k: int = 5
+    ) -> list[list[dict[str, Any]]]:
+        """多個查詢向量一次查詢 collection，回傳各自的結果"""
         results = self.collection.query(
-            query_texts=[query],
+            query_embeddings=query_vecs,  # type: ignore[arg-type]
             n_results=top_k,
             include=["documents", "metadatas", "distances"],
         )
+        return [_format_results(results, i) for i in range(len(query_vecs))]
 
-        output: list[dict[str, Any]] = []
-        metadatas = results.get("metadatas") or [[]]
-        documents = results.get("documents") or [[]]
-        distances = results.get("distances") or [[]]
+    def search_multi(
+        self,
+        queries: list[str],
+        top_k: int = 5,
+        fetch_k: int | None = None,
+        timeout: float | None = SEARCH_TIMEOUT,
+    ) -> list[dict[str, Any]]:
+        """多個查詢（例如原問題加上改寫）一次 embedding、一次查詢，以 RRF 合併
 
-        for i in range(len(results["ids"][0])):
-            output.append(
-                {
-                    "file_path": metadatas[0][i]["file_path"],
-                    "chunk": documents[0][i],
-                    "distance": distances[0][i],
-                }
-            )
+        embedding 逾時時改用第一個查詢做關鍵字搜尋，結果標記 degraded。
+        """
+        query_vecs = self.embed_queries(queries, timeout)
+        if query_vecs is None:
+            results = self.keyword_search(queries[0], top_k)
+            for r in results:
+                r["degraded"] = True
+            return results
 
-        return output
+        rankings = self.search_vectors(query_vecs, fetch_k or top_k * SEARCH_FETCH_MULTIPLIER)
+        return reciprocal_rank_fusion(rankings, top_k)
 
     def stats(self) -> dict[str, Any]:
         """取得統計資訊"""
@@ -239,41 +1334,97 @@ class ObsidianRAG:
             "total_chunks": self.collection.count(),
             "total_files": self.meta_collection.count(),
             "db_path": str(self.db_path),
-            "embedding": "text-embedding-3-small",
+            "collection": self.collection_name,
+            "embedding": EMBEDDING_MODEL,
         }
 
 
 def main() -> None:
     import argparse
-    import json
-    import sys
 
     parser = argparse.ArgumentParser(description="Obsidian RAG 索引工具")
-    parser.add_argument("command", choices=["sync", "search", "stats"], help="執行的命令")
+    parser.add_argument(
+        "command", choices=["sync", "plan", "fsck", "search", "stats", "related"], help="執行的命令"
+    )
     parser.add_argument("--vault", default="~/obsidian", help="Vault 路徑")
     parser.add_argument("--db", default=None, help="ChromaDB 路徑")
     parser.add_argument("--query", "-q", help="搜尋查詢")
     parser.add_argument("--top-k", "-k", type=int, default=5, help="回傳數量")
+    parser.add_argument("--mmr", action="store_true", help="使用 MMR 提高結果多樣性")
+    parser.add_argument("--mmr-lambda", type=float, default=MMR_LAMBDA, help="MMR 相關性權重")
+    parser.add_argument("--merge", action="store_true", help="合併同檔案相鄰 chunks")
+    parser.add_argument(
+        "--timeout", type=float, default=SEARCH_TIMEOUT, help="查詢 embedding 等待上限（秒）"
+    )
+    parser.add_argument("--file", "-f", help="筆記路徑（related 用，相對於 vault）")
+    parser.add_argument("--rebuild", action="store_true", help="完整重建相關筆記表")
+    parser.add_argument(
+        "--skip-blocks", default=None, help=f"模板區塊設定檔（預設 <vault>/{SKIP_BLOCKS_FILE}）"
+    )
+    parser.add_argument("--repair", action="store_true", help="修復 fsck 找到的問題")
     parser.add_argument("--json", action="store_true", help="JSON 輸出")
 
     args = parser.parse_args()
 
-    # stats 不需要 API key，使用 readonly 模式
-    readonly = args.command == "stats"
-    rag = ObsidianRAG(args.vault, args.db, readonly=readonly)
+    # plan / fsck / stats / related 不需要 API key，使用 readonly 模式
+    readonly = args.command in ("plan", "fsck", "stats", "related")
+    rag = ObsidianRAG(args.vault, args.db, readonly=readonly, skip_blocks_path=args.skip_blocks)
 
     if args.command == "sync":
         if not args.json:
-            print(f"同步 {args.vault} (embedding: text-embedding-3-small) ...", file=sys.stderr)
+            print(f"同步 {args.vault} (embedding: {EMBEDDING_MODEL}) ...", file=sys.stderr)
         stats = rag.sync()
         if args.json:
             print(json.dumps(stats))
         else:
             print(
                 f"\n完成: +{stats['added']} *{stats['updated']} "
-                f"-{stats['deleted']} ={stats['unchanged']}"
+                f"-{stats['deleted']} ={stats['unchanged']} "
+                f"(去重 {stats['deduplicated']} chunks)"
+            )
+
+    elif args.command == "plan":
+        p = rag.plan()
+        if args.json:
+            print(json.dumps(p))
+        else:
+            f, c = p["files"], p["chunks"]
+            print(f"檔案: +{f['add']} *{f['update']} -{f['delete']} ={f['unchanged']}")
+            print(f"Chunks: +{c['add']} *{c['update']} -{c['delete']} (去重 {c['deduplicated']})")
+            print(f"預估 tokens: {p['tokens']:,} ({p['embedding']}，只計精確去重，為上限估計)")
+            print(f"預估費用: ${p['cost_usd']:.4f}")
+            source = "實測" if p["throughput_measured"] else "預設"
+            print(
+                f"預估時間: {p['est_seconds']:.1f} 秒 ({source} {p['tokens_per_sec']:.0f} tokens/s)"
             )
 
+    elif args.command == "fsck":
+        report = rag.fsck(repair=args.repair)
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False))
+        else:
+            print(f"Chunks: {report['total_chunks']}  檔案: {report['total_files']}")
+            print(f"孤兒 chunks: {report['orphan_chunks']}")
+            print(f"重複 chunks: {report['duplicate_chunks']}")
+            print(f"失效引用: {report['stale_refs']}")
+            print(f"過期 manifest: {report['stale_meta']}")
+            print(f"需重新索引: {len(report['requeue'])}")
+            for rel_path in report["requeue"]:
+                print(f"  ~ {rel_path}")
+            if report["repaired"]:
+                print("\n已修復，需重新索引的檔案會在下次 sync 處理")
+            elif any(
+                report[k]
+                for k in (
+                    "orphan_chunks",
+                    "duplicate_chunks",
+                    "stale_refs",
+                    "stale_meta",
+                    "requeue",
+                )
+            ):
+                print("\n使用 --repair 修復")
+
     elif args.command == "search":
         if not args.query:
             if args.json:
@@ -281,14 +1432,42 @@ def main() -> None:
             else:
                 print("請提供 --query 參數")
             return
-        results = rag.search(args.query, args.top_k)
+        results = rag.search(
+            args.query,
+            args.top_k,
+            mmr=args.mmr,
+            mmr_lambda=args.mmr_lambda,
+            merge_adjacent=args.merge,
+            timeout=args.timeout,
+        )
         if args.json:
             print(json.dumps(results))
         else:
+            if any(r.get("degraded") for r in results):
+                print("（embedding 逾時，以下為關鍵字搜尋結果）")
             for i, r in enumerate(results, 1):
                 print(f"\n--- {i}. {r['file_path']} (distance: {r['distance']:.4f}) ---")
                 print(r["chunk"][:200] + "..." if len(r["chunk"]) > 200 else r["chunk"])
 
+    elif args.command == "related":
+        if args.rebuild:
+            count = rag.rebuild_related()
+            if not args.file:
+                print(json.dumps({"notes": count}) if args.json else f"已重建: {count} 個筆記")
+                return
+        if not args.file:
+            if args.json:
+                print(json.dumps({"error": "file required"}))
+            else:
+                print("請提供 --file 參數")
+            return
+        related = rag.related(args.file, args.top_k)
+        if args.json:
+            print(json.dumps(related, ensure_ascii=False))
+        else:
+            for i, r in enumerate(related, 1):
+                print(f"{i}. {r['file_path']} (similarity: {r['similarity']:.4f})")
+
     elif args.command == "stats":
         s = rag.stats()
         if args.json:
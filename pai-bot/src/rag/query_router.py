@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""本地查詢路由 - 字元 n-gram 線性分類器，決定問題該走哪條路徑
+
+路徑（由便宜到昂貴）：
+- direct: 打招呼、閒聊、知識庫無法回答的指令，不檢索
+- keyword: 找檔名、標籤、精確字詞，只做本地關鍵字搜尋
+- vector: 單一事實的語意問題，向量檢索一次後直接生成
+- agentic: 比較、總結、多步推理，完整的 retrieve → grade → rewrite 迴圈
+
+模型是 hashed 字元 n-gram 特徵上的多類別 logistic regression，
+以 routing_examples.jsonl 的標註範例訓練，權重快取在向量庫目錄；
+單次路由只需要數十微秒。信心不足時走 agentic，寧可多花成本也不漏答。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Any, TypedDict
+
+import numpy as np
+from obsidian_rag import DB_PATH
+
+# Constants
+ROUTES = ("direct", "keyword", "vector", "agentic")
+FALLBACK_ROUTE = "agentic"
+ROUTING_EXAMPLES_FILE = Path(__file__).with_name("routing_examples.jsonl")
+ROUTER_CACHE_PATH = DB_PATH / "query_router.npz"  # 訓練好的權重，範例檔變更時重新訓練
+ROUTER_FEATURES = 2**12  # hashing trick 的特徵維度
+ROUTER_NGRAMS = (1, 2, 3)  # 字元 n-gram 長度（中文不需要斷詞）
+ROUTER_LENGTH_BUCKET = 8  # 問題長度特徵的級距（字元）；長問題多半需要多步推理
+ROUTER_ITERATIONS = 200
+ROUTER_LEARNING_RATE = 5.0
+ROUTER_L2 = 1e-4
+ROUTER_MIN_CONFIDENCE = 0.5  # 最高機率低於此值時走 FALLBACK_ROUTE
+
+
+class RoutingExample(TypedDict):
+    """路由標註範例"""
+
+    text: str
+    route: str
+
+
+def featurize(text: str) -> np.ndarray:
+    """特徵的 hash 索引：字元 n-gram（前後補空白）、空白分隔的詞、長度級距"""
+    normalized = " ".join(text.lower().split())
+    padded = f" {normalized} "
+    grams = [padded[i : i + n] for n in ROUTER_NGRAMS for i in range(len(padded) - n + 1)]
+    grams += [f"w:{word}" for word in normalized.split()]
+    grams.append(f"len:{min(len(normalized) // ROUTER_LENGTH_BUCKET, 10)}")
+    indices = {zlib.crc32(gram.encode()) % ROUTER_FEATURES for gram in grams}
+    return np.fromiter(indices, dtype=np.int64, count=len(indices))
+
+
+def _feature_matrix(texts: list[str]) -> np.ndarray:
+    """每列 L2 正規化的二元特徵，長短問題的 logits 尺度一致"""
+    matrix = np.zeros((len(texts), ROUTER_FEATURES), dtype=np.float32)
+    for row, text in enumerate(texts):
+        indices = featurize(text)
+        matrix[row, indices] = 1 / np.sqrt(len(indices))
+    return matrix
+
+
+def load_examples(path: str | Path = ROUTING_EXAMPLES_FILE) -> list[RoutingExample]:
+    examples: list[RoutingExample] = []
+    for line in Path(path).expanduser().read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        example = json.loads(line)
+        if example["route"] not in ROUTES:
+            raise ValueError(f"未知的路由: {example['route']}")
+        examples.append(example)
+    return examples
+
+
+class QueryRouter:
+    """字元 n-gram 線性分類器"""
+
+    def __init__(self, min_confidence: float = ROUTER_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self.weights = np.zeros((ROUTER_FEATURES, len(ROUTES)), dtype=np.float32)
+        self.bias = np.zeros(len(ROUTES), dtype=np.float32)
+
+    @classmethod
+    def load(
+        cls,
+        path: str | Path = ROUTING_EXAMPLES_FILE,
+        min_confidence: float = ROUTER_MIN_CONFIDENCE,
+        cache_path: Path | None = ROUTER_CACHE_PATH,
+    ) -> QueryRouter:
+        """載入路由器；權重快取與範例檔相符時直接使用，否則重新訓練並寫入快取"""
+        router = cls(min_confidence)
+        raw = Path(path).expanduser().read_bytes()
+        digest = hashlib.md5(f"{ROUTER_FEATURES}:{ROUTER_ITERATIONS}:".encode() + raw).hexdigest()
+
+        if cache_path is not None and cache_path.exists():
+            try:
+                with np.load(cache_path) as cached:
+                    if str(cached["digest"]) == digest:
+                        router.weights = cached["weights"]
+                        router.bias = cached["bias"]
+                        return router
+            except (OSError, ValueError, KeyError):
+                pass  # 快取損毀就重新訓練
+
+        router.train(load_examples(path))
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # np.savez 會自動補 .npz，暫存檔名要以 .npz 結尾
+            tmp_path = cache_path.with_suffix(".tmp.npz")
+            np.savez(tmp_path, weights=router.weights, bias=router.bias, digest=digest)
+            tmp_path.replace(cache_path)
+        return router
+
+    def train(self, examples: list[RoutingExample], iterations: int = ROUTER_ITERATIONS) -> None:
+        """全批次梯度下降訓練多類別 logistic regression（結果可重現）"""
+        features = _feature_matrix([e["text"] for e in examples])
+        targets = np.eye(len(ROUTES), dtype=np.float32)[
+            [ROUTES.index(e["route"]) for e in examples]
+        ]
+        weights = np.zeros_like(self.weights)
+        bias = np.zeros_like(self.bias)
+        for _ in range(iterations):
+            probs = _softmax(features @ weights + bias)
+            grad = (probs - targets) / len(examples)  # cross-entropy 對 logits 的梯度
+            weights -= ROUTER_LEARNING_RATE * (features.T @ grad + ROUTER_L2 * weights)
+            bias -= ROUTER_LEARNING_RATE * grad.sum(axis=0)
+        self.weights, self.bias = weights, bias
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """回傳 (分類結果, 機率)，不套用信心門檻"""
+        indices = featurize(text)
+        logits = self.weights[indices].sum(axis=0) / np.sqrt(len(indices)) + self.bias
+        probs = _softmax(logits[None, :])[0]
+        best = int(probs.argmax())
+        return ROUTES[best], float(probs[best])
+
+    def route(self, text: str) -> str:
+        """回傳路由；信心不足時走 FALLBACK_ROUTE"""
+        route, confidence = self.predict(text)
+        return route if confidence >= self.min_confidence else FALLBACK_ROUTE
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return np.asarray(exp / exp.sum(axis=1, keepdims=True))
+
+
+def evaluate(examples: list[RoutingExample], folds: int = 5) -> dict[str, Any]:
+    """k-fold 交叉驗證準確率與單次路由延遲"""
+    order = np.random.default_rng(0).permutation(len(examples))
+    correct = 0
+    confusion = {route: {r: 0 for r in ROUTES} for route in ROUTES}
+    for fold in range(folds):
+        held_out = set(order[fold::folds].tolist())
+        router = QueryRouter()
+        router.train([e for i, e in enumerate(examples) if i not in held_out])
+        for i in held_out:
+            predicted, _ = router.predict(examples[i]["text"])
+            confusion[examples[i]["route"]][predicted] += 1
+            correct += predicted == examples[i]["route"]
+
+    router = QueryRouter()
+    started = time.perf_counter()
+    router.train(examples)
+    train_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    for example in examples:
+        router.route(example["text"])
+    route_us = (time.perf_counter() - started) / len(examples) * 1_000_000
+
+    return {
+        "examples": len(examples),
+        "accuracy": round(correct / len(examples), 4),
+        "confusion": confusion,
+        "train_ms": round(train_ms, 1),
+        "route_us": round(route_us, 1),
+    }
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地查詢路由")
+    parser.add_argument("command", choices=["route", "eval"], help="執行的命令")
+    parser.add_argument("--question", "-q", help="要路由的問題")
+    parser.add_argument("--examples", default=str(ROUTING_EXAMPLES_FILE), help="標註範例檔")
+    parser.add_argument("--folds", type=int, default=5, help="eval 交叉驗證的 fold 數")
+    parser.add_argument("--json", action="store_true", help="輸出 JSON 格式")
+
+    args = parser.parse_args()
+
+    if args.command == "route":
+        if not args.question:
+            parser.error("route 需要 --question")
+        router = QueryRouter.load(args.examples)
+        predicted, confidence = router.predict(args.question)
+        result = {"route": router.route(args.question), "predicted": predicted}
+        result["confidence"] = round(confidence, 4)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"路由: {result['route']}（分類 {predicted}，機率 {confidence:.2f}）")
+
+    elif args.command == "eval":
+        report = evaluate(load_examples(args.examples), args.folds)
+        if args.json:
+            print(json.dumps(report))
+            return
+        print(f"範例數: {report['examples']}")
+        print(f"交叉驗證準確率: {report['accuracy']:.1%}")
+        print(f"訓練時間: {report['train_ms']:.1f} ms，單次路由: {report['route_us']:.1f} µs")
+        print("\n混淆矩陣（列為標註，欄為預測）:")
+        print("  " + "".join(f"{r:>9}" for r in ROUTES))
+        for route, row in report["confusion"].items():
+            print(f"  {route:<8}" + "".join(f"{row[r]:>9}" for r in ROUTES))
+        if report["accuracy"] < 0.8:
+            print("\n準確率偏低，建議補充標註範例", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
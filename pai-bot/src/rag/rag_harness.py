@@ -0,0 +1,863 @@
+#!/usr/bin/env python3
+"""Agentic RAG 離線 harness - 以確定性替身取代 LLM 與 embedding，量測延遲與重試行為
+
+不需要 Gemini / OpenAI API：
+- FakeEmbeddingFunction: hashed bag-of-words 向量，可設定每次呼叫的延遲
+- FakeChatModel: 可設定延遲與相關比例的 chat model（評分、改寫、fan-out、生成、串流）
+- build_vault / make_questions: 產生合成 vault 與問題集
+- FakeBotApi: bot 的 /api/memory/search、/api/history/search 本地 HTTP 替身（federated 檢索用）
+- FakeCrossEncoder: 重排序模型替身，以設定的準確率與 FakeChatModel 的相關判定一致
+
+報告每個節點的延遲、重試次數、LLM 呼叫次數與 token 成本、端對端 p50/p99，
+用來在本機調整距離門檻、檢索模式、生成模型路由與並行度。
+
+範例：
+
+    python rag_harness.py --notes 200 --questions 100 --concurrency 8 --relevance 0.3
+    python rag_harness.py --compare-model-routing  # 生成模型路由開 / 關的延遲與成本
+    python rag_harness.py --rerank --relevance 0.3  # cross-encoder 重排序
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from collections.abc import AsyncIterator, Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from agentic_rag import (
+    GRADE_IRRELEVANT_DISTANCE,
+    GRADE_RELEVANT_DISTANCE,
+    MAX_RETRIES,
+    QUERY_CONCURRENCY,
+    RETRIEVAL_MODES,
+    AgenticRAG,
+)
+from chromadb.api.types import Embeddable, EmbeddingFunction
+from federated_rag import SOURCE_TIMEOUT, HistorySource, MemorySource, VaultSource
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable, RunnableLambda
+from obsidian_rag import ObsidianRAG, estimate_tokens, extract_keywords
+from pydantic import PrivateAttr
+from reranker import RERANK_BUDGET, CrossEncoderReranker
+
+# Constants
+FAKE_EMBEDDING_DIM = 64
+HARNESS_TOPICS = [
+    "docker",
+    "kubernetes",
+    "python",
+    "rust",
+    "obsidian",
+    "ansible",
+    "langgraph",
+    "chromadb",
+    "postgres",
+    "redis",
+    "nginx",
+    "tailscale",
+]
+HARNESS_FILLER = "設定 部署 筆記 範例 問題 排查 效能 紀錄 指令 架構 版本 備份".split()
+DIRECT_QUESTION_RATE = 0.05  # 合成問題中走 direct 路徑（打招呼）的比例
+# 成本估算用的牌價（USD / 百萬 tokens，輸入與輸出）：gemini-2.5-flash-lite / gemini-2.5-flash
+MODEL_PRICES = {"lite": (0.10, 0.40), "main": (0.30, 2.50)}
+
+
+def _unit(*parts: object) -> float:
+    """由輸入決定的 [0, 1) 亂數，同樣的輸入永遠得到同樣的值"""
+    digest = hashlib.md5("\x1f".join(map(str, parts)).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    arr = np.asarray(values)
+    return {
+        "count": len(values),
+        "mean": round(float(arr.mean()), 2),
+        "p50": round(float(np.percentile(arr, 50)), 2),
+        "p99": round(float(np.percentile(arr, 99)), 2),
+        "max": round(float(arr.max()), 2),
+    }
+
+
+class FakeEmbeddingFunction(EmbeddingFunction[Embeddable]):
+    """hashed bag-of-words embedding；共用詞越多距離越近"""
+
+    def __init__(self, latency: float = 0.0, dim: int = FAKE_EMBEDDING_DIM):
+        self.latency = latency
+        self.dim = dim
+        self.calls = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Embeddable) -> Any:
+        with self._lock:
+            self.calls += 1
+            self.texts += len(input)
+        if self.latency:
+            time.sleep(self.latency)  # 一次 API 呼叫的延遲，與批次大小無關
+        vectors = []
+        for text in input:
+            vec = np.zeros(self.dim, dtype=np.float32)
+            for word in re.findall(r"\w+", str(text).lower()):
+                vec[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1
+            vectors.append(vec / (np.linalg.norm(vec) or 1.0))
+        return vectors
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = 0
+            self.texts = 0
+
+    @staticmethod
+    def name() -> str:
+        return "harness-fake"
+
+    def get_config(self) -> dict[str, Any]:
+        return {"dim": self.dim}
+
+    @staticmethod
+    def build_from_config(config: dict[str, Any]) -> FakeEmbeddingFunction:
+        return FakeEmbeddingFunction(dim=config.get("dim", FAKE_EMBEDDING_DIM))
+
+
+class FakeChatModel(BaseChatModel):
+    """確定性的 chat model 替身
+
+    - latency/jitter: 每次呼叫的延遲（秒）與上下浮動比例，由 prompt 決定所以可重現
+    - relevance: 評分時回答 yes 的比例（依 (seed, 問題, 文件) 決定）
+    - 支援 with_structured_output 的 RelevanceGrade、RewrittenQuery、FanoutQueries
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    relevance: float = 0.5
+    seed: int = 0
+    _calls: Counter[str] = PrivateAttr(default_factory=Counter)
+    _tokens: Counter[str] = PrivateAttr(default_factory=Counter)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "harness-fake"
+
+    @property
+    def calls(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._calls)
+
+    @property
+    def tokens(self) -> dict[str, int]:
+        with self._lock:
+            return {"input": self._tokens["input"], "output": self._tokens["output"]}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._calls.clear()
+            self._tokens.clear()
+
+    def _count(self, kind: str) -> None:
+        with self._lock:
+            self._calls[kind] += 1
+
+    def _bill(self, prompt: str, output: str) -> None:
+        """以估計的 token 數累計用量（成本估算用）"""
+        with self._lock:
+            self._tokens["input"] += estimate_tokens(prompt)
+            self._tokens["output"] += estimate_tokens(output)
+
+    def _delay(self, key: str) -> float:
+        return max(0.0, self.latency * (1 + self.jitter * (2 * _unit(self.seed, key) - 1)))
+
+    # === Structured output ===
+
+    def _structured(self, schema: type[Any], text: str) -> Any:
+        name = schema.__name__
+        if name == "RelevanceGrade":
+            match = re.search(r"文件內容:\n(.*)\n\n問題: (.*)", text, re.DOTALL)
+            document, question = match.groups() if match else (text, "")
+            relevant = _unit(self.seed, question.strip(), document.strip()) < self.relevance
+            return schema(binary_score="yes" if relevant else "no")
+        question = re.search(r"原始問題: (.*)", text)
+        original = question.group(1).strip() if question else text.strip()
+        if name == "RewrittenQuery":
+            return schema(query=f"{original} {HARNESS_FILLER[int(_unit(original) * 12)]}")
+        if name == "FanoutQueries":
+            count = re.search(r"改寫成 (\d+) 個", text)
+            n = int(count.group(1)) if count else 3
+            return schema(queries=[f"{original} {HARNESS_FILLER[i]}" for i in range(n)])
+        raise ValueError(f"harness 不支援的 structured output: {name}")
+
+    def with_structured_output(  # type: ignore[override]
+        self, schema: type[Any], **kwargs: Any
+    ) -> Runnable[Any, Any]:
+        def text_of(prompt: Any) -> str:
+            if hasattr(prompt, "to_string"):
+                return str(prompt.to_string())
+            return str(prompt)
+
+        def invoke(prompt: Any) -> Any:
+            text = text_of(prompt)
+            self._count(schema.__name__)
+            time.sleep(self._delay(text))
+            result = self._structured(schema, text)
+            self._bill(text, result.model_dump_json())
+            return result
+
+        async def ainvoke(prompt: Any) -> Any:
+            text = text_of(prompt)
+            self._count(schema.__name__)
+            await asyncio.sleep(self._delay(text))
+            result = self._structured(schema, text)
+            self._bill(text, result.model_dump_json())
+            return result
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+    # === Generation ===
+
+    def _answer_tokens(self, messages: list[BaseMessage]) -> list[str]:
+        text = str(messages[-1].content)
+        question = re.search(r"問題: (.*)", text)
+        sources = re.findall(r"來源: (\S+)", text)
+        tokens = ["根據", "檢索到的", "筆記，", *(question.group(1).split() if question else [])]
+        return [*tokens, "\n\n參考:", *sources]
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self._count("generate")
+        time.sleep(self._delay(str(messages[-1].content)))
+        content = " ".join(self._answer_tokens(messages))
+        self._bill(str(messages[-1].content), content)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self._count("generate")
+        await asyncio.sleep(self._delay(str(messages[-1].content)))
+        content = " ".join(self._answer_tokens(messages))
+        self._bill(str(messages[-1].content), content)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        self._count("generate")
+        tokens = self._answer_tokens(messages)
+        self._bill(str(messages[-1].content), " ".join(tokens))
+        per_token = self._delay(str(messages[-1].content)) / len(tokens)
+        for token in tokens:
+            time.sleep(per_token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=f"{token} "))
+            if run_manager:
+                run_manager.on_llm_new_token(f"{token} ", chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        self._count("generate")
+        tokens = self._answer_tokens(messages)
+        self._bill(str(messages[-1].content), " ".join(tokens))
+        per_token = self._delay(str(messages[-1].content)) / len(tokens)
+        for token in tokens:
+            await asyncio.sleep(per_token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=f"{token} "))
+            if run_manager:
+                await run_manager.on_llm_new_token(f"{token} ", chunk=chunk)
+            yield chunk
+
+
+# === Synthetic data ===
+
+
+def build_vault(vault_path: Path, notes: int, seed: int = 0) -> int:
+    """產生合成 vault：每篇筆記一個主題，段落混入次要主題與填充詞"""
+    rnd = random.Random(seed)
+    vault_path.mkdir(parents=True, exist_ok=True)
+    for i in range(notes):
+        topic = HARNESS_TOPICS[i % len(HARNESS_TOPICS)]
+        paragraphs = []
+        for _ in range(rnd.randint(2, 6)):
+            words = [topic] * 6 + rnd.sample(HARNESS_TOPICS, 2) + rnd.choices(HARNESS_FILLER, k=24)
+            rnd.shuffle(words)
+            paragraphs.append(" ".join(words) + "。")
+        folder = vault_path / topic
+        folder.mkdir(exist_ok=True)
+        (folder / f"{topic}-{i:04d}.md").write_text(
+            f"# {topic} 筆記 {i}\n\n" + "\n\n".join(paragraphs) + "\n", encoding="utf-8"
+        )
+    return notes
+
+
+def make_questions(count: int, seed: int = 0) -> list[str]:
+    """產生合成問題集（少量打招呼，其餘為單主題或雙主題問題）"""
+    rnd = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        if rnd.random() < DIRECT_QUESTION_RATE:
+            questions.append("你好")
+            continue
+        first, second = rnd.sample(HARNESS_TOPICS, 2)
+        if rnd.random() < 0.5:
+            questions.append(f"{first} {rnd.choice(HARNESS_FILLER)} 怎麼做？")
+        else:
+            questions.append(f"{first} 和 {second} 的 {rnd.choice(HARNESS_FILLER)} 差異？")
+    return questions
+
+
+class FakeCrossEncoder:
+    """cross-encoder 替身：以 accuracy 的機率與 FakeChatModel 的相關判定一致
+
+    延遲與配對數成正比（CPU 推論）；相同判定的候選以 (問題, 段落) 決定的亂數排序。
+    """
+
+    def __init__(
+        self, latency: float = 0.0, accuracy: float = 0.8, relevance: float = 0.5, seed: int = 0
+    ):
+        self.latency = latency
+        self.accuracy = accuracy
+        self.relevance = relevance
+        self.seed = seed
+
+    def __call__(self, pairs: list[tuple[str, str]]) -> list[float]:
+        time.sleep(self.latency * len(pairs))
+        scores = []
+        for question, chunk in pairs:
+            relevant = _unit(self.seed, question.strip(), chunk.strip()) < self.relevance
+            correct = _unit("rerank", self.seed, question, chunk) < self.accuracy
+            scores.append(float(relevant == correct) + 0.5 * _unit("tie", question, chunk))
+        return scores
+
+
+class FakeBotApi:
+    """bot API 的本地 HTTP 替身：合成的短期記憶與歷史紀錄，可設定各端點延遲"""
+
+    def __init__(self, memory_latency: float = 0.0, history_latency: float = 0.0, seed: int = 0):
+        rnd = random.Random(seed)
+        self.memories = [
+            {
+                "id": i,
+                "content": f"使用者偏好 {rnd.choice(HARNESS_TOPICS)} 的"
+                f" {rnd.choice(HARNESS_FILLER)} 方式",
+                "category": "preference",
+                "importance": rnd.randint(1, 5),
+            }
+            for i in range(50)
+        ]
+        self.history = [
+            {
+                "filename": f"2025-01-{i % 28 + 1:02d}_{i}.md",
+                "type": rnd.choice(["sessions", "learnings", "decisions"]),
+                "summary": f"討論 {rnd.choice(HARNESS_TOPICS)} 與 {rnd.choice(HARNESS_TOPICS)}"
+                f" 的 {rnd.choice(HARNESS_FILLER)}",
+                "date": f"2025-01-{i % 28 + 1:02d}",
+            }
+            for i in range(50)
+        ]
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, payload: dict[str, Any]) -> None:
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                time.sleep(memory_latency)
+                terms = body.get("keywords") or extract_keywords(body.get("query", ""))
+                scored = [
+                    (sum(t.lower() in m["content"].lower() for t in terms), m) for m in api.memories
+                ]
+                memories = [m for hits, m in sorted(scored, key=lambda e: -e[0]) if hits]
+                memories = memories[: body.get("limit", 10)]
+                self._send({"ok": True, "count": len(memories), "memories": memories})
+
+            def do_GET(self) -> None:
+                params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                query = params.get("query", [""])[0].lower()
+                limit = int(params.get("limit", ["10"])[0])
+                time.sleep(history_latency)
+                items = [h for h in api.history if query in h["summary"].lower()]
+                self._send({"items": items[:limit]})
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# === Runner ===
+
+
+class Harness:
+    """在合成 vault 上以替身元件執行 Agentic RAG 圖"""
+
+    def __init__(
+        self,
+        workdir: Path,
+        notes: int = 100,
+        seed: int = 0,
+        embed_latency: float = 0.0,
+        lite_latency: float = 0.0,
+        main_latency: float = 0.0,
+        jitter: float = 0.0,
+        relevance: float = 0.5,
+        max_retries: int = MAX_RETRIES,
+        retrieval: str = "loop",
+        relevant_distance: float = GRADE_RELEVANT_DISTANCE,
+        irrelevant_distance: float = GRADE_IRRELEVANT_DISTANCE,
+        memory_latency: float = 0.0,
+        history_latency: float = 0.0,
+        source_timeout: float = SOURCE_TIMEOUT,
+        deadline: float | None = None,
+        model_routing: bool = True,
+        rerank: bool = False,
+        rerank_latency: float = 0.0,
+        rerank_accuracy: float = 0.8,
+    ):
+        vault_path = workdir / "vault"
+        if not vault_path.exists():
+            build_vault(vault_path, notes, seed)
+
+        self.embedder = FakeEmbeddingFunction(latency=embed_latency)
+        self.lite_llm = FakeChatModel(
+            latency=lite_latency, jitter=jitter, relevance=relevance, seed=seed
+        )
+        self.main_llm = FakeChatModel(
+            latency=main_latency, jitter=jitter, relevance=relevance, seed=seed
+        )
+        self.rag = ObsidianRAG(vault_path, db_path=workdir / "db", embedding_function=self.embedder)
+        self.api: FakeBotApi | None = None
+        sources = None
+        if retrieval == "federated":
+            self.api = FakeBotApi(memory_latency, history_latency, seed)
+            sources = [
+                VaultSource(self.rag),
+                MemorySource(self.api.url, "", source_timeout),
+                HistorySource(self.api.url, "", source_timeout),
+            ]
+        self.reranker = (
+            CrossEncoderReranker(
+                budget=RERANK_BUDGET,
+                scorer=FakeCrossEncoder(rerank_latency, rerank_accuracy, relevance, seed),
+            )
+            if rerank
+            else None
+        )
+        self.agent = AgenticRAG(
+            vault_path,
+            max_retries,
+            rag=self.rag,
+            lite_llm=self.lite_llm,
+            main_llm=self.main_llm,
+            use_cache=False,
+            retrieval=retrieval,
+            grade_thresholds={"relevant": relevant_distance, "irrelevant": irrelevant_distance},
+            sources=sources,
+            deadline=deadline,
+            model_routing=model_routing,
+            reranker=self.reranker,
+        )
+
+    def close(self) -> None:
+        if self.api is not None:
+            self.api.close()
+
+    def index(self) -> dict[str, int]:
+        """建立索引（同步輸出導到 stderr，stdout 留給報告）"""
+        with contextlib.redirect_stdout(sys.stderr):
+            stats = self.rag.sync()
+        return stats
+
+    def reset_counters(self) -> None:
+        self.embedder.reset()
+        self.lite_llm.reset()
+        self.main_llm.reset()
+        if self.reranker is not None:
+            self.reranker.stats = dict.fromkeys(self.reranker.stats, 0)
+
+    def _trace(
+        self, question: str, started: float, steps: list[tuple[str, float]], state: dict[str, Any]
+    ) -> dict[str, Any]:
+        return {
+            "question": question,
+            "total_ms": (time.perf_counter() - started) * 1000,
+            "nodes": steps,
+            "retry_count": state.get("retry_count", 0),
+            "documents": len(state.get("documents") or []),
+            "sources": state.get("source_stats"),
+            "shortcuts": state.get("shortcuts") or [],
+            "model": state.get("generation_model"),
+        }
+
+    def run_one(self, question: str) -> dict[str, Any]:
+        """同步執行一個問題（與 CLI query 相同的路徑）；節點依序執行，更新間隔即節點延遲"""
+        started = last = time.perf_counter()
+        steps: list[tuple[str, float]] = []
+        state: dict[str, Any] = {}
+        for update in self.agent.graph.stream(
+            self.agent.initial_state(question), stream_mode="updates"
+        ):
+            now = time.perf_counter()
+            for node, values in update.items():
+                steps.append((node, (now - last) * 1000))
+                state.update(values or {})
+            last = now
+        return self._trace(question, started, steps, state)
+
+    async def arun_one(self, question: str) -> dict[str, Any]:
+        """非同步執行一個問題（與 query_many 相同的路徑）"""
+        started = last = time.perf_counter()
+        steps: list[tuple[str, float]] = []
+        state: dict[str, Any] = {}
+        async for update in self.agent.graph.astream(
+            self.agent.initial_state(question), stream_mode="updates"
+        ):
+            now = time.perf_counter()
+            for node, values in update.items():
+                steps.append((node, (now - last) * 1000))
+                state.update(values or {})
+            last = now
+        return self._trace(question, started, steps, state)
+
+    async def arun(self, questions: list[str], concurrency: int) -> list[dict[str, Any]]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(question: str) -> dict[str, Any]:
+            async with semaphore:
+                return await self.arun_one(question)
+
+        return await asyncio.gather(*(run(q) for q in questions))
+
+    def run(
+        self, questions: list[str], concurrency: int = QUERY_CONCURRENCY, sync: bool = False
+    ) -> dict[str, Any]:
+        """執行問題集並彙整報告"""
+        self.reset_counters()
+        started = time.perf_counter()
+        if sync:
+            traces = [self.run_one(q) for q in questions]
+        else:
+            traces = asyncio.run(self.arun(questions, concurrency))
+        elapsed = time.perf_counter() - started
+        return self.report(traces, elapsed, concurrency=1 if sync else concurrency)
+
+    def report(
+        self, traces: list[dict[str, Any]], elapsed: float, concurrency: int
+    ) -> dict[str, Any]:
+        node_ms: dict[str, list[float]] = {}
+        for trace in traces:
+            for node, ms in trace["nodes"]:
+                node_ms.setdefault(node, []).append(ms)
+        generation_ms: dict[str, list[float]] = {}
+        for trace in traces:
+            for node, ms in trace["nodes"]:
+                if node == "generate" and trace["model"]:
+                    generation_ms.setdefault(trace["model"], []).append(ms)
+        retries = Counter(trace["retry_count"] for trace in traces)
+        shortcuts = Counter(name for trace in traces for name in trace["shortcuts"])
+        source_ms: dict[str, list[float]] = {}
+        source_status: dict[str, Counter[str]] = {}
+        for trace in traces:
+            for name, source in (trace["sources"] or {}).items():
+                source_ms.setdefault(name, []).append(source["ms"])
+                source_status.setdefault(name, Counter())[source["status"]] += 1
+        lite_calls = self.lite_llm.calls
+        main_calls = self.main_llm.calls
+        tokens = {"lite": self.lite_llm.tokens, "main": self.main_llm.tokens}
+        cost = {
+            model: round(
+                (usage["input"] * MODEL_PRICES[model][0] + usage["output"] * MODEL_PRICES[model][1])
+                / 1_000_000,
+                6,
+            )
+            for model, usage in tokens.items()
+        }
+        return {
+            "questions": len(traces),
+            "concurrency": concurrency,
+            "retrieval": self.agent.retrieval,
+            "model_routing": self.agent.model_routing,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_qps": round(len(traces) / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": _percentiles([trace["total_ms"] for trace in traces]),
+            "nodes_ms": {node: _percentiles(ms) for node, ms in sorted(node_ms.items())},
+            "routes": dict(Counter(trace["nodes"][0][0] for trace in traces if trace["nodes"])),
+            "retries": {
+                "total": sum(trace["retry_count"] for trace in traces),
+                "max": max(retries, default=0),
+                "distribution": {str(k): v for k, v in sorted(retries.items())},
+            },
+            "llm_calls": {
+                "lite": lite_calls,
+                "main": main_calls,
+                "total": sum(lite_calls.values()) + sum(main_calls.values()),
+            },
+            "tokens": tokens,
+            "cost_usd": {**cost, "total": round(sum(cost.values()), 6)},
+            "generation_ms": {
+                model: _percentiles(ms) for model, ms in sorted(generation_ms.items())
+            },
+            "embedding_calls": {"calls": self.embedder.calls, "texts": self.embedder.texts},
+            "rerank": dict(self.reranker.stats) if self.reranker is not None else None,
+            "sources": {
+                name: {**_percentiles(ms), "status": dict(source_status[name])}
+                for name, ms in sorted(source_ms.items())
+            },
+            "deadline_s": self.agent.deadline,
+            "shortcuts": dict(shortcuts),
+            "empty_results": sum(
+                trace["documents"] == 0 and trace["nodes"][0][0] != "direct" for trace in traces
+            ),
+        }
+
+
+def print_report(report: dict[str, Any]) -> None:
+    latency = report["latency_ms"]
+    print(
+        f"問題數: {report['questions']}（並行 {report['concurrency']}，"
+        f"檢索模式 {report['retrieval']}）"
+    )
+    print(f"總時間: {report['elapsed_s']:.2f} s（{report['throughput_qps']:.2f} q/s）")
+    print(
+        f"端對端延遲: p50 {latency['p50']:.1f} ms / p99 {latency['p99']:.1f} ms"
+        f" / max {latency['max']:.1f} ms"
+    )
+    print(f"起始路徑: {report['routes']}")
+    print("\n節點延遲 (ms):")
+    for node, s in report["nodes_ms"].items():
+        print(
+            f"  {node:<10} x{s['count']:<5} mean {s['mean']:>8.1f}"
+            f"  p50 {s['p50']:>8.1f}  p99 {s['p99']:>8.1f}"
+        )
+    retries = report["retries"]
+    print(f"\n重試: 共 {retries['total']} 次，分布 {retries['distribution']}")
+    calls = report["llm_calls"]
+    print(f"LLM 呼叫: {calls['total']} 次（lite {calls['lite']}，main {calls['main']}）")
+    cost = report["cost_usd"]
+    print(
+        f"估計成本: ${cost['total']:.4f}（lite ${cost['lite']:.4f}，main ${cost['main']:.4f}；"
+        f"tokens {report['tokens']}）"
+    )
+    if report["generation_ms"]:
+        print("生成延遲 (ms，依模型):")
+        for model, s in report["generation_ms"].items():
+            print(f"  {model:<10} x{s['count']:<5} mean {s['mean']:>8.1f}  p99 {s['p99']:>8.1f}")
+    embedding = report["embedding_calls"]
+    print(f"Embedding 呼叫: {embedding['calls']} 次（{embedding['texts']} 個查詢）")
+    if report["rerank"]:
+        rerank = report["rerank"]
+        print(
+            f"重排序: {rerank['calls']} 次，評分 {rerank['scored']} 組，"
+            f"快取命中 {rerank['cache_hits']}，超過預算 {rerank['over_budget']} 次"
+        )
+    if report["sources"]:
+        print("\n來源延遲 (ms，最後一次檢索):")
+        for name, s in report["sources"].items():
+            print(f"  {name:<10} p50 {s['p50']:>8.1f}  p99 {s['p99']:>8.1f}  {s['status']}")
+    if report["deadline_s"]:
+        print(f"\n期限 {report['deadline_s']} s，略過的步驟: {report['shortcuts'] or '無'}")
+    if report["empty_results"]:
+        print(f"沒有檢索結果的問題: {report['empty_results']}")
+
+
+def print_comparison(reports: dict[str, dict[str, Any]]) -> None:
+    """生成模型路由關閉 / 開啟的對照"""
+    print(f"{'模型路由':<10}{'p50 ms':>10}{'p99 ms':>10}{'生成 lite/main':>16}{'成本 USD':>12}")
+    for name, report in reports.items():
+        latency = report["latency_ms"]
+        generated = {m: s["count"] for m, s in report["generation_ms"].items()}
+        split = f"{generated.get('lite', 0)}/{generated.get('main', 0)}"
+        print(
+            f"{name:<10}{latency['p50']:>10.1f}{latency['p99']:>10.1f}{split:>16}"
+            f"{report['cost_usd']['total']:>12.4f}"
+        )
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Agentic RAG 離線 harness（替身 LLM / embedding）")
+    parser.add_argument(
+        "--workdir", help="vault 與向量庫目錄（預設使用暫存目錄，重複使用可略過索引）"
+    )
+    parser.add_argument("--notes", type=int, default=100, help="合成 vault 的筆記數")
+    parser.add_argument("--questions", type=int, default=50, help="合成問題數")
+    parser.add_argument("--questions-file", help="問題檔（每行一個問題），取代合成問題")
+    parser.add_argument("--seed", type=int, default=0, help="亂數種子")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="embedding 延遲（秒）")
+    parser.add_argument("--lite-latency", type=float, default=0.3, help="lite LLM 延遲（秒）")
+    parser.add_argument("--main-latency", type=float, default=1.0, help="main LLM 延遲（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延遲上下浮動比例")
+    parser.add_argument("--relevance", type=float, default=0.5, help="LLM 評為相關的比例")
+    parser.add_argument("--max-retries", "-r", type=int, default=MAX_RETRIES, help="最大重試次數")
+    parser.add_argument("--retrieval", choices=RETRIEVAL_MODES, default="loop", help="檢索模式")
+    parser.add_argument(
+        "--relevant-distance",
+        type=float,
+        default=GRADE_RELEVANT_DISTANCE,
+        help="distance 小於等於此值直接視為相關",
+    )
+    parser.add_argument(
+        "--irrelevant-distance",
+        type=float,
+        default=GRADE_IRRELEVANT_DISTANCE,
+        help="distance 大於等於此值直接視為不相關",
+    )
+    parser.add_argument(
+        "--memory-latency", type=float, default=0.1, help="federated: memory API 延遲（秒）"
+    )
+    parser.add_argument(
+        "--history-latency", type=float, default=0.2, help="federated: history API 延遲（秒）"
+    )
+    parser.add_argument(
+        "--source-timeout", type=float, default=SOURCE_TIMEOUT, help="federated: API 來源逾時（秒）"
+    )
+    parser.add_argument("--deadline", type=float, help="每個問題的時間上限（秒）")
+    parser.add_argument(
+        "--no-model-routing", action="store_true", help="一律以 main 模型生成（不依問題選模型）"
+    )
+    parser.add_argument(
+        "--compare-model-routing",
+        action="store_true",
+        help="同一組問題分別在模型路由關閉 / 開啟下執行並對照",
+    )
+    parser.add_argument("--rerank", action="store_true", help="啟用 cross-encoder 重排序（替身）")
+    parser.add_argument(
+        "--rerank-latency", type=float, default=0.002, help="重排序每組配對的延遲（秒）"
+    )
+    parser.add_argument(
+        "--rerank-accuracy", type=float, default=0.8, help="重排序與 LLM 相關判定一致的比例"
+    )
+    parser.add_argument("--concurrency", type=int, default=QUERY_CONCURRENCY, help="並行問題數")
+    parser.add_argument("--sync", action="store_true", help="以同步路徑逐一執行（CLI query 路徑）")
+    parser.add_argument("--verbose", "-v", action="store_true", help="顯示節點日誌")
+    parser.add_argument("--json", action="store_true", help="輸出 JSON 格式")
+
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.workdir:
+            workdir = Path(args.workdir).expanduser()
+            workdir.mkdir(parents=True, exist_ok=True)
+        else:
+            workdir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="rag-harness-")))
+
+        harness = Harness(
+            workdir,
+            notes=args.notes,
+            seed=args.seed,
+            embed_latency=args.embed_latency,
+            lite_latency=args.lite_latency,
+            main_latency=args.main_latency,
+            jitter=args.jitter,
+            relevance=args.relevance,
+            max_retries=args.max_retries,
+            retrieval=args.retrieval,
+            relevant_distance=args.relevant_distance,
+            irrelevant_distance=args.irrelevant_distance,
+            memory_latency=args.memory_latency,
+            history_latency=args.history_latency,
+            source_timeout=args.source_timeout,
+            deadline=args.deadline,
+            model_routing=not args.no_model_routing,
+            rerank=args.rerank,
+            rerank_latency=args.rerank_latency,
+            rerank_accuracy=args.rerank_accuracy,
+        )
+        stack.callback(harness.close)
+        if args.questions_file:
+            questions = [
+                line.strip()
+                for line in Path(args.questions_file)
+                .expanduser()
+                .read_text(encoding="utf-8")
+                .splitlines()
+                if line.strip()
+            ]
+        else:
+            questions = make_questions(args.questions, args.seed)
+
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        harness.index()
+        if args.compare_model_routing:
+            reports = {}
+            for enabled in (False, True):
+                harness.agent.model_routing = enabled
+                reports["on" if enabled else "off"] = harness.run(
+                    questions, args.concurrency, args.sync
+                )
+        else:
+            report = harness.run(questions, args.concurrency, args.sync)
+
+    if args.compare_model_routing:
+        if args.json:
+            print(json.dumps(reports, ensure_ascii=False))
+        else:
+            print_comparison(reports)
+    elif args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""本地 cross-encoder 重排序 - 向量檢索多取候選，以 (問題, 段落) 配對評分後重新排序
+
+向量距離只比對 embedding，常把只沾到關鍵字的段落排在前面；cross-encoder 同時讀問題與
+段落，排序較準，交給 grade 的前幾個文件更可能相關，減少 LLM 評分與重寫查詢。
+
+- 需要 sentence-transformers（選用套件，CPU 推論）；未安裝時略過重排序，維持向量順序
+- 分數快取以 (問題, 段落內容 hash) 為 key，存在向量庫目錄
+- 延遲預算：每批推論前預估耗時，超過預算就停止，未評分的候選依原順序排在後面
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from obsidian_rag import content_hash
+
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder
+
+# Constants
+RERANK_ENABLED = os.environ.get("RAG_RERANK", "") == "1"
+# 多語言小模型（中英文筆記），CPU 上一批 16 組約數十毫秒
+RERANK_MODEL = os.environ.get("RAG_RERANK_MODEL") or "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+RERANK_CANDIDATES = 20  # 向量檢索多取的候選數
+RERANK_BATCH_SIZE = 16
+RERANK_BUDGET = float(os.environ.get("RAG_RERANK_BUDGET") or 0.5)  # 秒
+RERANK_CACHE_FILE = "rerank_cache.npz"
+RERANK_CACHE_SIZE = 4096
+
+Scorer = Callable[[list[tuple[str, str]]], Iterable[float]]
+
+
+def rerank_available() -> bool:
+    """sentence-transformers 是否已安裝（不實際 import，避免載入 torch）"""
+    return importlib.util.find_spec("sentence_transformers") is not None
+
+
+class CrossEncoderReranker:
+    """帶分數快取與延遲預算的 cross-encoder 重排序
+
+    scorer: 自訂評分函式（(問題, 段落) 配對 → 分數），預設使用 RERANK_MODEL
+    """
+
+    def __init__(
+        self,
+        model_name: str = RERANK_MODEL,
+        batch_size: int = RERANK_BATCH_SIZE,
+        budget: float = RERANK_BUDGET,
+        cache_path: Path | None = None,
+        scorer: Scorer | None = None,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget = budget
+        self.cache_path = cache_path
+        self._scorer = scorer
+        self._model: CrossEncoder | None = None
+        self._cache: dict[str, float] | None = None
+        self._lock = threading.Lock()  # 模型推論與快取共用
+        self._pair_seconds: float | None = None  # 每組配對的推論時間（指數移動平均）
+        self.stats = {"calls": 0, "scored": 0, "cache_hits": 0, "over_budget": 0}
+
+    @property
+    def scorer(self) -> Scorer:
+        if self._scorer is None:
+            from sentence_transformers import CrossEncoder
+
+            print(f"  [rerank] 載入模型 {self.model_name}", file=sys.stderr)
+            self._model = CrossEncoder(self.model_name, device="cpu")
+            model = self._model
+            self._scorer = lambda pairs: model.predict(
+                pairs, batch_size=self.batch_size, show_progress_bar=False
+            )
+        return self._scorer
+
+    def _load_cache(self) -> dict[str, float]:
+        if self._cache is None:
+            self._cache = {}
+            if self.cache_path is not None and self.cache_path.exists():
+                try:
+                    with np.load(self.cache_path, allow_pickle=True) as stored:
+                        for key, score in zip(stored["keys"], stored["scores"], strict=False):
+                            self._cache[str(key)] = float(score)
+                except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                    self._cache = {}  # 快取損毀就重新評分
+        return self._cache
+
+    def _save_cache(self) -> None:
+        cache = self._load_cache()
+        if self.cache_path is None or not cache:
+            return
+        keys = list(cache)[-RERANK_CACHE_SIZE:]
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # 先寫暫存檔再替換，同時執行的查詢程序不會讀到寫一半的檔案
+        tmp_path = self.cache_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(keys, dtype=object),
+            scores=np.array([cache[k] for k in keys], dtype=np.float32),
+        )
+        tmp_path.replace(self.cache_path)
+
+    def _score(self, query: str, chunks: list[str]) -> list[float | None]:
+        """依序分批評分；超過延遲預算時剩下的回傳 None"""
+        started = time.perf_counter()
+        cache = self._load_cache()
+        keys = [f"{query}\x1f{content_hash(chunk)}" for chunk in chunks]
+        scores: list[float | None] = [cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self.stats["cache_hits"] += len(chunks) - len(missing)
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start : start + self.batch_size]
+            elapsed = time.perf_counter() - started
+            estimate = (self._pair_seconds or 0.0) * len(batch)
+            # 第一批一定執行，否則重排序沒有意義
+            if start and elapsed + estimate > self.budget:
+                self.stats["over_budget"] += 1
+                print(
+                    f"  [rerank] 超過延遲預算 {self.budget}s，{len(missing) - start} 個候選未評分",
+                    file=sys.stderr,
+                )
+                break
+            batch_started = time.perf_counter()
+            values = self.scorer([(query, chunks[i]) for i in batch])
+            per_pair = (time.perf_counter() - batch_started) / len(batch)
+            self._pair_seconds = (
+                per_pair
+                if self._pair_seconds is None
+                else 0.7 * self._pair_seconds + 0.3 * per_pair
+            )
+            for i, value in zip(batch, values, strict=True):
+                scores[i] = cache[keys[i]] = float(value)
+            self.stats["scored"] += len(batch)
+
+        for key in dict.fromkeys(keys):
+            if key in cache:
+                cache[key] = cache.pop(key)  # LRU: 移到最後
+        if missing:
+            self._save_cache()
+        return scores
+
+    def rerank(self, query: str, results: list[dict[str, Any]], top_k: int) -> list[dict[str, Any]]:
+        """依 cross-encoder 分數重新排序，回傳前 top_k 個（附 rerank_score）
+
+        未評分的候選（超過預算）維持原順序排在已評分的候選之後。
+        """
+        if not results:
+            return []
+        with self._lock:
+            self.stats["calls"] += 1
+            try:
+                scores = self._score(query, [r["chunk"] for r in results])
+            except Exception as e:
+                print(f"  [rerank] 重排序失敗，維持向量順序: {e}", file=sys.stderr)
+                return results[:top_k]
+
+        scored = [
+            {**r, "rerank_score": round(score, 4)}
+            for r, score in zip(results, scores, strict=True)
+            if score is not None
+        ]
+        scored.sort(key=lambda r: -r["rerank_score"])
+        unscored = [r for r, score in zip(results, scores, strict=True) if score is None]
+        return (scored + unscored)[:top_k]
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""多來源 RAG - 每個來源（vault、workspace）一個 collection，平行查詢後合併
+
+設定檔範例（~/.config/pai/rag-shards.json）：
+
+    {
+      "shards": [
+        {"name": "personal", "vault": "~/obsidian-vault", "sync_interval_minutes": 240},
+        {"name": "work", "vault": "~/work-vault", "collection": "work_vault"},
+        {"name": "workspace", "vault": "~/pai-claude", "collection": "pai_workspace"}
+      ]
+    }
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, NotRequired, TypedDict
+
+from obsidian_rag import (
+    DB_PATH,
+    DEFAULT_COLLECTION,
+    EMBEDDING_MODEL,
+    SEARCH_FETCH_MULTIPLIER,
+    SEARCH_TIMEOUT,
+    ObsidianRAG,
+)
+
+SHARDS_CONFIG = Path(
+    os.environ.get("RAG_SHARDS_CONFIG") or Path.home() / ".config" / "pai" / "rag-shards.json"
+)
+DEFAULT_SYNC_INTERVAL_MINUTES = 240
+
+
+class ShardConfig(TypedDict):
+    """單一 shard 設定"""
+
+    name: str
+    vault: str
+    collection: NotRequired[str]
+    db: NotRequired[str]
+    sync_interval_minutes: NotRequired[int]
+
+
+def load_shard_configs(path: str | Path = SHARDS_CONFIG) -> list[ShardConfig]:
+    """讀取 shard 設定檔"""
+    config_path = Path(path).expanduser()
+    if not config_path.exists():
+        raise FileNotFoundError(f"Shard 設定檔不存在: {config_path}")
+    data = json.loads(config_path.read_text(encoding="utf-8"))
+    shards: list[ShardConfig] = data["shards"]
+    names = [s["name"] for s in shards]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Shard 名稱重複: {names}")
+    check_shard_targets(shards)
+    return shards
+
+
+def check_shard_targets(shards: list[ShardConfig], db_path: str | Path | None = None) -> None:
+    """確認每個 shard 的 (db, collection) 不重複
+
+    共用同一個 collection 時，各自的 sync 會把對方的 chunks 當成已刪除檔案清掉，
+    合併查詢也會回傳重複結果。
+    """
+    default_db = Path(db_path).expanduser() if db_path else DB_PATH
+    owners: dict[tuple[Path, str], str] = {}
+    for shard in shards:
+        db = Path(shard.get("db") or default_db).expanduser().resolve()
+        target = (db, shard.get("collection", DEFAULT_COLLECTION))
+        if target in owners:
+            raise ValueError(
+                f"Shard {owners[target]} 與 {shard['name']} 使用同一個 collection: "
+                f"{target[1]}（{target[0]}），請設定不同的 collection 或 db"
+            )
+        owners[target] = shard["name"]
+
+
+class ShardedRAG:
+    """多個 ObsidianRAG shard 的查詢與同步管理
+
+    所有 shard 使用同一個 embedding 模型，查詢向量只計算一次，
+    各 shard 的向量查詢是本地操作，以 thread pool 平行執行。
+    """
+
+    def __init__(
+        self,
+        configs: list[ShardConfig],
+        db_path: str | Path | None = None,
+        readonly: bool = False,
+    ):
+        check_shard_targets(configs, db_path)
+        self.configs = {c["name"]: c for c in configs}
+        self.db_path = Path(db_path).expanduser() if db_path else DB_PATH
+        self.readonly = readonly
+        self.state_path = self.db_path / "shards_state.json"
+        self._shards: dict[str, ObsidianRAG] = {}
+
+    def shard(self, name: str) -> ObsidianRAG:
+        """取得（必要時建立）shard"""
+        if name not in self._shards:
+            config = self.configs[name]
+            self._shards[name] = ObsidianRAG(
+                config["vault"],
+                config.get("db") or self.db_path,
+                readonly=self.readonly,
+                collection=config.get("collection", DEFAULT_COLLECTION),
+            )
+        return self._shards[name]
+
+    def _select(self, names: list[str] | None) -> list[str]:
+        if not names:
+            return list(self.configs)
+        unknown = set(names) - self.configs.keys()
+        if unknown:
+            raise ValueError(f"未知的 shard: {sorted(unknown)}")
+        return names
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 5,
+        shards: list[str] | None = None,
+        mmr: bool = False,
+        merge_adjacent: bool = False,
+        timeout: float | None = SEARCH_TIMEOUT,
+    ) -> list[dict[str, Any]]:
+        """平行查詢多個 shard，依 cosine distance 合併成全域 top-k
+
+        各 shard 位於同一個 embedding 空間，cosine distance 可直接比較。
+        embedding 逾時時每個 shard 改用關鍵字搜尋，結果標記 degraded。
+        """
+        names = self._select(shards)
+        query_vec = self.shard(names[0]).embed_query(query, timeout)
+        fetch_k = top_k * SEARCH_FETCH_MULTIPLIER if (mmr or merge_adjacent) else None
+
+        def run(name: str) -> list[dict[str, Any]]:
+            rag = self.shard(name)
+            if query_vec is None:
+                results = rag.keyword_search(query, top_k)
+                for r in results:
+                    r["degraded"] = True
+            else:
+                results = rag.search_vector(
+                    query_vec, top_k, mmr=mmr, merge_adjacent=merge_adjacent, fetch_k=fetch_k
+                )
+            for r in results:
+                r["shard"] = name
+            return results
+
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            merged = [r for results in pool.map(run, names) for r in results]
+
+        merged.sort(key=lambda r: r["distance"])
+        return merged[:top_k]
+
+    def _load_state(self) -> dict[str, Any]:
+        if not self.state_path.exists():
+            return {}
+        data: dict[str, Any] = json.loads(self.state_path.read_text(encoding="utf-8"))
+        return data
+
+    def due_shards(self, now: datetime | None = None) -> list[str]:
+        """依各 shard 的 sync_interval_minutes 判斷需要同步的 shard"""
+        now = now or datetime.now(tz=timezone.utc)
+        state = self._load_state()
+        due: list[str] = []
+        for name, config in self.configs.items():
+            last = state.get(name, {}).get("last_sync")
+            interval = config.get("sync_interval_minutes", DEFAULT_SYNC_INTERVAL_MINUTES)
+            if (
+                last is None
+                or (now - datetime.fromisoformat(last)).total_seconds() >= interval * 60
+            ):
+                due.append(name)
+        return due
+
+    def sync(self, shards: list[str] | None = None, due_only: bool = False) -> dict[str, Any]:
+        """依序同步 shard（embedding API 有速率限制，不平行執行）"""
+        names = self.due_shards() if due_only else self._select(shards)
+        if due_only and shards:
+            names = [n for n in names if n in shards]
+
+        results: dict[str, Any] = {}
+        for name in names:
+            print(f"[{name}] 同步 {self.configs[name]['vault']} ...", file=sys.stderr)
+            results[name] = self.shard(name).sync()
+            state = self._load_state()
+            state[name] = {
+                "last_sync": datetime.now(tz=timezone.utc).isoformat(),
+                "stats": results[name],
+            }
+            self.state_path.write_text(json.dumps(state), encoding="utf-8")
+        return results
+
+    def stats(self) -> dict[str, Any]:
+        """各 shard 統計"""
+        state = self._load_state()
+        return {
+            name: {**self.shard(name).stats(), "last_sync": state.get(name, {}).get("last_sync")}
+            for name in self.configs
+        }
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="多來源 RAG（shard）工具")
+    parser.add_argument("command", choices=["sync", "search", "stats"], help="執行的命令")
+    parser.add_argument("--config", default=str(SHARDS_CONFIG), help="Shard 設定檔")
+    parser.add_argument("--db", default=None, help="ChromaDB 路徑")
+    parser.add_argument("--shard", "-s", action="append", help="限定 shard（可重複）")
+    parser.add_argument("--due", action="store_true", help="只同步到期的 shard")
+    parser.add_argument("--query", "-q", help="搜尋查詢")
+    parser.add_argument("--top-k", "-k", type=int, default=5, help="回傳數量")
+    parser.add_argument("--mmr", action="store_true", help="使用 MMR 提高結果多樣性")
+    parser.add_argument("--merge", action="store_true", help="合併同檔案相鄰 chunks")
+    parser.add_argument(
+        "--timeout", type=float, default=SEARCH_TIMEOUT, help="查詢 embedding 等待上限（秒）"
+    )
+    parser.add_argument("--json", action="store_true", help="JSON 輸出")
+
+    args = parser.parse_args()
+
+    rag = ShardedRAG(load_shard_configs(args.config), args.db, readonly=args.command == "stats")
+
+    if args.command == "sync":
+        results = rag.sync(args.shard, due_only=args.due)
+        if args.json:
+            print(json.dumps(results))
+        else:
+            if not results:
+                print("沒有需要同步的 shard")
+            for name, s in results.items():
+                print(f"[{name}] +{s['added']} *{s['updated']} -{s['deleted']} ={s['unchanged']}")
+
+    elif args.command == "search":
+        if not args.query:
+            if args.json:
+                print(json.dumps({"error": "query required"}))
+            else:
+                print("請提供 --query 參數")
+            return
+        results = rag.search(
+            args.query,
+            args.top_k,
+            shards=args.shard,
+            mmr=args.mmr,
+            merge_adjacent=args.merge,
+            timeout=args.timeout,
+        )
+        if args.json:
+            print(json.dumps(results, ensure_ascii=False))
+        else:
+            for i, r in enumerate(results, 1):
+                print(
+                    f"\n--- {i}. [{r['shard']}] {r['file_path']} "
+                    f"(distance: {r['distance']:.4f}) ---"
+                )
+                print(r["chunk"][:200] + "..." if len(r["chunk"]) > 200 else r["chunk"])
+
+    elif args.command == "stats":
+        s = rag.stats()
+        if args.json:
+            print(json.dumps(s))
+        else:
+            print(f"Embedding: {EMBEDDING_MODEL}")
+            for name, shard_stats in s.items():
+                print(
+                    f"[{name}] {shard_stats['collection']}: "
+                    f"{shard_stats['total_files']} 檔案 / {shard_stats['total_chunks']} chunks "
+                    f"(上次同步: {shard_stats['last_sync'] or '從未'})"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+"""Token 粗估 - 不依賴 tokenizer，供 context 預算與批次分組使用
+
+只用標準函式庫：obsidian_rag / agentic_rag 與 intel-feed agent 共用，
+intel-feed 的執行環境沒有 chromadb，不能從 obsidian_rag 匯入。
+"""
+
+from __future__ import annotations
+
+import re
+
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數（CJK 約一字一 token，其他約四字元一 token）"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
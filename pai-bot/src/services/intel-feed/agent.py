@@ -10,6 +10,8 @@ from __future__ import annotations
 import json
 import os
 import sys
+from collections import Counter
+from pathlib import Path
 from typing import TYPE_CHECKING, Any, Literal, TypedDict
 
 from langchain_core.prompts import ChatPromptTemplate
@@ -18,11 +20,51 @@ from langgraph.graph import END, START, StateGraph
 from pydantic import BaseModel, Field
 
 if TYPE_CHECKING:
+    from langchain_core.caches import BaseCache
     from langgraph.graph.state import CompiledStateGraph
 
+# 與 agentic_rag 共用的模組（src/rag）；單獨部署時以 PAI_RAG_DIR 指定，
+# 找不到就不使用快取，批次評分也改為逐一評分（分批需要 token 估算）
+RAG_MODULE_DIR = Path(
+    os.environ.get("PAI_RAG_DIR") or Path(__file__).resolve().parent.parent.parent / "rag"
+).expanduser()
+if RAG_MODULE_DIR.is_dir():
+    sys.path.insert(0, str(RAG_MODULE_DIR))
+try:
+    from llm_cache import get_llm_cache
+    from token_estimate import estimate_tokens
+
+    SHARED_MODULES = True
+except ImportError:
+    print(f"[intel-feed-agent] 找不到 {RAG_MODULE_DIR} 的共用模組，不使用快取", file=sys.stderr)
+    SHARED_MODULES = False
+
+    def get_llm_cache(namespace: str) -> BaseCache | None:
+        return None
+
+
 # Constants
 MIN_RELEVANCE_SCORE = 6
 ITEMS_PER_CATEGORY = 3
+# 同時進行的評分呼叫上限
+SCORE_CONCURRENCY = int(os.environ.get("INTEL_FEED_SCORE_CONCURRENCY") or 8)
+DEFAULT_RELEVANCE_SCORE = 5  # 評分失敗或回應無法解析時的分數
+# 評分模式：single 每個項目一次請求（預設），batch 一次請求評多個項目（共用 system prompt）
+# 找不到共用模組時無法估算 token 分批，只能逐一評分
+SCORE_MODES = ("single", "batch")
+SCORE_MODE = (os.environ.get("INTEL_FEED_SCORE_MODE") or "single").strip().lower()
+if SCORE_MODE not in SCORE_MODES:
+    print(
+        f"[intel-feed-agent] 未知的 INTEL_FEED_SCORE_MODE={SCORE_MODE!r}"
+        f"（可用 {'/'.join(SCORE_MODES)}），改用 single",
+        file=sys.stderr,
+    )
+    SCORE_MODE = "single"
+elif SCORE_MODE == "batch" and not SHARED_MODULES:
+    print("[intel-feed-agent] 沒有共用模組無法批次評分，改用 single", file=sys.stderr)
+    SCORE_MODE = "single"
+SCORE_BATCH_TOKEN_BUDGET = 1500  # 每批項目內容的 token 上限，決定每批的項目數
+SCORE_BATCH_MAX_ITEMS = 25  # 每批項目數上限（限制輸出長度）
 
 CATEGORY_META = {
     "ai": {"label": "AI/技術", "emoji": "🤖"},
@@ -99,6 +141,42 @@ class RelevanceScore(BaseModel):
     score: int = Field(description="1-10 的相關性分數", ge=1, le=10)
 
 
+class ItemScore(BaseModel):
+    """批次評分中單一項目的分數（範圍由呼叫端檢查，單筆無效不影響整批）"""
+
+    id: str = Field(description="項目編號")
+    score: int = Field(description="1-10 的相關性分數")
+
+
+class BatchRelevanceScores(BaseModel):
+    """批次相關性評分"""
+
+    scores: list[ItemScore] = Field(description="每個項目的分數")
+
+
+def _item_line(number: int, item: FeedItem) -> str:
+    return f"[{number}] 標題: {item['title']}\n來源: {item['sourceName']}\n分類: {item['category']}"
+
+
+def _pack_batches(items: list[FeedItem]) -> list[list[int]]:
+    """依 token 預算把項目分批（回傳各批的項目索引）"""
+    batches: list[list[int]] = []
+    current: list[int] = []
+    used = 0
+    for i, item in enumerate(items):
+        cost = estimate_tokens(_item_line(len(current) + 1, item))
+        if current and (
+            used + cost > SCORE_BATCH_TOKEN_BUDGET or len(current) >= SCORE_BATCH_MAX_ITEMS
+        ):
+            batches.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
 def _check_api_key() -> None:
     """檢查 API key"""
     if not os.environ.get("GOOGLE_API_KEY") and not os.environ.get("GEMINI_API_KEY"):
@@ -111,6 +189,7 @@ def get_lite_llm() -> ChatGoogleGenerativeAI:
     return ChatGoogleGenerativeAI(
         model="gemini-2.5-flash-lite",
         temperature=0,
+        cache=get_llm_cache("intel_feed"),
     )
 
 
@@ -120,6 +199,7 @@ def get_main_llm() -> ChatGoogleGenerativeAI:
     return ChatGoogleGenerativeAI(
         model="gemini-2.5-flash",
         temperature=0,
+        cache=get_llm_cache("intel_feed"),
     )
 
 
@@ -129,19 +209,21 @@ def create_intel_feed_graph() -> CompiledStateGraph[IntelFeedState]:
     lite_llm = get_lite_llm()
     main_llm = get_main_llm()
 
-    # Score prompt
+    # Score prompts（逐一與批次共用評分標準，分數可互相比較）
+    score_rubric = """評分標準 (1-10):
+- 1-3: 不相關或低品質（廣告、重複、無實質內容）
+- 4-5: 一般內容，無特殊價值
+- 6-7: 有趣、原創或有價值的內容
+- 8-10: 高價值內容，必讀"""
+
     score_prompt = ChatPromptTemplate.from_messages(
         [
             (
                 "system",
-                """你是一個內容評分助手。
+                f"""你是一個內容評分助手。
 評估這篇文章對一位關注 AI/技術、創業、生產力工具和 TRPG 的開發者的相關性。
 
-評分標準 (1-10):
-- 1-3: 不相關或低品質（廣告、重複、無實質內容）
-- 4-5: 一般內容，無特殊價值
-- 6-7: 有趣、原創或有價值的內容
-- 8-10: 高價值內容，必讀
+{score_rubric}
 
 只回答一個數字 (1-10)，不要其他內容。""",
             ),
@@ -152,6 +234,23 @@ def create_intel_feed_graph() -> CompiledStateGraph[IntelFeedState]:
         ]
     )
 
+    batch_score_prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                f"""你是一個內容評分助手。
+逐篇評估以下文章對一位關注 AI/技術、創業、生產力工具和 TRPG 的開發者的相關性。
+每篇文章獨立評分，不要互相比較。
+
+{score_rubric}
+
+為每篇文章回傳它的編號（方括號內的數字）與分數。""",
+            ),
+            ("human", "{items}"),
+        ]
+    )
+    batch_scorer = batch_score_prompt | lite_llm.with_structured_output(BatchRelevanceScores)
+
     # Outline prompt
     outline_prompt = ChatPromptTemplate.from_messages(
         [
@@ -199,30 +298,124 @@ def create_intel_feed_graph() -> CompiledStateGraph[IntelFeedState]:
         ]
     )
 
+    # Helper: Score items in batches
+    def _score_batches(items: list[FeedItem]) -> dict[int, int]:
+        """批次評分，回傳 {項目索引: 分數}；缺少或無效的項目不在結果中"""
+        batches = _pack_batches(items)
+        inputs = [
+            {"items": "\n\n".join(_item_line(n, items[i]) for n, i in enumerate(batch, 1))}
+            for batch in batches
+        ]
+        responses = batch_scorer.batch(
+            inputs,
+            config={"max_concurrency": SCORE_CONCURRENCY},
+            return_exceptions=True,
+        )
+
+        scores: dict[int, int] = {}
+        failed_batches = 0
+        for batch, response in zip(batches, responses, strict=True):
+            if isinstance(response, BaseException):
+                print(f"  [score] 批次評分失敗: {response}", file=sys.stderr)
+                failed_batches += 1
+                continue
+            # Handle both dict and Pydantic model responses
+            entries = (
+                response.scores
+                if isinstance(response, BatchRelevanceScores)
+                else response["scores"]
+            )
+            seen: set[int] = set()
+            for entry in entries:
+                entry_id, score = (
+                    (entry.id, entry.score)
+                    if isinstance(entry, ItemScore)
+                    else (entry["id"], entry["score"])
+                )
+                number = str(entry_id).strip("[] ")
+                if not number.isdigit() or not 1 <= int(number) <= len(batch):
+                    continue
+                index = batch[int(number) - 1]
+                if index in seen or not isinstance(score, int) or not 1 <= score <= 10:
+                    scores.pop(index, None)  # 重複或無效的分數都不採用
+                    seen.add(index)
+                    continue
+                seen.add(index)
+                scores[index] = score
+
+        print(
+            f"  [score] 批次評分: {len(batches)} 個請求（每批最多 {SCORE_BATCH_MAX_ITEMS} 項，"
+            f"{failed_batches} 批失敗），{len(scores)}/{len(items)} 個項目取得分數",
+            file=sys.stderr,
+        )
+        return scores
+
+    # Helper: Score items one by one
+    def _score_single(items: list[FeedItem]) -> list[int]:
+        """逐一評分（並行），失敗或無法解析的項目以 DEFAULT_RELEVANCE_SCORE 計"""
+        prompts = [
+            score_prompt.format(
+                title=item["title"],
+                source=item["sourceName"],
+                category=item["category"],
+            )
+            for item in items
+        ]
+        responses = lite_llm.batch(
+            prompts,  # type: ignore[arg-type]
+            config={"max_concurrency": SCORE_CONCURRENCY},
+            return_exceptions=True,
+        )
+
+        scores: list[int] = []
+        failures: Counter[str] = Counter()
+        unparsed = 0
+        for response in responses:
+            if isinstance(response, BaseException):
+                failures[type(response).__name__] += 1
+                scores.append(DEFAULT_RELEVANCE_SCORE)
+                continue
+            score_text = str(response.content).strip()
+            if score_text.isdigit():
+                scores.append(min(10, max(1, int(score_text))))
+            else:
+                unparsed += 1
+                scores.append(DEFAULT_RELEVANCE_SCORE)
+
+        if failures or unparsed:
+            summary = ", ".join(f"{name} x{count}" for name, count in failures.most_common())
+            print(
+                f"  [score] {sum(failures.values())} 個評分失敗"
+                f"{f'（{summary}）' if summary else ''}、{unparsed} 個回應無法解析，"
+                f"以 {DEFAULT_RELEVANCE_SCORE} 分計",
+                file=sys.stderr,
+            )
+        return scores
+
     # Node: Score items
     def score_items(state: IntelFeedState) -> dict[str, Any]:
-        """評分所有項目"""
-        items = state["items"]
-        scored: list[ScoredItem] = []
-
-        print(f"  [score] 評分 {len(items)} 個項目...", file=sys.stderr)
+        """評分所有項目（最多 SCORE_CONCURRENCY 個請求同時進行），結果依輸入順序
 
-        for item in items:
-            try:
-                prompt = score_prompt.format(
-                    title=item["title"],
-                    source=item["sourceName"],
-                    category=item["category"],
-                )
-                response = lite_llm.invoke(prompt)
-                score_text = str(response.content).strip()
-                score = min(10, max(1, int(score_text) if score_text.isdigit() else 5))
-            except Exception as e:
-                print(f"  [score] 評分失敗: {e}", file=sys.stderr)
-                score = 5
+        batch 模式先以批次請求評分，缺少或無效的項目再逐一評分。
+        """
+        items = state["items"]
 
-            scored_item: ScoredItem = {**item, "relevanceScore": score}  # type: ignore[typeddict-item]
-            scored.append(scored_item)
+        print(
+            f"  [score] 評分 {len(items)} 個項目（{SCORE_MODE}，並行 {SCORE_CONCURRENCY}）...",
+            file=sys.stderr,
+        )
+
+        scores = _score_batches(items) if SCORE_MODE == "batch" else {}
+        missing = [i for i in range(len(items)) if i not in scores]
+        if missing:
+            if scores:
+                print(f"  [score] {len(missing)} 個項目改為逐一評分", file=sys.stderr)
+            scores.update(zip(missing, _score_single([items[i] for i in missing]), strict=True))
+
+        scored: list[ScoredItem] = [
+            {**item, "relevanceScore": scores[i]}  # type: ignore[typeddict-item]
+            for i, item in enumerate(items)
+        ]
 
         avg_score = sum(i["relevanceScore"] for i in scored) / len(scored)
         print(f"  [score] 完成，平均分數: {avg_score:.1f}", file=sys.stderr)